@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SlicerWebApp.settings')
 
 application = get_asgi_application()
+
+# Load the model and run a warm-up pass once per worker, on a background thread
+# (see MODEL_WARMUP_IN_BACKGROUND), so the worker does not wait for it to start serving.
+from dicom_processor.model_registry import warm_up_model_registry  # noqa: E402
+
+warm_up_model_registry()
@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the latency it records includes every other middleware.
+    'dicom_processor.metrics.request_metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -129,4 +131,80 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100 MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10 MB per file
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Load the Keras model and run a warm-up inference when a WSGI/ASGI worker starts,
+# so the first processing request does not pay for model deserialization.
+MODEL_WARMUP_ON_STARTUP = True
+# Warm up on a background thread, so the worker (and runserver) serves pages while
+# TensorFlow and the model load; processing requests wait for the model until it is ready.
+MODEL_WARMUP_IN_BACKGROUND = True
+
+# Micro-batching of Grad-CAM inference: concurrent processing requests are collected
+# for up to INFERENCE_MAX_WAIT_MS or INFERENCE_MAX_BATCH_SIZE volumes and run as one batch.
+INFERENCE_BATCHING_ENABLED = True
+INFERENCE_MAX_BATCH_SIZE = 8
+INFERENCE_MAX_WAIT_MS = 20
+
+# Number of background threads that run processing jobs (inference, NRRD conversion)
+# outside of the HTTP request.
+PROCESSING_JOB_WORKERS = 2
+
+# A queued or running job whose row has not been updated for this long lost its worker
+# (e.g. the server was restarted) and is marked failed. Keep it above the longest stage.
+PROCESSING_JOB_STALE_SECONDS = 30 * 60
+
+# Byte budget of the per-process LRU cache of decoded volumes used by the slice endpoint.
+VOLUME_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB
+
+# Size limit of the on-disk cache of rendered slice PNGs (MEDIA_ROOT/slice_cache).
+SLICE_RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+
+# Parallel decoding of DICOM slices when a series is read. 'thread' suits uncompressed
+# and GIL-releasing codecs; 'process' spreads pure-Python codecs (e.g. RLE) over cores.
+DICOM_DECODE_WORKERS = min(8, os.cpu_count() or 1)
+DICOM_DECODE_BACKEND = 'thread'
+
+# Compile the inference tf.functions (Grad-CAM and score-only) with XLA. Can be faster
+# per batch, at the cost of one compilation per distinct batch size.
+GRAD_CAM_JIT_COMPILE = False
+
+# How the model volume is downsampled to (90, 90, 25): 'separable' (float32 matrix
+# products on MODEL_RESAMPLE_WORKERS threads) or 'skimage' (the original single-threaded
+# float64 resize). Both give the same result within float32 rounding.
+MODEL_INPUT_RESAMPLER = 'separable'
+MODEL_RESAMPLE_WORKERS = None  # None: one per CPU, up to 8
+
+# Resolution levels written for the 3D viewer, as shrink factors per axis. Every level
+# is a gzip-encoded NRRD; the viewer shows the coarsest first and refines with the rest.
+NRRD_PYRAMID_SHRINK_FACTORS = [4, 2, 1]
+
+# Threads that encode the slice sprite atlases of generate_all_directional_slices.
+SLICE_ATLAS_WORKERS = None  # None: one per CPU, up to 8
+
+# Threads that encode the slices of one ajax/slice_batch/ response.
+SLICE_BATCH_WORKERS = None  # None: one per CPU, up to 8
+
+# Stage timings (see dicom_processor.metrics.timed_stage) are logged as
+# "stage=<name> seconds=<s> ..." lines; per-slice encode timings only at DEBUG.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'timestamped': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'timestamped'},
+    },
+    'loggers': {
+        'dicom_processor': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# The Prometheus /metrics page is open to staff users, and to a scraper that sends
+# "Authorization: Bearer <METRICS_TOKEN>" when a token is set here.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+# Include the instance store's blob count and size in /metrics. Counting walks the
+# whole store, so the figures are kept for INSTANCE_STORE_STATS_MAX_AGE seconds.
+METRICS_INSTANCE_STORE_STATS = True
+INSTANCE_STORE_STATS_MAX_AGE = 5 * 60
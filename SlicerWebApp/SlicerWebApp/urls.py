@@ -15,11 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
 from dicom_processor import views as dicom_views
+from dicom_processor.media_serving import SERVED_MEDIA_DIRECTORIES
 
 
 urlpatterns = [
@@ -36,9 +37,20 @@ urlpatterns = [
 
     #if there is no id, then redirect it to the latest dashboard view:
     path('dashboard/', dicom_views.dashboard_view, name='dashboard_home'),
+
+    # Prometheus scrape target: stage timings, request latency and cache stats.
+    path('metrics', dicom_views.metrics, name='metrics'),
    
 ]
 
+# The viewer's media (NRRD volumes, heatmaps, rendered slices) is served by the app itself,
+# with authentication, Range requests, precompressed variants and cache headers.
+urlpatterns += [
+    re_path(r'^%s(?P<path>(?:%s)/.+)$' % (
+        settings.MEDIA_URL.lstrip('/'), '|'.join(SERVED_MEDIA_DIRECTORIES)
+    ), dicom_views.serve_media, name='serve_media'),
+]
+
 if settings.DEBUG:
     # This line serves  user-uploaded media files (like .nrrd files)
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,168 @@
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.test import override_settings
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless
+
+from . import model_registry
+from .synthetic import write_synthetic_series
+from .utils import (
+    convert_dicom_series_to_nrrd,
+    generate_all_directional_slices,
+    generate_heatmap,
+    get_slice_from_volume_and_save_png,
+    load_scan_as_3d_volume,
+)
+from .volume_store import VOLUME_FILENAME, VOLUME_HEADER_FILENAME
+
+
+# Transfer syntaxes the synthetic series can be written in.
+TRANSFER_SYNTAXES = {
+    'explicit': ExplicitVRLittleEndian,
+    'rle': RLELossless,
+}
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_commit():
+    """The commit the working tree is on, so reports from two commits can be told apart."""
+    try:
+        completed = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                                   capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+def synthetic_series_directory(data_dir, num_slices, size, transfer_syntax):
+    """
+    Directory of the synthetic series with these parameters under `data_dir`, written
+    on first use. The phantom is seeded, so every run (and every commit) measures the
+    same input; keep `data_dir` between runs to skip writing it again.
+    """
+    directory = os.path.join(data_dir, f"ct_{num_slices}x{size}x{size}_{transfer_syntax}")
+    complete_marker = os.path.join(directory, '.complete')
+    if not os.path.exists(complete_marker):
+        write_synthetic_series(directory, num_slices=num_slices, rows=size, cols=size,
+                               transfer_syntax=TRANSFER_SYNTAXES[transfer_syntax])
+        open(complete_marker, 'w').close()
+    return directory
+
+
+def clear_volume_store(directory):
+    """
+    Removes the consolidated volume store that reading a series leaves behind, so the
+    next stage decodes the DICOM files again instead of memory-mapping the store.
+    """
+    for filename in (VOLUME_FILENAME, VOLUME_HEADER_FILENAME):
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+
+
+def _bench_load_scan(directory, scratch, options):
+    volume, _ = load_scan_as_3d_volume(directory)
+    return {'shape': list(volume.shape)}
+
+
+def _bench_convert_nrrd(directory, scratch, options):
+    nrrd_path = os.path.join(scratch, 'volume.nrrd')
+    ok = convert_dicom_series_to_nrrd(directory, nrrd_path)
+    return {'ok': ok, 'bytes': os.path.getsize(nrrd_path) if ok else None}
+
+
+def _bench_generate_heatmap(directory, scratch, options):
+    heatmap_directory, ece_probability, _ = generate_heatmap(directory)
+    return {'ok': ece_probability is not None, 'with_heatmap': heatmap_directory is not None}
+
+
+def _bench_slice_png(directory, scratch, options):
+    volume, _ = load_scan_as_3d_volume(directory)
+    # Only the rendering is timed; the volume load is reported as load_scan_as_3d_volume.
+    started = time.perf_counter()
+    calls = 0
+    for orientation, axis in (('axial', 0), ('coronal', 1), ('sagittal', 2)):
+        for slice_index in range(0, volume.shape[axis], max(1, volume.shape[axis] // options['slice_samples'])):
+            get_slice_from_volume_and_save_png(volume, orientation, slice_index, 40, 400, scratch, 'bench_')
+            calls += 1
+    seconds = time.perf_counter() - started
+    return {'timed_seconds': seconds, 'calls': calls, 'seconds_per_slice': seconds / calls}
+
+
+def _bench_directional_slices(directory, scratch, options):
+    index = generate_all_directional_slices(directory, scratch, 0, 0)
+    return {'slices': sum(entry['count'] for entry in index['orientations'].values())}
+
+
+# Benchmarked stages: name -> function(directory, scratch, options) returning extra details.
+SUITE_STAGES = {
+    'load_scan_as_3d_volume': _bench_load_scan,
+    'convert_dicom_series_to_nrrd': _bench_convert_nrrd,
+    'generate_heatmap': _bench_generate_heatmap,
+    'get_slice_from_volume_and_save_png': _bench_slice_png,
+    'generate_all_directional_slices': _bench_directional_slices,
+}
+
+
+def run_stage(stage, directory, model_path=None, slice_samples=16):
+    """
+    Runs one benchmark stage and returns its wall time, peak RSS and details. Meant to
+    run in a fresh process, so the peak belongs to this stage alone. The model for
+    generate_heatmap is loaded before the clock starts, as a worker process does at
+    start-up, and its load time is reported separately.
+    """
+    baseline_rss = peak_rss_bytes()
+    options = {'slice_samples': slice_samples}
+    result = {}
+    if stage == 'generate_heatmap':
+        if model_path:
+            model_registry._registry = model_registry.ModelRegistry(model_path)
+        started = time.perf_counter()
+        if not model_registry.get_model_registry().warm_up():
+            return {'skipped': f"no model at {model_registry.get_model_registry().model_path}"}
+        result['model_warm_up_seconds'] = time.perf_counter() - started
+        baseline_rss = peak_rss_bytes()
+
+    with tempfile.TemporaryDirectory() as scratch, override_settings(MEDIA_ROOT=scratch):
+        # Outputs (NRRDs, heatmaps, PNGs) go to the scratch directory, not the real media.
+        started = time.perf_counter()
+        result.update(SUITE_STAGES[stage](directory, scratch, options))
+        result['seconds'] = time.perf_counter() - started
+    result['peak_rss_bytes'] = peak_rss_bytes()
+    result['peak_rss_above_startup_bytes'] = result['peak_rss_bytes'] - baseline_rss
+    return result
+
+
+def compare_reports(report, baseline):
+    """Per series and stage, the ratio of seconds and peak RSS between `report` and `baseline`."""
+    baseline_results = {entry['series']: entry['stages'] for entry in baseline.get('results', [])}
+    comparison = []
+    for entry in report['results']:
+        for stage, result in entry['stages'].items():
+            previous = baseline_results.get(entry['series'], {}).get(stage)
+            if not previous or 'seconds' not in previous or 'seconds' not in result:
+                continue
+            comparison.append({
+                'series': entry['series'],
+                'stage': stage,
+                'seconds': result['seconds'],
+                'baseline_seconds': previous['seconds'],
+                'seconds_ratio': result['seconds'] / previous['seconds'] if previous['seconds'] else None,
+                'peak_rss_ratio': (
+                    result['peak_rss_above_startup_bytes'] / previous['peak_rss_above_startup_bytes']
+                    if previous.get('peak_rss_above_startup_bytes') else None
+                ),
+            })
+    return comparison
@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+
+from .model_registry import MODEL_INPUT_SHAPE, get_model_registry
+from .utils import compute_gradcam_batch, compute_predictions_batch
+
+
+class InferenceDispatcher:
+    """
+    Collects model inputs from concurrent requests and runs them as one batch.
+
+    Callers submit a volume that is already resized to (90, 90, 25) and get back a
+    Future. A single background thread waits for the first request, then keeps
+    collecting until either max_batch_size requests are queued or max_wait_seconds
+    have passed, and runs one batched Grad-CAM pass for all of them. Each Future
+    resolves to (prediction_row, cam) for its own volume.
+
+    Score-only requests (with_heatmap=False) are collected the same way but run as
+    a separate forward-only batch, and resolve to (prediction_row, None).
+    """
+
+    def __init__(self, gradcam_fn_getter, max_batch_size=8, max_wait_seconds=0.02, predict_fn_getter=None):
+        self.gradcam_fn_getter = gradcam_fn_getter
+        self.predict_fn_getter = predict_fn_getter
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_seconds = max(0.0, float(max_wait_seconds))
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.batches_run = 0
+        self.requests_served = 0
+        self.requests_failed = 0
+        self.score_only_requests_served = 0
+        self.max_queue_depth = 0
+        self.batch_size_counts = {}
+        self.total_batch_seconds = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, resized_volume, with_heatmap=True):
+        """Queues one (90, 90, 25) volume and returns a Future for (prediction_row, cam)."""
+        resized_volume = np.asarray(resized_volume, dtype=np.float32)
+        if resized_volume.shape != MODEL_INPUT_SHAPE:
+            raise ValueError(f"Expected a volume of shape {MODEL_INPUT_SHAPE}, got {resized_volume.shape}.")
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((resized_volume, future, with_heatmap))
+        with self._metrics_lock:
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='inference-dispatcher', daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self):
+        # Block until there is at least one request, then fill up the batch
+        # until it is full or the wait window has closed.
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Requests whose caller already cancelled the Future are dropped here.
+            batch = [(volume, future, with_heatmap) for volume, future, with_heatmap in self._collect_batch()
+                     if future.set_running_or_notify_cancel()]
+            gradcam_batch = [(volume, future) for volume, future, with_heatmap in batch if with_heatmap]
+            score_batch = [(volume, future) for volume, future, with_heatmap in batch if not with_heatmap]
+            if gradcam_batch:
+                self._run_batch(gradcam_batch, with_heatmap=True)
+            if score_batch:
+                self._run_batch(score_batch, with_heatmap=False)
+
+    def _run_batch(self, batch, with_heatmap):
+        volumes = [volume for volume, _ in batch]
+        futures = [future for _, future in batch]
+
+        started = time.perf_counter()
+        try:
+            input_batch = np.expand_dims(np.stack(volumes, axis=0), axis=-1)
+            if with_heatmap:
+                gradcam_fn = self.gradcam_fn_getter()
+                if gradcam_fn is None:
+                    raise RuntimeError("Grad-CAM model is not available.")
+                predictions, cams = compute_gradcam_batch(gradcam_fn, input_batch)
+            else:
+                predict_fn = self.predict_fn_getter() if self.predict_fn_getter else None
+                if predict_fn is None:
+                    raise RuntimeError("Model is not available.")
+                predictions = compute_predictions_batch(predict_fn, input_batch)
+                cams = [None] * len(predictions)
+        except Exception as e:
+            print(f"!!! ERROR running batched inference for {len(futures)} request(s): {e}")
+            for future in futures:
+                future.set_exception(e)
+            with self._metrics_lock:
+                self.requests_failed += len(futures)
+            return
+
+        for future, prediction_row, cam in zip(futures, predictions, cams):
+            future.set_result((prediction_row, cam))
+
+        with self._metrics_lock:
+            self.batches_run += 1
+            self.requests_served += len(futures)
+            if not with_heatmap:
+                self.score_only_requests_served += len(futures)
+            self.batch_size_counts[len(futures)] = self.batch_size_counts.get(len(futures), 0) + 1
+            self.total_batch_seconds += time.perf_counter() - started
+
+    def stats(self):
+        with self._metrics_lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'batches_run': self.batches_run,
+                'requests_served': self.requests_served,
+                'requests_failed': self.requests_failed,
+                'score_only_requests_served': self.score_only_requests_served,
+                'mean_batch_size': (self.requests_served / self.batches_run) if self.batches_run else 0.0,
+                'batch_size_counts': dict(sorted(self.batch_size_counts.items())),
+                'total_batch_seconds': self.total_batch_seconds,
+            }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def _registry_gradcam_fn():
+    registry = get_model_registry()
+    registry.ensure_loaded()
+    return registry.gradcam_fn
+
+
+def _registry_predict_fn():
+    registry = get_model_registry()
+    registry.ensure_loaded()
+    return registry.predict_fn
+
+
+def get_inference_dispatcher():
+    """Returns the process-wide InferenceDispatcher, configured from settings."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = InferenceDispatcher(
+                    _registry_gradcam_fn,
+                    max_batch_size=getattr(settings, 'INFERENCE_MAX_BATCH_SIZE', 8),
+                    max_wait_seconds=getattr(settings, 'INFERENCE_MAX_WAIT_MS', 20) / 1000.0,
+                    predict_fn_getter=_registry_predict_fn,
+                )
+    return _dispatcher
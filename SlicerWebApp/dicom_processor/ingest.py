@@ -0,0 +1,364 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pydicom
+
+from .metrics import timed_stage
+
+
+def _first_value(value, default):
+    if value is None or value == '':
+        return default
+    if isinstance(value, pydicom.multival.MultiValue):
+        value = value[0]
+    return float(value)
+
+
+class SeriesVolume:
+    """
+    A DICOM series decoded once, together with the metadata every later stage needs.
+
+    `pixels` holds the stored values with shape (slices, rows, cols), in the order
+    given by sort_slice_headers. Rescale slope/intercept and window center/width are
+    kept per slice, because the DICOM standard allows them to differ between instances.
+    Spacing and origin follow SimpleITK's (x, y, z) order. `fingerprint` identifies
+    the series content (see series_fingerprint) and is None when it is not known.
+    """
+
+    def __init__(self, pixels, spacing, origin, direction,
+                 rescale_slopes, rescale_intercepts, window_centers, window_widths, fingerprint=None):
+        self.pixels = pixels
+        self.spacing = tuple(spacing)
+        self.origin = tuple(origin)
+        self.direction = tuple(direction)
+        self.rescale_slopes = np.asarray(rescale_slopes, dtype=np.float32)
+        self.rescale_intercepts = np.asarray(rescale_intercepts, dtype=np.float32)
+        self.window_centers = np.asarray(window_centers, dtype=np.float32)
+        self.window_widths = np.asarray(window_widths, dtype=np.float32)
+        self.fingerprint = fingerprint
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    @property
+    def voxel_spacing(self):
+        """[row_spacing, col_spacing, slice_spacing] (PixelSpacing order), as returned by load_scan_as_3d_volume."""
+        return [self.spacing[1], self.spacing[0], self.spacing[2]]
+
+    @property
+    def slice_counts(self):
+        return {
+            'axial': self.pixels.shape[0],
+            'coronal': self.pixels.shape[1],
+            'sagittal': self.pixels.shape[2],
+        }
+
+    @property
+    def has_integer_rescale(self):
+        return bool(
+            np.all(self.rescale_slopes == np.round(self.rescale_slopes))
+            and np.all(self.rescale_intercepts == np.round(self.rescale_intercepts))
+        )
+
+    def rescaled_slice(self, index):
+        """One axial slice in modality units (e.g. Hounsfield units for CT) as float32."""
+        return self.pixels[index].astype(np.float32) * self.rescale_slopes[index] + self.rescale_intercepts[index]
+
+    def rescaled(self, dtype=np.float32):
+        """
+        The volume in modality units. It is filled one slice at a time, so no
+        full-size temporary copy is made besides the result itself.
+        """
+        volume = np.empty(self.pixels.shape, dtype=dtype)
+        for index in range(self.pixels.shape[0]):
+            volume[index] = self.rescaled_slice(index)
+        return volume
+
+    def rescaled_fits_int16(self):
+        """True when the rescaled values are whole numbers inside the int16 range."""
+        if not self.has_integer_rescale:
+            return False
+        low = np.minimum(self.pixels.min() * self.rescale_slopes, self.pixels.max() * self.rescale_slopes) + self.rescale_intercepts
+        high = np.maximum(self.pixels.min() * self.rescale_slopes, self.pixels.max() * self.rescale_slopes) + self.rescale_intercepts
+        return bool(low.min() >= -32768 and high.max() <= 32767)
+
+
+def series_fingerprint(sop_instance_uids, series_volume):
+    """
+    Content hash of a series: its SOPInstanceUIDs in stacking order, the decoded
+    pixel data slice by slice, and the per-slice rescale and window values the
+    model input depends on. Two uploads of the same study get the same fingerprint.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    for uid in sop_instance_uids:
+        digest.update(str(uid or '').encode())
+        digest.update(b'\0')
+    digest.update(f"{series_volume.pixels.shape}|{series_volume.pixels.dtype.str}".encode())
+    for index in range(series_volume.pixels.shape[0]):
+        digest.update(np.ascontiguousarray(series_volume.pixels[index]).data)
+    for values in (series_volume.rescale_slopes, series_volume.rescale_intercepts,
+                   series_volume.window_centers, series_volume.window_widths):
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def _decode_file(file_path):
+    """
+    Worker for decode_dicom_files: parses one file and decodes its pixels.
+    Returns (dataset_without_pixel_data, pixel_array). Kept at module level and
+    free of Django imports so process-pool workers can import and run it.
+    """
+    dicom_slice = pydicom.dcmread(file_path)
+    pixel_array = dicom_slice.pixel_array
+    del dicom_slice.PixelData
+    return dicom_slice, pixel_array
+
+
+def _decode_pixels(file_path):
+    """Like _decode_file, for callers that already have the headers: only the pixel array leaves the worker."""
+    return pydicom.dcmread(file_path).pixel_array
+
+
+def _decode_options(workers, backend):
+    if workers is None or backend is None:
+        from django.conf import settings
+        if workers is None:
+            workers = getattr(settings, 'DICOM_DECODE_WORKERS', 1)
+        if backend is None:
+            backend = getattr(settings, 'DICOM_DECODE_BACKEND', 'thread')
+    if backend not in ('thread', 'process'):
+        raise ValueError(f"Unknown DICOM decode backend '{backend}'. Use 'thread' or 'process'.")
+    return max(1, int(workers)), backend
+
+
+def decode_dicom_files(file_paths, workers=None, backend=None, with_headers=True):
+    """
+    Decodes the given DICOM files into one (len(file_paths), rows, cols) volume, in
+    the order given. Returns (pixels, headers) where headers are the datasets
+    without their PixelData, or None when `with_headers` is False (each dataset is
+    then dropped as soon as its pixels are decoded).
+
+    With more than one worker the files are decoded concurrently on a thread pool
+    or, for codecs that hold the GIL, a process pool (DICOM_DECODE_WORKERS and
+    DICOM_DECODE_BACKEND). Every decoded slice is written straight into its slot
+    of the output volume as soon as it is ready, so the result is identical to
+    decoding the files one by one.
+    """
+    if not file_paths:
+        raise ValueError("No DICOM files to decode.")
+    workers, backend = _decode_options(workers, backend)
+    pixels = None
+    headers = [None] * len(file_paths) if with_headers else None
+    decode = _decode_file if with_headers else _decode_pixels
+
+    def place(index, file_path, decoded):
+        nonlocal pixels
+        dicom_slice, pixel_array = decoded if with_headers else (None, decoded)
+        if pixels is None:
+            pixels = np.empty((len(file_paths),) + pixel_array.shape, dtype=pixel_array.dtype)
+        if pixel_array.shape != pixels.shape[1:]:
+            raise ValueError(f"Error stacking slices into a 3D volume: {file_path} has shape "
+                             f"{pixel_array.shape}, expected {pixels.shape[1:]}")
+        pixels[index] = pixel_array
+        if headers is not None:
+            headers[index] = dicom_slice
+
+    def read_error(file_path, e):
+        print(f"Warning: Could not read DICOM file {file_path}: {e}")
+        return ValueError(f"Could not read DICOM file {file_path}: {e}")
+
+    if workers == 1 or len(file_paths) < 2:
+        for index, file_path in enumerate(file_paths):
+            try:
+                decoded = decode(file_path)
+            except Exception as e:
+                raise read_error(file_path, e)
+            place(index, file_path, decoded)
+        return pixels, headers
+
+    if backend == 'process':
+        # 'spawn' keeps TensorFlow's threads out of the children; workers only import this module.
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dicom-decode')
+    with pool:
+        futures = {pool.submit(decode, file_path): index for index, file_path in enumerate(file_paths)}
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    decoded = future.result()
+                except Exception as e:
+                    raise read_error(file_paths[index], e)
+                place(index, file_paths[index], decoded)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return pixels, headers
+
+
+# Header elements kept per instance: enough to order the slices, describe the
+# volume geometry and window it, plus the study fields the upload form shows.
+SLICE_HEADER_KEYWORDS = [
+    'InstanceNumber', 'ImagePositionPatient', 'ImageOrientationPatient',
+    'PixelSpacing', 'SliceThickness', 'SpacingBetweenSlices',
+    'RescaleSlope', 'RescaleIntercept', 'WindowCenter', 'WindowWidth',
+    'SOPInstanceUID', 'SeriesInstanceUID', 'PatientID', 'PatientAge', 'PatientSex',
+    'SeriesDescription', 'StudyDescription', 'Rows', 'Columns',
+]
+
+
+class SliceHeader:
+    """
+    The few header values of one instance that ordering, geometry and windowing
+    need, read without touching its pixel data. `get` mirrors Dataset.get.
+    """
+
+    def __init__(self, path, dataset):
+        self.path = path
+        self.values = {keyword: dataset.get(keyword) for keyword in SLICE_HEADER_KEYWORDS if keyword in dataset}
+
+    def get(self, keyword, default=None):
+        value = self.values.get(keyword)
+        return default if value is None else value
+
+
+def read_slice_header(file_path):
+    """Parses only the header elements in SLICE_HEADER_KEYWORDS of one file; pixel data is never read."""
+    dataset = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=SLICE_HEADER_KEYWORDS)
+    return SliceHeader(file_path, dataset)
+
+
+def _slice_position(header):
+    position = header.get('ImagePositionPatient')
+    orientation = header.get('ImageOrientationPatient')
+    if not position or len(position) != 3:
+        return None
+    normal = np.array([0.0, 0.0, 1.0])
+    if orientation and len(orientation) == 6:
+        normal = np.cross([float(v) for v in orientation[:3]], [float(v) for v in orientation[3:]])
+    return float(np.dot([float(v) for v in position], normal))
+
+
+def sort_slice_headers(headers):
+    """
+    Puts the headers of a series in stacking order: by InstanceNumber when every
+    instance has a distinct one (as the volume has always been ordered), otherwise
+    by position along the slice normal from ImagePositionPatient, otherwise by file name.
+    """
+    try:
+        instance_numbers = [int(header.get('InstanceNumber')) for header in headers]
+        if len(set(instance_numbers)) == len(headers):
+            return [header for _, header in sorted(zip(instance_numbers, headers), key=lambda pair: pair[0])]
+    except (TypeError, ValueError):
+        pass
+
+    positions = [_slice_position(header) for header in headers]
+    if all(position is not None for position in positions) and len(set(positions)) == len(headers):
+        print("Warning: InstanceNumber missing or repeated, sorting slices by ImagePositionPatient instead.")
+        return [header for _, header in sorted(zip(positions, headers), key=lambda pair: pair[0])]
+
+    print("Warning: Could not order slices by InstanceNumber or position. Keeping file name order instead.")
+    return sorted(headers, key=lambda header: os.path.basename(header.path))
+
+
+def scan_series_headers(dicom_series_directory_path):
+    """
+    Header-only pass over the .dcm files of a directory. Returns the SliceHeaders
+    in stacking order; raises ValueError when there is nothing readable.
+    """
+    dicom_file_paths = [
+        os.path.join(dicom_series_directory_path, filename)
+        for filename in os.listdir(dicom_series_directory_path)
+        if filename.lower().endswith('.dcm')
+    ]
+    if not dicom_file_paths:
+        print(f"Error: No .dcm files found in directory: {dicom_series_directory_path}")
+        raise ValueError("No DICOM files found in the specified directory.")
+
+    headers = []
+    for file_path in dicom_file_paths:
+        try:
+            headers.append(read_slice_header(file_path))
+        except Exception as e:
+            print(f"Warning: Could not read DICOM file {file_path}: {e}")
+            raise ValueError(f"Could not read DICOM file {file_path}: {e}")
+    return sort_slice_headers(headers)
+
+
+def read_dicom_series(dicom_series_directory_path, workers=None, backend=None, headers=None):
+    """
+    Reads a DICOM series in two phases and returns a SeriesVolume. A header-only
+    scan orders the slices and supplies spacing and window metadata; pixel data is
+    then decoded in that order straight into the volume, so no more than a few
+    full datasets are alive at once. Pass `headers` (SliceHeaders with their paths
+    set, e.g. collected during upload) to skip the scan. Raises ValueError when the
+    directory does not contain a readable series.
+    """
+    print("Reading DICOM series from: ", dicom_series_directory_path)
+    with timed_stage('dicom_sort', headers_given=bool(headers)):
+        if headers:
+            headers = sort_slice_headers(headers)
+        else:
+            headers = scan_series_headers(dicom_series_directory_path)
+
+    with timed_stage('dicom_read', slices=len(headers)):
+        pixels, _ = decode_dicom_files(
+            [header.path for header in headers], workers=workers, backend=backend, with_headers=False,
+        )
+
+    slopes = [_first_value(header.get('RescaleSlope'), 1.0) for header in headers]
+    intercepts = [_first_value(header.get('RescaleIntercept'), 0.0) for header in headers]
+    centers = [_first_value(header.get('WindowCenter'), 40.0) for header in headers]
+    widths = [_first_value(header.get('WindowWidth'), 400.0) for header in headers]
+
+    spacing, origin, direction = _geometry(headers)
+    print(f"Read {len(headers)} slices as a volume with shape {pixels.shape} and spacing {spacing}")
+    series_volume = SeriesVolume(pixels, spacing, origin, direction, slopes, intercepts, centers, widths)
+    series_volume.fingerprint = series_fingerprint([header.get('SOPInstanceUID') for header in headers], series_volume)
+    return series_volume
+
+
+def _geometry(slice_objects):
+    """Returns (spacing, origin, direction) in SimpleITK's (x, y, z) convention."""
+    first_slice = slice_objects[0]
+
+    pixel_spacing = [1.0, 1.0]
+    ps = first_slice.get('PixelSpacing', None)
+    if ps:
+        pixel_spacing = [float(ps[0]), float(ps[1])]
+
+    slice_thickness = 1.0
+    st = first_slice.get('SliceThickness', None) or first_slice.get('SpacingBetweenSlices', None)
+    if st:
+        slice_thickness = float(st)
+
+    row_cosines, col_cosines = np.array([1.0, 0.0, 0.0]), np.array([0.0, 1.0, 0.0])
+    iop = first_slice.get('ImageOrientationPatient', None)
+    if iop and len(iop) == 6:
+        row_cosines = np.array([float(v) for v in iop[:3]])
+        col_cosines = np.array([float(v) for v in iop[3:]])
+    slice_direction = np.cross(row_cosines, col_cosines)
+
+    origin = (0.0, 0.0, 0.0)
+    first_position = first_slice.get('ImagePositionPatient', None)
+    last_position = slice_objects[-1].get('ImagePositionPatient', None)
+    if first_position:
+        origin = tuple(float(v) for v in first_position)
+        if last_position and len(slice_objects) > 1:
+            # Use the real distance between slice positions, and follow the order we
+            # stacked the slices in, even if it runs against the orientation normal.
+            step = (np.array([float(v) for v in last_position]) - np.array(origin)) / (len(slice_objects) - 1)
+            if np.linalg.norm(step) > 0:
+                slice_thickness = float(np.linalg.norm(step))
+                slice_direction = step / np.linalg.norm(step)
+
+    # PixelSpacing is (row spacing, column spacing); x runs along a row.
+    spacing = (pixel_spacing[1], pixel_spacing[0], slice_thickness)
+    direction = tuple(np.column_stack([row_cosines, col_cosines, slice_direction]).ravel().tolist())
+    return spacing, origin, direction
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import pydicom
+from django.conf import settings
+from django.core.files.move import file_move_safe
+
+from .volume_store import VOLUME_FILENAME, VOLUME_HEADER_FILENAME, build_volume_store
+
+
+INSTANCE_STORE_DIRNAME = 'instances'
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def _link_or_copy(source, destination):
+    """
+    Makes `destination` a hard link to `source`, replacing a file already there; where
+    the filesystem cannot link, a copy. The link is made under a unique name and moved
+    into place, so an existing destination is swapped out rather than written through
+    (it may be a link to another blob). Raises FileNotFoundError when `source` is gone,
+    e.g. a blob released by another process meanwhile. Returns whether it linked.
+    """
+    temp_path = os.path.join(os.path.dirname(destination), f".{uuid.uuid4().hex}.tmp")
+    try:
+        os.link(source, temp_path)
+        linked = True
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, temp_path)
+        linked = False
+    os.replace(temp_path, destination)
+    if os.path.lexists(temp_path):
+        # Renaming onto another link of the same file does nothing, so drop the spare link.
+        os.remove(temp_path)
+    return linked
+
+
+def _remove_if_unreferenced(blob):
+    """
+    Deletes a blob that no series links to any more; returns whether it did.
+
+    The blob is first moved to a unique name, so no other process can link to it
+    while its link count is checked: an upload that comes along meanwhile finds no
+    blob and stores the instance again. When a series linked to it just before the
+    move, the blob is put back.
+    """
+    try:
+        fd, claimed_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(blob))
+    except FileNotFoundError:
+        return False
+    os.close(fd)
+    try:
+        os.replace(blob, claimed_path)
+    except FileNotFoundError:
+        os.remove(claimed_path)
+        return False
+    if os.stat(claimed_path).st_nlink > 1:
+        try:
+            os.link(claimed_path, blob)
+        except FileExistsError:
+            # Stored again meanwhile; the series linked to this copy keep it alive.
+            pass
+        os.remove(claimed_path)
+        return False
+    os.remove(claimed_path)
+    return True
+
+
+class InstanceStore:
+    """
+    Content-addressed store of uploaded DICOM instances under MEDIA_ROOT/instances.
+
+    Every instance is kept once, as a blob named after the hash of its
+    SOPInstanceUID and its bytes. A series directory holds hard links to its blobs
+    (so every reader of .dcm files keeps working unchanged) plus a manifest.json
+    listing them. The consolidated volume store is shared the same way, keyed by
+    the manifest. The link count of a blob is its reference count: once no series
+    directory links to it any more, it is deleted.
+
+    Several worker processes share the store, so nothing here relies on a lock: blobs
+    are published with os.link (which fails if another process got there first),
+    and a blob that disappears before it is linked is stored again.
+    """
+
+    def __init__(self, root, stats_max_age=300):
+        self.root = root
+        self.stats_max_age = stats_max_age
+        self._stats = None
+        self._stats_time = None
+        self._stats_lock = threading.Lock()
+
+    def blob_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}.dcm")
+
+    def volume_paths(self, volume_key):
+        base = os.path.join(self.root, 'volumes', volume_key[:2], volume_key)
+        return base + '.raw', base + '.json'
+
+    def add_uploaded_file(self, uploaded_file, destination_path):
+        """
+        Places one uploaded file at `destination_path`, linked to its blob. Only
+        bytes that are not in the store yet are written; a re-upload costs hashing.
+        Files that are not DICOM are written as they are, without a blob.
+        Returns the manifest entry for the file.
+
+        Files that came through DicomStreamingUploadHandler already carry their hash
+        and header, so they are not read again; the header's path is set to
+        `destination_path`.
+        """
+        header = getattr(uploaded_file, 'dicom_header', None)
+        content_sha256 = getattr(uploaded_file, 'content_sha256', None)
+        if content_sha256 is None:
+            content_hash = hashlib.sha256()
+            for chunk in uploaded_file.chunks():
+                content_hash.update(chunk)
+            content_sha256 = content_hash.hexdigest()
+
+        if header is not None:
+            header.path = destination_path
+            sop_instance_uid = str(header.get('SOPInstanceUID', ''))
+        else:
+            try:
+                uploaded_file.seek(0)
+                dataset = pydicom.dcmread(uploaded_file, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+                sop_instance_uid = str(dataset.get('SOPInstanceUID', ''))
+            except Exception:
+                sop_instance_uid = ''
+
+        entry = {
+            'filename': os.path.basename(destination_path),
+            'sop_instance_uid': sop_instance_uid,
+            'size': uploaded_file.size,
+            'key': None,
+            'deduplicated': False,
+        }
+        if not sop_instance_uid:
+            self._write_upload(uploaded_file, destination_path)
+            return entry
+
+        key = hashlib.sha256(f"{sop_instance_uid}\0{content_sha256}".encode()).hexdigest()
+        entry['key'] = key
+        entry['deduplicated'] = self._store_blob(uploaded_file, self.blob_path(key), destination_path)
+        return entry
+
+    def _store_blob(self, uploaded_file, blob_path, destination_path):
+        """
+        Links `destination_path` to the blob, writing the blob from the upload first
+        when it is not in the store. Returns whether the blob was already there.
+        """
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            _link_or_copy(blob_path, destination_path)
+            return True
+        except FileNotFoundError:
+            pass
+
+        # Written under a unique name next to the blob, so it is never seen half-written.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(blob_path))
+        os.close(fd)
+        try:
+            self._write_upload(uploaded_file, temp_path)
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(temp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            deduplicated = False
+            for _ in range(3):
+                try:
+                    os.link(temp_path, blob_path)
+                except FileExistsError:
+                    # Another upload stored the same instance first; share that one.
+                    deduplicated = True
+                except OSError:
+                    # No hard links on this filesystem: the blob and the series get copies.
+                    _link_or_copy(temp_path, blob_path)
+                try:
+                    _link_or_copy(blob_path, destination_path)
+                    return deduplicated
+                except FileNotFoundError:
+                    # Released by another process in between; store it again.
+                    deduplicated = False
+            _link_or_copy(temp_path, destination_path)
+            return False
+        finally:
+            os.remove(temp_path)
+
+    @staticmethod
+    def _write_upload(uploaded_file, path):
+        if hasattr(uploaded_file, 'temporary_file_path'):
+            # Already on disk: move it into place instead of copying the bytes again.
+            file_move_safe(uploaded_file.temporary_file_path(), path, allow_overwrite=True)
+            return
+        uploaded_file.seek(0)
+        with open(path, 'wb+') as dest:
+            for chunk in uploaded_file.chunks():
+                dest.write(chunk)
+
+    @staticmethod
+    def volume_key(entries):
+        """Identifies the volume store of a series by its files and their blobs."""
+        pairs = sorted((entry['filename'], entry['key'] or '') for entry in entries)
+        return hashlib.sha256(json.dumps(pairs).encode()).hexdigest()
+
+    def write_manifest(self, series_directory, entries, volume_key=None):
+        manifest = {'instances': entries, 'volume_key': volume_key}
+        manifest_path = os.path.join(series_directory, MANIFEST_FILENAME)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def build_or_link_volume_store(self, series_directory, entries, headers=None):
+        """
+        Gives the series its volume store: linked from the store when an identical
+        set of instances was uploaded before, otherwise decoded (using the SliceHeaders
+        collected during the upload, when given) and then shared.
+        Returns (volume_key, reused).
+        """
+        if not all(entry['key'] for entry in entries):
+            build_volume_store(series_directory, headers=headers)
+            return None, False
+
+        volume_key = self.volume_key(entries)
+        raw_blob, header_blob = self.volume_paths(volume_key)
+        try:
+            _link_or_copy(raw_blob, os.path.join(series_directory, VOLUME_FILENAME))
+            _link_or_copy(header_blob, os.path.join(series_directory, VOLUME_HEADER_FILENAME))
+            return volume_key, True
+        except FileNotFoundError:
+            # Not built yet, or released by another process meanwhile.
+            pass
+
+        build_volume_store(series_directory, headers=headers)
+        os.makedirs(os.path.dirname(raw_blob), exist_ok=True)
+        for blob, filename in ((raw_blob, VOLUME_FILENAME), (header_blob, VOLUME_HEADER_FILENAME)):
+            try:
+                os.link(os.path.join(series_directory, filename), blob)
+            except FileExistsError:
+                # Shared by another upload of the same instances; this series keeps its own copy.
+                pass
+            except OSError as e:
+                print(f"Warning: Could not share the volume store of {series_directory}: {e}")
+        return volume_key, False
+
+    def release_series(self, series_directory):
+        """
+        Removes a series directory and then every blob it referenced that no other
+        series links to. Call instead of deleting the directory directly.
+        """
+        try:
+            with open(os.path.join(series_directory, MANIFEST_FILENAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {'instances': [], 'volume_key': None}
+
+        blobs = [self.blob_path(entry['key']) for entry in manifest.get('instances', []) if entry.get('key')]
+        if manifest.get('volume_key'):
+            blobs.extend(self.volume_paths(manifest['volume_key']))
+
+        if os.path.isdir(series_directory):
+            shutil.rmtree(series_directory)
+        return sum(_remove_if_unreferenced(blob) for blob in blobs)
+
+    def stats(self):
+        """
+        Blob count and bytes of the store. Counting walks every blob, so the figures
+        are reused for `stats_max_age` seconds; other processes change the store too,
+        so they are recounted rather than kept up to date here.
+        """
+        with self._stats_lock:
+            if self._stats is None or time.monotonic() - self._stats_time > self.stats_max_age:
+                self._stats = self._count_blobs()
+                self._stats_time = time.monotonic()
+            return dict(self._stats)
+
+    def _count_blobs(self):
+        blobs = 0
+        total_bytes = 0
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.dcm') or filename.endswith('.raw'):
+                    blobs += 1
+                    total_bytes += os.path.getsize(os.path.join(directory, filename))
+        return {'blobs': blobs, 'bytes': total_bytes}
+
+
+_instance_store = None
+_instance_store_lock = threading.Lock()
+
+
+def get_instance_store():
+    """Returns the process-wide InstanceStore under MEDIA_ROOT/instances."""
+    global _instance_store
+    if _instance_store is None:
+        with _instance_store_lock:
+            if _instance_store is None:
+                _instance_store = InstanceStore(
+                    os.path.join(settings.MEDIA_ROOT, INSTANCE_STORE_DIRNAME),
+                    stats_max_age=getattr(settings, 'INSTANCE_STORE_STATS_MAX_AGE', 300),
+                )
+    return _instance_store
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from .metrics import JOB_STAGE_SECONDS, get_metrics
+from .model_registry import get_model_registry
+from .models import ProcessingJob, ProcessingResult
+from .result_cache import get_result_cache
+from .volume_store import load_series_volume
+from .utils import generate_heatmap, write_series_volume_nrrd_pyramid
+from .volume_cache import get_volume_cache
+
+
+# Jobs run on a small local thread pool inside the web process, so no external
+# broker is needed. The pool is created lazily on the first submitted job.
+_executor = None
+_executor_lock = threading.Lock()
+
+# Ids of jobs queued or running in *this* process. A job row left in 'running'
+# by a worker that was restarted is not in here, so it does not block a new run.
+_inflight_job_ids = set()
+_inflight_lock = threading.Lock()
+# Jobs waiting for an earlier job on the same series: job id -> ids of the jobs to
+# start when it finishes. Two jobs on one series never run at the same time, so a
+# score-only run cannot save its result over the heatmap of a later one.
+_follow_up_job_ids = {}
+
+# The in-flight jobs whose mode also answers a request for each mode: any run gives
+# the score, and a full run gives the heatmap too.
+_COVERING_MODES = {
+    ProcessingJob.MODE_FULL: [ProcessingJob.MODE_FULL],
+    ProcessingJob.MODE_SCORE_ONLY: [ProcessingJob.MODE_FULL, ProcessingJob.MODE_SCORE_ONLY, ProcessingJob.MODE_HEATMAP],
+    ProcessingJob.MODE_HEATMAP: [ProcessingJob.MODE_FULL, ProcessingJob.MODE_HEATMAP],
+}
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'PROCESSING_JOB_WORKERS', 2),
+                    thread_name_prefix='processing-job',
+                )
+    return _executor
+
+
+def enqueue_processing_job(series, mode=ProcessingJob.MODE_FULL):
+    """
+    Creates a queued ProcessingJob for the series and hands it to the worker pool.
+    `mode` is one of the ProcessingJob.MODE_* values. If this process is already
+    working on the series in a mode that covers `mode` (see _COVERING_MODES), that
+    job is returned. Otherwise the new job starts once the series' latest in-flight
+    job has finished.
+    """
+    with _inflight_lock:
+        inflight = ProcessingJob.objects.filter(dicom_series=series, id__in=list(_inflight_job_ids))
+        existing = inflight.filter(mode__in=_COVERING_MODES[mode]).order_by('id').first()
+        if existing:
+            return existing
+        previous_job_id = inflight.order_by('-id').values_list('id', flat=True).first()
+        job = ProcessingJob.objects.create(dicom_series=series, mode=mode)
+        _inflight_job_ids.add(job.id)
+
+    def start_job():
+        with _inflight_lock:
+            if previous_job_id in _inflight_job_ids:
+                _follow_up_job_ids.setdefault(previous_job_id, []).append(job.id)
+                return
+        _get_executor().submit(run_processing_job, job.id)
+
+    # Only start the work once the job row is visible to the worker thread.
+    transaction.on_commit(start_job)
+    return job
+
+
+def fail_orphaned_jobs(jobs):
+    """
+    Marks the queued or running jobs among `jobs` (a ProcessingJob queryset) that lost
+    their worker as failed, so the process page stops polling them. A job is orphaned
+    when this process is not working on it and it has not been updated for
+    PROCESSING_JOB_STALE_SECONDS, e.g. because the server was restarted mid-run.
+    Returns the number of jobs marked failed.
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=getattr(settings, 'PROCESSING_JOB_STALE_SECONDS', 30 * 60))
+    with _inflight_lock:
+        inflight_job_ids = list(_inflight_job_ids)
+    orphaned = jobs.filter(
+        state__in=[ProcessingJob.STATE_QUEUED, ProcessingJob.STATE_RUNNING], updated_date__lt=stale_before,
+    ).exclude(id__in=inflight_job_ids)
+    count = orphaned.update(
+        state=ProcessingJob.STATE_FAILED,
+        error_message="The worker running this job stopped (e.g. the server was restarted). Process the series again.",
+        finished_date=now,
+        updated_date=now,
+    )
+    if count:
+        print(f"  > Marked {count} orphaned processing job(s) as failed.")
+    return count
+
+
+def _update_job(job, **fields):
+    # A queryset update instead of save(), so a job whose series was deleted
+    # while it was running is not re-created or turned into an error. update()
+    # skips auto_now, so the heartbeat that fail_orphaned_jobs checks is set here.
+    fields['updated_date'] = timezone.now()
+    for name, value in fields.items():
+        setattr(job, name, value)
+    ProcessingJob.objects.filter(id=job.id).update(**fields)
+
+
+class _JobRecorder:
+    """Writes stage, progress and per-stage timings of a running job to the database."""
+
+    def __init__(self, job):
+        self.job = job
+        self.timings = {}
+
+    def start_stage(self, stage):
+        _update_job(self.job, stage=stage)
+        return time.perf_counter()
+
+    def record_cache_lookup(self, hit):
+        _update_job(self.job, result_cache_hit=hit)
+
+    def finish_stage(self, stage, started, progress):
+        seconds = time.perf_counter() - started
+        self.timings[stage] = round(seconds, 3)
+        get_metrics().observe(JOB_STAGE_SECONDS, seconds, stage=stage)
+        _update_job(self.job, progress=progress, stage_timings_json=json.dumps(self.timings))
+
+
+def run_processing_pipeline(series, recorder, mode=ProcessingJob.MODE_FULL):
+    """
+    Runs model inference, NRRD conversion and slice counting for a series
+    and stores the outcome as its ProcessingResult.
+
+    In score-only mode the model stage is a plain forward pass and no heatmap is
+    written. Heatmap mode adds the heatmap to an existing result and leaves its
+    NRRD volume alone; a series without a result gets the full pipeline instead.
+    """
+    print(f"--- Starting processing for Series ID: {series.id} (mode: {mode}) ---")
+    existing_result = ProcessingResult.objects.filter(dicom_series=series).first()
+    if mode == ProcessingJob.MODE_HEATMAP and existing_result is None:
+        mode = ProcessingJob.MODE_FULL
+    with_heatmap = mode != ProcessingJob.MODE_SCORE_ONLY
+
+    # The series is read once here (memory-mapped from its volume store) and shared by every stage below.
+    started = recorder.start_stage('read')
+    series_volume = load_series_volume(series.file_path)
+    # The dashboard asks for slices right after processing, so keep the volume around.
+    get_volume_cache().put(series.id, series.file_path, series_volume)
+    recorder.finish_stage('read', started, 20)
+
+    model_stage = 'heatmap' if with_heatmap else 'score'
+    started = recorder.start_stage(model_stage)
+    # The same pixels through the same checkpoint give the same answer, so an earlier
+    # result with a matching fingerprint (this series or another upload of the study) is reused.
+    model_id = get_model_registry().model_id
+    cached_result = get_result_cache().lookup(series_volume.fingerprint, model_id, with_heatmap=with_heatmap)
+    if series_volume.fingerprint and model_id:
+        recorder.record_cache_lookup(cached_result is not None)
+    if cached_result is not None:
+        print(f"  > Reusing the result computed for series {cached_result.dicom_series_id} (same content and model).")
+        heatmap_file_path = cached_result.heatmap_file_path
+        ece_prob, non_ece_prob = cached_result.ece_probability, cached_result.non_ece_probability
+    else:
+        # `generate_heatmap` returns (heatmap_directory_path, ece_probability, non_ece_probability)
+        heatmap_dir_path, ece_prob, non_ece_prob = generate_heatmap(
+            series.file_path, series_volume=series_volume, with_heatmap=with_heatmap
+        )
+        heatmap_file_path = os.path.join(heatmap_dir_path, 'heatmap.nrrd') if heatmap_dir_path else None
+    recorder.finish_stage(model_stage, started, 70)
+
+    if mode == ProcessingJob.MODE_HEATMAP:
+        nrrd_path = existing_result.nrrd_file_path
+    else:
+        started = recorder.start_stage('nrrd')
+        nrrd_dir = os.path.join(settings.MEDIA_ROOT, "nrrd_files")
+        os.makedirs(nrrd_dir, exist_ok=True)
+        nrrd_path = os.path.join(nrrd_dir, f"user{series.user.id}_series{series.id}.nrrd")
+        # Coarse levels first, so the viewer can show the volume before the full one arrives.
+        write_series_volume_nrrd_pyramid(series_volume, nrrd_path)
+        recorder.finish_stage('nrrd', started, 95)
+
+    slice_counts = series_volume.slice_counts
+
+    started = recorder.start_stage('save')
+    result, _ = ProcessingResult.objects.update_or_create(
+        dicom_series=series,
+        defaults={
+            'result_type': (
+                ProcessingResult.RESULT_HEATMAP_AND_PREDICTION if heatmap_file_path
+                else ProcessingResult.RESULT_PREDICTION_ONLY
+            ),
+            'heatmap_file_path': heatmap_file_path,
+            'nrrd_file_path': nrrd_path,
+            'ece_probability': ece_prob if ece_prob is not None else 0.0,
+            'non_ece_probability': non_ece_prob if non_ece_prob is not None else 0.0,
+            'slice_counts_json': json.dumps(slice_counts),
+            # A failed model run is not worth reusing, so it gets no cache key.
+            'content_fingerprint': (series_volume.fingerprint or '') if ece_prob is not None else '',
+            'model_id': (model_id or '') if ece_prob is not None else '',
+        }
+    )
+    recorder.finish_stage('save', started, 100)
+    return result
+
+
+def run_processing_job(job_id):
+    """Worker-pool entry point: runs the pipeline for one job and records the outcome."""
+    close_old_connections()
+    try:
+        try:
+            job = ProcessingJob.objects.select_related('dicom_series__user').get(id=job_id)
+        except ProcessingJob.DoesNotExist:
+            # The series (and with it the job) was deleted before the job started.
+            return
+
+        _update_job(job, state=ProcessingJob.STATE_RUNNING, started_date=timezone.now())
+
+        recorder = _JobRecorder(job)
+        try:
+            run_processing_pipeline(job.dicom_series, recorder, mode=job.mode)
+        except Exception as e:
+            print(f"!!! ERROR: Processing job {job.id} failed in stage '{job.stage}': {e}")
+            _update_job(job, state=ProcessingJob.STATE_FAILED, error_message=str(e), finished_date=timezone.now())
+        else:
+            _update_job(job, state=ProcessingJob.STATE_SUCCEEDED, stage='', finished_date=timezone.now())
+        print(f"--- Processing job {job.id} {job.state}. Stage timings: {recorder.timings} ---")
+    finally:
+        with _inflight_lock:
+            _inflight_job_ids.discard(job_id)
+            follow_up_job_ids = _follow_up_job_ids.pop(job_id, [])
+        for follow_up_job_id in follow_up_job_ids:
+            _get_executor().submit(run_processing_job, follow_up_job_id)
+        # Worker threads open their own database connections; release them.
+        connections.close_all()
+
+
+def job_status(job):
+    """JSON-serializable status of a job, as returned by the job status endpoint."""
+    result_ready = (
+        job.state == ProcessingJob.STATE_SUCCEEDED
+        and ProcessingResult.objects.filter(dicom_series_id=job.dicom_series_id).exists()
+    )
+    return {
+        'job_id': job.id,
+        'series_id': job.dicom_series_id,
+        'state': job.state,
+        'mode': job.mode,
+        'result_cache_hit': job.result_cache_hit,
+        'stage': job.stage,
+        'progress': job.progress,
+        'stage_timings': json.loads(job.stage_timings_json or '{}'),
+        'error': job.error_message,
+        'result_ready': result_ready,
+    }
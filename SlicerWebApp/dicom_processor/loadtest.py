@@ -0,0 +1,402 @@
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from collections import namedtuple
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.urls import reverse
+
+from .models import DicomSeries, ProcessingResult
+from .synthetic import write_synthetic_series
+from .utils import save_heatmap, write_series_volume_nrrd_pyramid
+from .volume_store import load_series_volume
+from .windowing import WINDOW_PRESETS
+
+
+# Fixture series live under MEDIA_ROOT/<LOADTEST_DIRNAME> and belong to this account.
+LOADTEST_USERNAME = 'loadtest'
+LOADTEST_DIRNAME = 'loadtest'
+
+# How often the process page polls job_status_ajax (see process.html).
+JOB_POLL_SECONDS = 2.0
+
+# One request of a trace. `think` is the pause before it, in seconds; `ok` checks the
+# response beyond its status code, e.g. that a job did not fail.
+TraceRequest = namedtuple('TraceRequest', 'endpoint method path params think ok', defaults=(None, 0.0, None))
+TraceResponse = namedtuple('TraceResponse', 'status headers body')
+
+# One measured request: when it started (seconds since the level started), how long it took.
+Sample = namedtuple('Sample', 'endpoint started seconds status error')
+
+
+class ViewerSession:
+    """
+    One clinician's browser: a persistent HTTP/1.1 connection, its cookies and the
+    responses it may reuse without asking (Cache-Control max-age), as a browser would
+    when scrolling back over slices it already has.
+    """
+
+    def __init__(self, base_url, session_key, timeout=60.0, browser_cache=True, keep_alive=True):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.cookies = {settings.SESSION_COOKIE_NAME: session_key}
+        self.browser_cache = browser_cache
+        self.fresh_until = {}
+        self.browser_cache_hits = 0
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _send(self, method, url, body, headers):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.connection.request(method, url, body=body, headers=headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def request(self, method, path, params=None):
+        url = path
+        body = None
+        headers = {'Cookie': '; '.join(f"{name}={value}" for name, value in self.cookies.items())}
+        if method == 'GET':
+            if params:
+                url = f"{path}?{urlencode(params)}"
+            if self.browser_cache and self.fresh_until.get(url, 0) > time.monotonic():
+                self.browser_cache_hits += 1
+                return None
+        else:
+            body = urlencode(params or {})
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['X-CSRFToken'] = self.cookies.get(settings.CSRF_COOKIE_NAME, '')
+
+        try:
+            response, content = self._send(method, url, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server closed an idle keep-alive connection; a browser reconnects too.
+            self.close()
+            response, content = self._send(method, url, body, headers)
+        if not self.keep_alive or response.getheader('Connection', '').lower() == 'close':
+            self.close()
+
+        for set_cookie in response.msg.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(set_cookie).items():
+                self.cookies[name] = morsel.value
+        max_age = re.search(r'max-age=(\d+)', response.getheader('Cache-Control', ''))
+        if method == 'GET' and max_age and response.status == 200:
+            self.fresh_until[url] = time.monotonic() + int(max_age.group(1))
+        return TraceResponse(response.status, response.msg, content)
+
+
+def _slice_requests(series, view_type, slice_index, think, window=None):
+    """get_slice_url_ajax for one slice, then the image it points to, as the viewer loads it."""
+    params = {'series_id': series['id'], 'view_type': view_type, 'slice_index': slice_index}
+    if window:
+        params['window_center'], params['window_width'] = window
+    response = yield TraceRequest('get_slice_url_ajax', 'GET', reverse('ajax_get_slice_url'), params, think)
+    if response is not None and response.status == 200:
+        slice_url = json.loads(response.body).get('slice_url')
+        if slice_url:
+            yield TraceRequest('slice_image', 'GET', slice_url)
+
+
+def _open_dashboard(series, think=0.0):
+    yield TraceRequest('dashboard_view', 'GET', reverse('dashboard_series_view', args=[series['id']]), think=think)
+    # The viewer then looks up the volume levels and the heatmap overlay of the series.
+    yield TraceRequest('get_nrrd_url', 'GET', reverse('ajax_get_nrrd_url', args=[series['id']]))
+    yield TraceRequest('get_heatmap_url', 'GET', reverse('get_heatmap_url_ajax', args=[series['id']]))
+
+
+def scroll_trace(rng, series):
+    """Opens the dashboard, then scrolls through one orientation a wheel tick at a time, sometimes turning back."""
+    yield from _open_dashboard(series)
+    view_type = rng.choices(['axial', 'coronal', 'sagittal'], weights=[7, 1.5, 1.5])[0]
+    count = series['slice_counts'][view_type]
+    slice_index = rng.randrange(count)
+    direction = rng.choice([-1, 1])
+    for _ in range(rng.randint(10, 40)):
+        yield from _slice_requests(series, view_type, slice_index, think=rng.uniform(0.02, 0.06))
+        if rng.random() < 0.05:
+            direction = -direction
+        slice_index = min(max(slice_index + direction, 0), count - 1)
+
+
+def window_trace(rng, series):
+    """Stays on one slice and drags the window/level, with the odd jump to a preset."""
+    view_type = rng.choices(['axial', 'coronal', 'sagittal'], weights=[7, 1.5, 1.5])[0]
+    slice_index = rng.randrange(series['slice_counts'][view_type])
+    window_center, window_width = series['window']
+    for _ in range(rng.randint(10, 30)):
+        if rng.random() < 0.15:
+            window_center, window_width = rng.choice(list(WINDOW_PRESETS.values()))
+        else:
+            window_center += rng.randint(-15, 15)
+            window_width = max(1, window_width + rng.randint(-25, 25))
+        yield from _slice_requests(series, view_type, slice_index, think=rng.uniform(0.03, 0.08),
+                                   window=(window_center, window_width))
+
+
+def _job_ok(response):
+    return json.loads(response.body).get('state') != 'failed'
+
+
+def processing_trace(rng, series, poll_timeout=300.0):
+    """
+    Submits the series for processing from the process page, polls the job like the
+    page does until the result is ready, then opens the dashboard.
+    """
+    process_path = reverse('process_dicom', args=[series['id']])
+    yield TraceRequest('process_dicom', 'GET', process_path)
+    # "Generate Heatmap" is ticked by default on the process page.
+    response = yield TraceRequest('process_dicom_submit', 'POST', process_path, {'process_type': 'heatmap'},
+                                  think=rng.uniform(1.0, 3.0))
+    job_id = re.search(r'[?&]job=(\d+)', response.headers.get('Location', '')) if response is not None else None
+    if not job_id:
+        return
+    yield TraceRequest('process_dicom', 'GET', f"{process_path}?job={job_id.group(1)}")
+
+    status_path = reverse('ajax_job_status', args=[int(job_id.group(1))])
+    deadline = time.monotonic() + poll_timeout
+    while time.monotonic() < deadline:
+        response = yield TraceRequest('job_status_ajax', 'GET', status_path, think=JOB_POLL_SECONDS, ok=_job_ok)
+        if response is None or response.status != 200:
+            break
+        status = json.loads(response.body)
+        if status.get('result_ready') or status.get('state') == 'failed':
+            break
+    yield from _open_dashboard(series)
+
+
+# Traces a virtual clinician picks from: name -> function(rng, series) generating TraceRequests.
+TRACES = {
+    'scroll': scroll_trace,
+    'window': window_trace,
+    'processing': processing_trace,
+}
+
+
+def run_session(session, fixtures, mix, rng, deadline, think_scale, samples, level_started):
+    """
+    Replays traces, chosen by their `mix` weights, until `deadline`, appending a Sample
+    per request to `samples`. Between traces the clinician pauses for a few seconds.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.monotonic() < deadline:
+        series = rng.choice(fixtures)
+        trace = TRACES[rng.choices(names, weights=weights)[0]](rng, series)
+        response = None
+        try:
+            while True:
+                trace_request = trace.send(response)
+                pause = trace_request.think * think_scale
+                if time.monotonic() + pause >= deadline:
+                    return
+                time.sleep(pause)
+                started = time.monotonic()
+                error = None
+                try:
+                    response = session.request(trace_request.method, trace_request.path, trace_request.params)
+                except (OSError, http.client.HTTPException) as e:
+                    session.close()
+                    response, error = None, type(e).__name__
+                else:
+                    if response is None:
+                        continue  # answered from the browser cache
+                    if response.status >= 400:
+                        error = f"HTTP {response.status}"
+                    elif trace_request.ok is not None and not trace_request.ok(response):
+                        error = 'failed'
+                samples.append(Sample(
+                    trace_request.endpoint, started - level_started, time.monotonic() - started,
+                    response.status if response is not None else None, error,
+                ))
+        except StopIteration:
+            pass
+        time.sleep(rng.uniform(1.0, 3.0) * think_scale)
+
+
+def run_load_level(base_url, session_keys, fixtures, mix, duration, ramp_up=0.0, think_scale=1.0,
+                   seed=0, browser_cache=True, keep_alive=True, timeout=60.0):
+    """
+    Runs len(session_keys) concurrent sessions for `duration` seconds, starting them
+    evenly over `ramp_up` seconds. Session i always replays the traces of seed + i, so
+    two runs (say, before and after a change) send the same requests.
+    Returns (samples, wall seconds, browser cache hits).
+    """
+    samples = []
+    sessions = [
+        ViewerSession(base_url, key, timeout=timeout, browser_cache=browser_cache, keep_alive=keep_alive)
+        for key in session_keys
+    ]
+    level_started = time.monotonic()
+    deadline = level_started + ramp_up + duration
+
+    def start_session(index, session):
+        time.sleep(ramp_up * index / len(sessions))
+        run_session(session, fixtures, mix, random.Random(seed + index), deadline, think_scale, samples, level_started)
+
+    threads = [
+        threading.Thread(target=start_session, args=(index, session), name=f'loadtest-session-{index}', daemon=True)
+        for index, session in enumerate(sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - level_started
+    for session in sessions:
+        session.close()
+    return samples, wall_seconds, sum(session.browser_cache_hits for session in sessions)
+
+
+def summarize_samples(samples, seconds):
+    """Per endpoint (and 'total'): requests, errors, error rate, throughput and latency percentiles in ms."""
+    by_endpoint = {}
+    for sample in samples:
+        by_endpoint.setdefault(sample.endpoint, []).append(sample)
+    by_endpoint['total'] = list(samples)
+
+    summary = {}
+    for endpoint, endpoint_samples in by_endpoint.items():
+        if not endpoint_samples:
+            continue
+        latencies = np.array([sample.seconds for sample in endpoint_samples]) * 1000
+        errors = [sample.error for sample in endpoint_samples if sample.error]
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[endpoint] = {
+            'requests': len(endpoint_samples),
+            'errors': len(errors),
+            'error_rate': len(errors) / len(endpoint_samples),
+            'error_kinds': {kind: errors.count(kind) for kind in sorted(set(errors))},
+            'throughput_rps': len(endpoint_samples) / seconds if seconds else None,
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'mean_ms': float(latencies.mean()),
+            'max_ms': float(latencies.max()),
+        }
+    return summary
+
+
+def saturation_point(levels, min_gain=1.1, max_error_rate=0.01):
+    """
+    The smallest session count after which adding sessions no longer raised the total
+    throughput by `min_gain`, or at which errors passed `max_error_rate`; None when
+    every level still scaled. Only meaningful with several session counts.
+    """
+    previous = None
+    for level in levels:
+        total = level['endpoints'].get('total')
+        if total is None:
+            continue
+        if total['error_rate'] > max_error_rate:
+            return level['sessions']
+        if previous is not None and total['throughput_rps'] < previous['endpoints']['total']['throughput_rps'] * min_gain:
+            return previous['sessions']
+        previous = level
+    return None
+
+
+def create_session_keys(user, count):
+    """Logs `user` in `count` times, as separate browsers, and returns their session keys."""
+    keys = []
+    for _ in range(count):
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        keys.append(session.session_key)
+    return keys
+
+
+def _fixture_heatmap(shape):
+    # A smooth blob off the centre, in the range of a Grad-CAM map; save_heatmap resizes it.
+    z, y, x = np.mgrid[0:8, 0:32, 0:32]
+    cam = np.exp(-(((z - 4) / 3.0) ** 2 + ((y - 12) / 6.0) ** 2 + ((x - 20) / 6.0) ** 2))
+    return save_heatmap(cam.astype(np.float32), shape)
+
+
+def prepare_fixture_series(count, num_slices, size, username=LOADTEST_USERNAME):
+    """
+    The load-test account and `count` processed synthetic series it owns, created on
+    first use: DICOM files with their volume store, the NRRD levels, a heatmap and the
+    ProcessingResult the dashboard needs. No model runs; the processing trace does that.
+    Returns (user, fixtures) with the fields the traces need for each series.
+    """
+    user, created = get_user_model().objects.get_or_create(username=username)
+    if created:
+        user.set_unusable_password()
+        user.save()
+
+    fixtures = []
+    for index in range(count):
+        directory = os.path.join(settings.MEDIA_ROOT, LOADTEST_DIRNAME, f"series{index}_{num_slices}x{size}x{size}")
+        series, _ = DicomSeries.objects.get_or_create(
+            file_path=directory,
+            defaults={'user': user, 'name': f"Load test {index} ({num_slices}x{size}x{size})",
+                      'patient_id': 'SYNTHETIC', 'modality': 'CT'},
+        )
+        result = getattr(series, 'processing_result', None)
+        if result is None:
+            print(f"  > Preparing load-test series {index} ({num_slices} x {size}x{size})...")
+            if not os.path.isdir(directory):
+                write_synthetic_series(directory, num_slices=num_slices, rows=size, cols=size, seed=index)
+            series_volume = load_series_volume(directory)
+            nrrd_dir = os.path.join(settings.MEDIA_ROOT, 'nrrd_files')
+            os.makedirs(nrrd_dir, exist_ok=True)
+            nrrd_path = os.path.join(nrrd_dir, f"user{user.id}_series{series.id}.nrrd")
+            write_series_volume_nrrd_pyramid(series_volume, nrrd_path)
+            heatmap_directory = _fixture_heatmap(series_volume.pixels.shape)
+            result = ProcessingResult.objects.create(
+                dicom_series=series,
+                heatmap_file_path=os.path.join(heatmap_directory, 'heatmap.nrrd'),
+                nrrd_file_path=nrrd_path,
+                ece_probability=0.5,
+                non_ece_probability=0.5,
+                slice_counts_json=json.dumps(series_volume.slice_counts),
+            )
+        fixtures.append({
+            'id': series.id,
+            'window': (series.window_center, series.window_width),
+            'slice_counts': json.loads(result.slice_counts_json),
+        })
+    return user, fixtures
+
+
+def remove_fixtures(username=LOADTEST_USERNAME):
+    """Deletes the load-test account with its series, results and files. Returns the number of series removed."""
+    user = get_user_model().objects.filter(username=username).first()
+    if user is None:
+        return 0
+    series_list = list(DicomSeries.objects.filter(user=user).select_related('processing_result'))
+    for series in series_list:
+        result = getattr(series, 'processing_result', None)
+        if result is not None:
+            if result.heatmap_file_path:
+                shutil.rmtree(os.path.dirname(result.heatmap_file_path), ignore_errors=True)
+            if result.nrrd_file_path:
+                # The full volume, its coarser levels (<root>_x2.nrrd, ...), the levels index and .gz siblings.
+                nrrd_dir = os.path.dirname(result.nrrd_file_path)
+                root = os.path.splitext(os.path.basename(result.nrrd_file_path))[0]
+                for filename in os.listdir(nrrd_dir):
+                    if filename.startswith((root + '.', root + '_x')):
+                        os.remove(os.path.join(nrrd_dir, filename))
+        shutil.rmtree(series.file_path, ignore_errors=True)
+    user.delete()
+    return len(series_list)
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_processor.benchmarking import TRANSFER_SYNTAXES
+from dicom_processor.ingest import read_dicom_series
+from dicom_processor.synthetic import write_synthetic_series
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how reading a series scales with the number of DICOM decode workers "
+        "(1, 2, 4 and 8 by default) for the thread and process backends, and checks that "
+        "every parallel read matches the serial one exactly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help="Existing DICOM series directory. Defaults to a synthetic series.")
+        parser.add_argument('--slices', type=int, default=128, help="Slices in the synthetic series.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic series.")
+        parser.add_argument('--transfer-syntax', choices=sorted(TRANSFER_SYNTAXES), default='rle',
+                            help="Transfer syntax of the synthetic series.")
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--backends', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+        parser.add_argument('--repeats', type=int, default=3, help="Runs per setting; the fastest one is reported.")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as scratch:
+            directory = options['directory']
+            if not directory:
+                directory = os.path.join(scratch, 'series')
+                self.stderr.write(
+                    f"Writing synthetic {options['transfer_syntax']} series "
+                    f"({options['slices']} x {options['size']}x{options['size']})..."
+                )
+                write_synthetic_series(directory, num_slices=options['slices'], rows=options['size'],
+                                       cols=options['size'],
+                                       transfer_syntax=TRANSFER_SYNTAXES[options['transfer_syntax']])
+
+            reference = read_dicom_series(directory, workers=1)
+            report = {'directory': directory, 'shape': list(reference.shape), 'results': []}
+            for backend in options['backends']:
+                serial_seconds = None
+                for workers in options['workers']:
+                    seconds, identical = self._time_read(directory, workers, backend, reference, options['repeats'])
+                    if not identical:
+                        raise CommandError(f"{backend} backend with {workers} workers did not match the serial read.")
+                    if serial_seconds is None:
+                        serial_seconds = seconds
+                    report['results'].append({
+                        'backend': backend,
+                        'workers': workers,
+                        'seconds': seconds,
+                        'speedup': serial_seconds / seconds,
+                        'identical': identical,
+                    })
+                    self.stderr.write(f"{backend:>7} x{workers}: {seconds:.3f}s")
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _time_read(self, directory, workers, backend, reference, repeats):
+        best = None
+        identical = True
+        for _ in range(max(1, repeats)):
+            started = time.perf_counter()
+            series_volume = read_dicom_series(directory, workers=workers, backend=backend)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+            identical = identical and (
+                series_volume.pixels.dtype == reference.pixels.dtype
+                and np.array_equal(series_volume.pixels, reference.pixels)
+                and np.array_equal(series_volume.rescale_slopes, reference.rescale_slopes)
+                and np.array_equal(series_volume.rescale_intercepts, reference.rescale_intercepts)
+                and series_volume.spacing == reference.spacing
+            )
+        return best, identical
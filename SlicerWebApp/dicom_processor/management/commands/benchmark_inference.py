@@ -0,0 +1,71 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_processor.inference_dispatcher import InferenceDispatcher
+from dicom_processor.model_registry import MODEL_INPUT_SHAPE, ModelRegistry, get_default_model_path
+from dicom_processor.utils import compute_gradcam_batch, compute_predictions_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares requests per second of the per-request Grad-CAM path against the "
+        "micro-batching InferenceDispatcher under concurrent load."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None, help="Path to a .keras model (defaults to the app checkpoint).")
+        parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent simulated requests.")
+        parser.add_argument('--requests', type=int, default=64, help="Total number of requests per mode.")
+        parser.add_argument('--max-batch-size', type=int, default=8)
+        parser.add_argument('--max-wait-ms', type=float, default=20.0)
+        parser.add_argument('--score-only', action='store_true',
+                            help="Benchmark the forward-only triage path instead of Grad-CAM.")
+
+    def handle(self, *args, **options):
+        registry = ModelRegistry(options['model'] or get_default_model_path())
+        if not registry.warm_up() or registry.gradcam_fn is None:
+            raise CommandError(f"Could not load a Grad-CAM capable model from {registry.model_path}.")
+
+        rng = np.random.default_rng(0)
+        volumes = [rng.random(MODEL_INPUT_SHAPE, dtype=np.float32) * 255 for _ in range(options['requests'])]
+
+        with_heatmap = not options['score_only']
+
+        def per_request(volume):
+            input_batch = np.expand_dims(volume, axis=(0, -1))
+            if with_heatmap:
+                compute_gradcam_batch(registry.gradcam_fn, input_batch)
+            else:
+                compute_predictions_batch(registry.predict_fn, input_batch)
+
+        dispatcher = InferenceDispatcher(
+            lambda: registry.gradcam_fn,
+            max_batch_size=options['max_batch_size'],
+            max_wait_seconds=options['max_wait_ms'] / 1000.0,
+            predict_fn_getter=lambda: registry.predict_fn,
+        )
+
+        def batched(volume):
+            dispatcher.submit(volume, with_heatmap=with_heatmap).result()
+
+        report = {
+            'mode': 'score_only' if options['score_only'] else 'grad_cam',
+            'concurrency': options['concurrency'],
+            'requests': options['requests'],
+            'per_request': self._run(per_request, volumes, options['concurrency']),
+            'batched': self._run(batched, volumes, options['concurrency']),
+            'dispatcher': dispatcher.stats(),
+        }
+        report['speedup'] = report['batched']['requests_per_second'] / report['per_request']['requests_per_second']
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _run(self, fn, volumes, concurrency):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(fn, volumes))
+        elapsed = time.perf_counter() - started
+        return {'seconds': elapsed, 'requests_per_second': len(volumes) / elapsed}
@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_processor.benchmarking import peak_rss_bytes
+from dicom_processor.ingest import read_dicom_series
+from dicom_processor.synthetic import write_synthetic_series
+from dicom_processor.utils import (
+    convert_dicom_series_to_nrrd,
+    create_model_volume,
+    create_volume_from_dicom,
+    load_scan_as_3d_volume,
+    write_series_volume_nrrd,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the old three-pass ingestion of process_dicom (model volume, NRRD and "
+        "slice counts each decoding the series) against the single-pass SeriesVolume, "
+        "reporting wall time and peak RSS. Each mode runs in a fresh subprocess."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help="Existing DICOM series directory. Defaults to a synthetic series.")
+        parser.add_argument('--slices', type=int, default=320, help="Slices in the synthetic series.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic series.")
+        parser.add_argument('--mode', choices=['three_pass', 'single_pass'],
+                            help="Run only one mode in this process (used internally by the benchmark).")
+
+    def handle(self, *args, **options):
+        if options['mode']:
+            self.stdout.write(json.dumps(self._run_mode(options['mode'], options['directory'])))
+            return
+
+        with tempfile.TemporaryDirectory() as scratch:
+            directory = options['directory']
+            if not directory:
+                directory = os.path.join(scratch, 'series')
+                self.stderr.write(f"Writing synthetic series ({options['slices']} x {options['size']}x{options['size']})...")
+                write_synthetic_series(directory, num_slices=options['slices'], rows=options['size'], cols=options['size'])
+
+            report = {'directory': directory}
+            for mode in ('three_pass', 'single_pass'):
+                report[mode] = self._run_in_subprocess(mode, directory)
+            report['wall_time_reduction'] = 1 - report['single_pass']['seconds'] / report['three_pass']['seconds']
+            report['peak_rss_reduction_bytes'] = report['three_pass']['peak_rss_bytes'] - report['single_pass']['peak_rss_bytes']
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _run_in_subprocess(self, mode, directory):
+        manage_py = os.path.join(os.getcwd(), 'manage.py')
+        if not os.path.exists(manage_py):
+            raise CommandError("Run this command from the directory that contains manage.py.")
+        completed = subprocess.run(
+            [sys.executable, manage_py, 'benchmark_ingest', '--mode', mode, '--directory', directory],
+            capture_output=True, text=True, check=True,
+        )
+        # The last line of stdout is the JSON result; everything before it is progress output.
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def _run_mode(self, mode, directory):
+        baseline_rss = peak_rss_bytes()
+        nrrd_path = os.path.join(tempfile.mkdtemp(), 'volume.nrrd')
+        started = time.perf_counter()
+        if mode == 'three_pass':
+            create_volume_from_dicom(directory)
+            convert_dicom_series_to_nrrd(directory, nrrd_path)
+            volume, _ = load_scan_as_3d_volume(directory)
+            slice_counts = {'axial': volume.shape[0], 'coronal': volume.shape[1], 'sagittal': volume.shape[2]}
+        else:
+            series_volume = read_dicom_series(directory)
+            create_model_volume(series_volume)
+            write_series_volume_nrrd(series_volume, nrrd_path)
+            slice_counts = series_volume.slice_counts
+        elapsed = time.perf_counter() - started
+        os.remove(nrrd_path)
+        return {
+            'seconds': elapsed,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'peak_rss_above_startup_bytes': peak_rss_bytes() - baseline_rss,
+            'slice_counts': slice_counts,
+        }
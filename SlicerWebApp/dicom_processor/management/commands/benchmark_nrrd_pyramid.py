@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import time
+
+import SimpleITK as sitk
+from django.core.management.base import BaseCommand
+
+from dicom_processor.ingest import read_dicom_series
+from dicom_processor.synthetic import write_synthetic_series
+from dicom_processor.utils import write_series_volume_nrrd, write_series_volume_nrrd_pyramid
+
+
+def _timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    value = function(*args, **kwargs)
+    return value, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the single uncompressed NRRD the 3D viewer used to download with the "
+        "gzip-encoded resolution levels: bytes per file, write and parse time, and the "
+        "estimated time to first render at a few connection speeds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help="Existing DICOM series directory. Defaults to a synthetic series.")
+        parser.add_argument('--slices', type=int, default=256, help="Slices in the synthetic series.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic series.")
+        parser.add_argument('--shrink-factors', type=int, nargs='+', default=None,
+                            help="Levels to write. Defaults to NRRD_PYRAMID_SHRINK_FACTORS.")
+        parser.add_argument('--mbps', type=float, nargs='+', default=[10, 50, 100],
+                            help="Connection speeds, in megabits per second, to estimate the download at.")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as scratch:
+            directory = options['directory']
+            if not directory:
+                directory = os.path.join(scratch, 'series')
+                self.stderr.write(f"Writing synthetic series ({options['slices']} x {options['size']}x{options['size']})...")
+                write_synthetic_series(directory, num_slices=options['slices'], rows=options['size'], cols=options['size'])
+            series_volume = read_dicom_series(directory)
+
+            single_path = os.path.join(scratch, 'single', 'volume.nrrd')
+            os.makedirs(os.path.dirname(single_path))
+            _, single_write_seconds = _timed(write_series_volume_nrrd, series_volume, single_path)
+            _, single_parse_seconds = _timed(sitk.ReadImage, single_path)
+            before = {
+                'bytes': os.path.getsize(single_path),
+                'write_seconds': single_write_seconds,
+                'parse_seconds': single_parse_seconds,
+            }
+
+            pyramid_path = os.path.join(scratch, 'pyramid', 'volume.nrrd')
+            os.makedirs(os.path.dirname(pyramid_path))
+            levels, pyramid_write_seconds = _timed(
+                write_series_volume_nrrd_pyramid, series_volume, pyramid_path, options['shrink_factors']
+            )
+            for level in levels:
+                # Parsing includes inflating the gzip data, as the browser has to.
+                _, level['parse_seconds'] = _timed(sitk.ReadImage, level['path'])
+                del level['path']
+            after = {
+                'levels': levels,
+                'total_bytes': sum(level['bytes'] for level in levels),
+                'write_seconds': pyramid_write_seconds,
+            }
+
+        first_level = levels[0]
+        time_to_first_render = []
+        for mbps in options['mbps']:
+            bytes_per_second = mbps * 1e6 / 8
+            entry = {
+                'mbps': mbps,
+                'before_seconds': before['bytes'] / bytes_per_second + before['parse_seconds'],
+                'after_seconds': first_level['bytes'] / bytes_per_second + first_level['parse_seconds'],
+                'after_full_resolution_seconds': sum(
+                    level['bytes'] / bytes_per_second + level['parse_seconds'] for level in levels
+                ),
+            }
+            time_to_first_render.append(entry)
+            self.stderr.write(
+                f"{mbps:>6.0f} Mbit/s: first render {entry['before_seconds']:.2f}s -> {entry['after_seconds']:.2f}s, "
+                f"full resolution after {entry['after_full_resolution_seconds']:.2f}s"
+            )
+
+        report = {
+            'shape': list(series_volume.shape),
+            'before': before,
+            'after': after,
+            'bytes_reduction_first_render': 1 - first_level['bytes'] / before['bytes'],
+            'bytes_reduction_full_resolution': 1 - levels[-1]['bytes'] / before['bytes'],
+            'time_to_first_render': time_to_first_render,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,57 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from dicom_processor.synthetic import make_synthetic_volume
+from dicom_processor.utils import apply_windowing, prepare_model_input
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the downsampling of a windowed 512x512xN CT volume to the (90, 90, 25) model "
+        "input with the original skimage resize and the separable float32 resampler, and "
+        "reports the largest difference between them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slices', type=int, nargs='+', default=[64, 128, 256, 512])
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic volume.")
+        parser.add_argument('--workers', type=int, default=None, help="Threads for the separable resampler.")
+        parser.add_argument('--repeats', type=int, default=3, help="Runs per setting; the fastest one is reported.")
+
+    def handle(self, *args, **options):
+        results = []
+        for num_slices in options['slices']:
+            # The model sees the windowed uint8 volume, so benchmark on the same kind of data.
+            stored = make_synthetic_volume(num_slices, options['size'], options['size'])
+            volume = apply_windowing(stored.astype(np.float32) - 1024, 40, 400)
+            del stored
+
+            timings = {}
+            outputs = {}
+            for resampler in ('skimage', 'separable'):
+                with override_settings(MODEL_INPUT_RESAMPLER=resampler, MODEL_RESAMPLE_WORKERS=options['workers']):
+                    best = None
+                    for _ in range(max(1, options['repeats'])):
+                        started = time.perf_counter()
+                        outputs[resampler], _ = prepare_model_input(volume)
+                        elapsed = time.perf_counter() - started
+                        best = elapsed if best is None else min(best, elapsed)
+                timings[resampler] = best
+
+            result = {
+                'shape': list(volume.shape),
+                'skimage_seconds': timings['skimage'],
+                'separable_seconds': timings['separable'],
+                'speedup': timings['skimage'] / timings['separable'],
+                'max_abs_difference': float(np.max(np.abs(outputs['skimage'] - outputs['separable']))),
+            }
+            results.append(result)
+            self.stderr.write(
+                f"{num_slices:>4} slices: skimage {result['skimage_seconds']:.3f}s, "
+                f"separable {result['separable_seconds']:.3f}s ({result['speedup']:.1f}x)"
+            )
+        self.stdout.write(json.dumps({'results': results}, indent=2))
@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from dicom_processor.slice_atlas import ORIENTATION_AXES, normalize_orientation, render_slice_atlases
+from dicom_processor.synthetic import make_synthetic_volume
+
+
+def _per_slice_pngs(volume, output_folder):
+    # The loop generate_all_directional_slices used to run: one normalization and one
+    # plt.imsave per slice.
+    for view, axis in ORIENTATION_AXES.items():
+        for i in range(volume.shape[axis]):
+            img = np.take(volume, i, axis=axis).astype(np.float32)
+            img -= np.min(img)
+            img /= np.max(img) if np.max(img) > 0 else 1
+            img *= 255
+            img = img.astype(np.uint8)
+            plt.imsave(os.path.join(output_folder, f"{view}_{i}.png"), img, cmap='gray')
+
+
+def _directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+class Command(BaseCommand):
+    help = (
+        "Times writing every axial, coronal and sagittal slice of a synthetic volume as "
+        "individual PNGs (the old generate_all_directional_slices) against the batch "
+        "sprite atlas renderer, and checks that both hold the same pixels."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slices', type=int, default=64, help="Slices in the synthetic volume.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic volume.")
+        parser.add_argument('--workers', type=int, default=None, help="Threads for the atlas renderer.")
+        parser.add_argument('--skip-per-slice', action='store_true',
+                            help="Only time the atlas renderer (the per-slice loop takes minutes on large volumes).")
+
+    def handle(self, *args, **options):
+        volume = make_synthetic_volume(options['slices'], options['size'], options['size'])
+        report = {'shape': list(volume.shape)}
+
+        with tempfile.TemporaryDirectory() as scratch:
+            if not options['skip_per_slice']:
+                per_slice_dir = os.path.join(scratch, 'per_slice')
+                os.makedirs(per_slice_dir)
+                started = time.perf_counter()
+                _per_slice_pngs(volume, per_slice_dir)
+                report['per_slice'] = {
+                    'seconds': time.perf_counter() - started,
+                    'files': len(os.listdir(per_slice_dir)),
+                    'bytes': _directory_bytes(per_slice_dir),
+                }
+                self.stderr.write(f"per-slice PNGs: {report['per_slice']['seconds']:.2f}s, {report['per_slice']['files']} files")
+
+            atlas_dir = os.path.join(scratch, 'atlas')
+            started = time.perf_counter()
+            index = render_slice_atlases(volume, atlas_dir, 'volume', workers=options['workers'])
+            report['atlas'] = {
+                'seconds': time.perf_counter() - started,
+                'files': len(os.listdir(atlas_dir)),
+                'bytes': _directory_bytes(atlas_dir),
+            }
+            self.stderr.write(f"sprite atlases: {report['atlas']['seconds']:.2f}s, {report['atlas']['files']} files")
+            if 'per_slice' in report:
+                report['speedup'] = report['per_slice']['seconds'] / report['atlas']['seconds']
+
+            # Spot-check: the middle slice of every orientation, cut out of its atlas.
+            mismatches = 0
+            for orientation, axis in ORIENTATION_AXES.items():
+                entry = index['orientations'][orientation]
+                middle = entry['count'] // 2
+                sheet, x, y = entry['slices'][middle]
+                atlas = np.asarray(Image.open(os.path.join(atlas_dir, entry['atlases'][sheet])))
+                tile = atlas[y:y + entry['tile_height'], x:x + entry['tile_width']]
+                expected = normalize_orientation(np.take(volume, [middle], axis=axis), axis)[0]
+                mismatches += int(not np.array_equal(tile, expected))
+            report['atlas_tiles_match'] = mismatches == 0
+
+        self.stdout.write(json.dumps(report, indent=2))
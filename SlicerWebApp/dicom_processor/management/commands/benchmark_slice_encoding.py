@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from dicom_processor.synthetic import make_synthetic_volume
+from dicom_processor.utils import encode_slice_image, render_slice
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the old matplotlib imsave-to-file slice path against in-memory "
+        "PNG/WebP/JPEG encoding, reporting encode latency and bytes on the wire."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slices', type=int, default=32, help="Number of axial slices to encode.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of each slice.")
+        parser.add_argument('--quality', type=int, default=85, help="Quality for webp and jpeg.")
+
+    def handle(self, *args, **options):
+        volume = make_synthetic_volume(num_slices=options['slices'], rows=options['size'], cols=options['size'])
+        windowed = [render_slice(volume, 'axial', index, 1064, 400) for index in range(volume.shape[0])]
+
+        report = {'slices': len(windowed), 'size': options['size']}
+        with tempfile.TemporaryDirectory() as scratch:
+            def imsave(windowed_slice):
+                path = os.path.join(scratch, 'slice.png')
+                plt.imsave(path, windowed_slice, cmap='gray', vmin=0, vmax=255)
+                return os.path.getsize(path)
+
+            report['matplotlib_imsave'] = self._measure(imsave, windowed)
+
+        for image_format in ('png', 'webp', 'jpeg'):
+            report[image_format] = self._measure(
+                lambda windowed_slice: len(encode_slice_image(windowed_slice, image_format, options['quality'])),
+                windowed,
+            )
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _measure(self, encode, windowed):
+        timings, sizes = [], []
+        for windowed_slice in windowed:
+            started = time.perf_counter()
+            sizes.append(encode(windowed_slice))
+            timings.append(time.perf_counter() - started)
+        return {
+            'mean_ms': float(np.mean(timings) * 1000),
+            'p95_ms': float(np.percentile(timings, 95) * 1000),
+            'mean_bytes': float(np.mean(sizes)),
+        }
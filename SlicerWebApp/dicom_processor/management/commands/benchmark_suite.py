@@ -0,0 +1,141 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+import pydicom
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_processor.benchmarking import (
+    SUITE_STAGES,
+    TRANSFER_SYNTAXES,
+    clear_volume_store,
+    compare_reports,
+    git_commit,
+    run_stage,
+    synthetic_series_directory,
+)
+
+
+def _directory_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks ingest, NRRD conversion, inference and slice rendering on synthetic CT "
+        "series of several sizes and transfer syntaxes. Each stage runs in a fresh process "
+        "and its wall time and peak memory go into a JSON report, which --compare checks "
+        "against the report of another commit."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slices', type=int, nargs='+', default=[64, 256, 1024],
+                            help="Slice counts of the synthetic series.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic series.")
+        parser.add_argument('--transfer-syntaxes', nargs='+', choices=sorted(TRANSFER_SYNTAXES),
+                            default=['explicit', 'rle'])
+        parser.add_argument('--stages', nargs='+', choices=list(SUITE_STAGES), default=list(SUITE_STAGES))
+        parser.add_argument('--data-dir', help="Where the synthetic series are kept between runs. Defaults to a temporary directory.")
+        parser.add_argument('--model', help="Path to a .keras model for generate_heatmap (defaults to the app checkpoint).")
+        parser.add_argument('--slice-samples', type=int, default=16,
+                            help="Slices rendered per orientation by the get_slice_from_volume_and_save_png stage.")
+        parser.add_argument('--warm-volume-store', action='store_true',
+                            help="Keep the volume store between stages instead of decoding the DICOM files in every stage.")
+        parser.add_argument('--output', help="Write the report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A report from an earlier run to compare against.")
+        parser.add_argument('--run-stage', choices=list(SUITE_STAGES),
+                            help="Run one stage in this process (used internally by the suite).")
+        parser.add_argument('--directory', help="Series directory for --run-stage.")
+
+    def handle(self, *args, **options):
+        if options['run_stage']:
+            result = run_stage(options['run_stage'], options['directory'], options['model'], options['slice_samples'])
+            self.stdout.write(json.dumps(result))
+            return
+
+        manage_py = os.path.join(os.getcwd(), 'manage.py')
+        if not os.path.exists(manage_py):
+            raise CommandError("Run this command from the directory that contains manage.py.")
+
+        report = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'git_commit': git_commit(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'numpy': np.__version__,
+                'pydicom': pydicom.__version__,
+            },
+            'config': {
+                'slices': options['slices'],
+                'size': options['size'],
+                'transfer_syntaxes': options['transfer_syntaxes'],
+                'stages': options['stages'],
+                'warm_volume_store': options['warm_volume_store'],
+            },
+            'results': [],
+        }
+
+        with tempfile.TemporaryDirectory() as scratch:
+            data_dir = options['data_dir'] or scratch
+            for transfer_syntax in options['transfer_syntaxes']:
+                for num_slices in options['slices']:
+                    name = f"ct_{num_slices}x{options['size']}x{options['size']}_{transfer_syntax}"
+                    self.stderr.write(f"{name}: preparing series...")
+                    directory = synthetic_series_directory(data_dir, num_slices, options['size'], transfer_syntax)
+                    entry = {
+                        'series': name,
+                        'slices': num_slices,
+                        'size': options['size'],
+                        'transfer_syntax': transfer_syntax,
+                        'bytes_on_disk': _directory_bytes(directory),
+                        'stages': {},
+                    }
+                    clear_volume_store(directory)
+                    for stage in options['stages']:
+                        if not options['warm_volume_store']:
+                            clear_volume_store(directory)
+                        result = self._run_in_subprocess(manage_py, stage, directory, options)
+                        entry['stages'][stage] = result
+                        if 'seconds' in result:
+                            self.stderr.write(
+                                f"  {stage}: {result['seconds']:.2f}s, "
+                                f"peak RSS +{result['peak_rss_above_startup_bytes'] / 2**20:.0f} MB"
+                            )
+                        else:
+                            self.stderr.write(f"  {stage}: {result.get('skipped') or result.get('error')}")
+                    report['results'].append(entry)
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                report['comparison'] = compare_reports(report, json.load(baseline_file))
+            for row in report['comparison']:
+                if row['seconds_ratio'] is not None:
+                    self.stderr.write(f"{row['series']} {row['stage']}: {row['seconds_ratio']:.2f}x the baseline time")
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def _run_in_subprocess(self, manage_py, stage, directory, options):
+        command = [
+            sys.executable, manage_py, 'benchmark_suite', '--run-stage', stage, '--directory', directory,
+            '--slice-samples', str(options['slice_samples']),
+        ]
+        if options['model']:
+            command += ['--model', options['model']]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+        # The last line of stdout is the JSON result; everything before it is progress output.
+        return json.loads(completed.stdout.strip().splitlines()[-1])
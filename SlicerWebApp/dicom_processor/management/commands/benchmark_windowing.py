@@ -0,0 +1,81 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from dicom_processor.synthetic import make_synthetic_volume
+from dicom_processor.windowing import WINDOW_PRESETS, _cached_window_lut, apply_window_lut, apply_windowing
+
+
+def _best_time(function, repeats):
+    best = None
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        value = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+class Command(BaseCommand):
+    help = (
+        "Times windowing of an int16 CT volume with the float path (astype(float32) and "
+        "apply_windowing) against the cached lookup tables, per slice and for the whole "
+        "volume, for each window preset. Reports the largest difference between them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slices', type=int, default=128, help="Slices in the synthetic volume.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the synthetic volume.")
+        parser.add_argument('--presets', nargs='+', default=list(WINDOW_PRESETS), choices=list(WINDOW_PRESETS))
+        parser.add_argument('--repeats', type=int, default=3, help="Runs per setting; the fastest one is reported.")
+
+    def handle(self, *args, **options):
+        # Stored values are HU + 1024; shift them to HU so the presets apply directly.
+        volume = (make_synthetic_volume(options['slices'], options['size'], options['size']) - 1024).astype(np.int16)
+        middle = volume[volume.shape[0] // 2]
+        repeats = options['repeats']
+
+        results = []
+        for preset in options['presets']:
+            window_center, window_width = WINDOW_PRESETS[preset]
+
+            slice_float, expected_slice = _best_time(
+                lambda: apply_windowing(middle.astype(np.float32), window_center, window_width), repeats
+            )
+            volume_float, expected_volume = _best_time(
+                lambda: apply_windowing(volume.astype(np.float32), window_center, window_width), repeats
+            )
+
+            _cached_window_lut.cache_clear()
+            lut_build, _ = _best_time(lambda: apply_window_lut(middle[:1, :1], window_center, window_width), 1)
+            slice_lut, windowed_slice = _best_time(
+                lambda: apply_window_lut(middle, window_center, window_width), repeats
+            )
+            volume_lut, windowed_volume = _best_time(
+                lambda: apply_window_lut(volume, window_center, window_width), repeats
+            )
+
+            result = {
+                'preset': preset,
+                'window': [window_center, window_width],
+                'lut_build_seconds': lut_build,
+                'slice_float_seconds': slice_float,
+                'slice_lut_seconds': slice_lut,
+                'slice_speedup': slice_float / slice_lut,
+                'volume_float_seconds': volume_float,
+                'volume_lut_seconds': volume_lut,
+                'volume_speedup': volume_float / volume_lut,
+                'max_abs_difference': int(max(
+                    np.max(np.abs(expected_slice.astype(np.int16) - windowed_slice)),
+                    np.max(np.abs(expected_volume.astype(np.int16) - windowed_volume)),
+                )),
+            }
+            results.append(result)
+            self.stderr.write(
+                f"{preset:>12}: slice {slice_float * 1e3:.2f}ms -> {slice_lut * 1e3:.2f}ms "
+                f"({result['slice_speedup']:.1f}x), volume {volume_float:.3f}s -> {volume_lut:.3f}s "
+                f"({result['volume_speedup']:.1f}x), LUT built in {lut_build * 1e3:.1f}ms"
+            )
+        self.stdout.write(json.dumps({'shape': list(volume.shape), 'results': results}, indent=2))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from dicom_processor.model_registry import get_model_registry
+from dicom_processor.models import ProcessingJob, ProcessingResult
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports how often processing jobs reused an earlier result with the same content "
+        "fingerprint and model, and how many cached results exist per model checkpoint."
+    )
+
+    def handle(self, *args, **options):
+        hits = ProcessingJob.objects.filter(result_cache_hit=True).count()
+        misses = ProcessingJob.objects.filter(result_cache_hit=False).count()
+        current_model_id = get_model_registry().model_id
+
+        results_by_model = (
+            ProcessingResult.objects.exclude(model_id='')
+            .values('model_id')
+            .annotate(results=Count('id'), fingerprints=Count('content_fingerprint', distinct=True))
+            .order_by('model_id')
+        )
+        report = {
+            'jobs': {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            },
+            'current_model_id': current_model_id,
+            'results_by_model': [
+                dict(entry, current=entry['model_id'] == current_model_id) for entry in results_by_model
+            ],
+        }
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,190 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_processor.benchmarking import git_commit
+from dicom_processor.loadtest import (
+    TRACES,
+    create_session_keys,
+    prepare_fixture_series,
+    remove_fixtures,
+    run_load_level,
+    saturation_point,
+    summarize_samples,
+)
+
+
+def _parse_mix(values):
+    mix = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        if name not in TRACES:
+            raise CommandError(f"Unknown trace '{name}'. Choose from: {', '.join(TRACES)}.")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"The weight of '{name}' must be a number, not '{weight}'.")
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+    if not mix:
+        raise CommandError("--mix needs at least one trace with a positive weight.")
+    return mix
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the viewer endpoints (dashboard, get_slice_url and the slice images, "
+        "get_nrrd_url, get_heatmap_url, processing and job status) with concurrent "
+        "logged-in sessions replaying scroll, window/level and processing traces on "
+        "synthetic fixture series. Reports p50/p95/p99 latency, throughput and error "
+        "rate per endpoint for each session count, and where throughput stopped scaling. "
+        "runserver answers every request after the first on a kept-alive connection about "
+        "40ms late, so measure saturation against the production server with --base-url."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8, 32],
+                            help="Concurrent sessions; each count is run in turn.")
+        parser.add_argument('--duration', type=float, default=30, help="Seconds each session count runs for.")
+        parser.add_argument('--ramp-up', type=float, default=5, help="Seconds over which the sessions are started.")
+        parser.add_argument('--mix', nargs='+', default=['scroll=6', 'window=3', 'processing=1'],
+                            help="Traces and their weights, e.g. scroll=6 window=3 processing=1.")
+        parser.add_argument('--think-scale', type=float, default=1.0,
+                            help="Multiplies every pause between requests; 0 sends requests back to back.")
+        parser.add_argument('--series', type=int, default=2, help="Fixture series the sessions open.")
+        parser.add_argument('--slices', type=int, default=128, help="Slices in each fixture series.")
+        parser.add_argument('--size', type=int, default=512, help="Rows and columns of the fixture series.")
+        parser.add_argument('--base-url',
+                            help="A running server using this project's database and media, e.g. "
+                                 "http://127.0.0.1:8000. Defaults to starting runserver on a free port.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the traces; keep it to replay the same requests.")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds before a request counts as failed.")
+        parser.add_argument('--no-browser-cache', action='store_true',
+                            help="Send every request, even those a browser would answer from its cache.")
+        parser.add_argument('--no-keep-alive', action='store_true',
+                            help="Open a new connection for every request instead of keeping one per session.")
+        parser.add_argument('--output', help="Write the report to this file instead of stdout.")
+        parser.add_argument('--clean', action='store_true', help="Remove the load-test account, series and files, then exit.")
+
+    def handle(self, *args, **options):
+        if options['clean']:
+            removed = remove_fixtures()
+            self.stderr.write(f"Removed the load-test account and {removed} series.")
+            return
+
+        mix = _parse_mix(options['mix'])
+        user, fixtures = prepare_fixture_series(options['series'], options['slices'], options['size'])
+
+        server = None
+        base_url = options['base_url']
+        if not base_url:
+            server, base_url = self._start_server()
+        try:
+            levels = []
+            for sessions in options['sessions']:
+                self.stderr.write(f"{sessions} sessions for {options['duration']:.0f}s...")
+                samples, seconds, browser_cache_hits = run_load_level(
+                    base_url, create_session_keys(user, sessions), fixtures, mix, options['duration'],
+                    ramp_up=options['ramp_up'], think_scale=options['think_scale'], seed=options['seed'],
+                    browser_cache=not options['no_browser_cache'], keep_alive=not options['no_keep_alive'],
+                    timeout=options['timeout'],
+                )
+                level = {
+                    'sessions': sessions,
+                    'seconds': seconds,
+                    'browser_cache_hits': browser_cache_hits,
+                    'endpoints': summarize_samples(samples, seconds),
+                }
+                levels.append(level)
+                self._write_level(level)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        report = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'git_commit': git_commit(),
+            'base_url': options['base_url'] or 'runserver',
+            'cpu_count': os.cpu_count(),
+            'config': {
+                'mix': mix,
+                'duration': options['duration'],
+                'ramp_up': options['ramp_up'],
+                'think_scale': options['think_scale'],
+                'series': options['series'],
+                'slices': options['slices'],
+                'size': options['size'],
+                'seed': options['seed'],
+                'browser_cache': not options['no_browser_cache'],
+                'keep_alive': not options['no_keep_alive'],
+            },
+            'levels': levels,
+            'saturated_at_sessions': saturation_point(levels),
+        }
+        if len(levels) > 1 and report['saturated_at_sessions'] is not None:
+            self.stderr.write(
+                f"Saturated at {report['saturated_at_sessions']} sessions "
+                "(throughput stopped growing or more than 1% errors)."
+            )
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def _start_server(self):
+        manage_py = os.path.join(os.getcwd(), 'manage.py')
+        if not os.path.exists(manage_py):
+            raise CommandError("Run this command from the directory that contains manage.py, or pass --base-url.")
+        port = _free_port()
+        self.stderr.write(f"Starting runserver on port {port}...")
+        server = subprocess.Popen(
+            [sys.executable, manage_py, 'runserver', f'127.0.0.1:{port}', '--noreload'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        # Start-up imports TensorFlow and may warm up the model, so give it a while.
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"runserver exited with status {server.returncode}.")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server, f'http://127.0.0.1:{port}'
+            except OSError:
+                time.sleep(0.5)
+        server.terminate()
+        raise CommandError("runserver did not start listening within 120 seconds.")
+
+    def _write_level(self, level):
+        total = level['endpoints'].get('total')
+        if total is None:
+            self.stderr.write("  no requests completed")
+            return
+        self.stderr.write(
+            f"  {total['throughput_rps']:.1f} req/s, p50 {total['p50_ms']:.0f}ms, p95 {total['p95_ms']:.0f}ms, "
+            f"p99 {total['p99_ms']:.0f}ms, errors {total['error_rate']:.1%} "
+            f"({level['browser_cache_hits']} answered from the browser cache)"
+        )
+        for endpoint, stats in level['endpoints'].items():
+            if endpoint == 'total':
+                continue
+            self.stderr.write(
+                f"    {endpoint:>22}: {stats['requests']:>6} requests, {stats['throughput_rps']:6.1f} req/s, "
+                f"p50 {stats['p50_ms']:7.1f}ms, p95 {stats['p95_ms']:7.1f}ms, p99 {stats['p99_ms']:7.1f}ms, "
+                f"errors {stats['error_rate']:.1%}"
+            )
@@ -0,0 +1,57 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dicom_processor.media_serving import GZIP_SUFFIX, SERVED_MEDIA_DIRECTORIES, write_gzip_sibling
+
+
+# Formats that are compressed already; gzip would only cost CPU on both ends.
+ALREADY_COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', GZIP_SUFFIX)
+
+
+def _is_gzip_encoded_nrrd(path):
+    with open(path, 'rb') as nrrd_file:
+        header = nrrd_file.read(4096).split(b'\n\n', 1)[0]
+    return any(line.strip() in (b'encoding: gzip', b'encoding: gz') for line in header.splitlines())
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes .gz siblings for the uncompressed files served by serve_media (e.g. NRRD "
+        "volumes converted before the gzip-encoded levels existed), so clients that accept "
+        "gzip download less. Siblings that would not save at least --min-saving are removed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-saving', type=float, default=0.1,
+                            help="Smallest fraction of bytes a .gz sibling must save to be kept.")
+
+    def handle(self, *args, **options):
+        report = {'written': 0, 'up_to_date': 0, 'not_worth_it': 0, 'bytes_before': 0, 'bytes_after': 0}
+        for directory in SERVED_MEDIA_DIRECTORIES:
+            for root, _, filenames in os.walk(os.path.join(settings.MEDIA_ROOT, directory)):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if filename.endswith(ALREADY_COMPRESSED_EXTENSIONS) or filename.endswith('.tmp'):
+                        continue
+                    if filename.endswith('.nrrd') and _is_gzip_encoded_nrrd(path):
+                        continue
+
+                    gzip_path = path + GZIP_SUFFIX
+                    if os.path.exists(gzip_path) and os.path.getmtime(gzip_path) >= os.path.getmtime(path):
+                        report['up_to_date'] += 1
+                        continue
+
+                    write_gzip_sibling(path)
+                    size, gzip_size = os.path.getsize(path), os.path.getsize(gzip_path)
+                    if gzip_size > size * (1 - options['min_saving']):
+                        os.remove(gzip_path)
+                        report['not_worth_it'] += 1
+                        continue
+                    report['written'] += 1
+                    report['bytes_before'] += size
+                    report['bytes_after'] += gzip_size
+                    self.stderr.write(f"{os.path.relpath(path, settings.MEDIA_ROOT)}: {size} -> {gzip_size} bytes")
+        self.stdout.write(json.dumps(report, indent=2))
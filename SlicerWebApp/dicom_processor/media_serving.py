@@ -0,0 +1,181 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+
+
+# Media directories served by serve_media, and whether their files are content-addressed
+# (written once under a name that changes with the content). Only those may be cached
+# for good; NRRD volumes keep their name when a series is processed again.
+SERVED_MEDIA_DIRECTORIES = {
+    'nrrd_files': False,
+    'heatmaps': True,
+    'slice_cache': True,
+}
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+STREAM_BLOCK_SIZE = 64 * 1024
+GZIP_SUFFIX = '.gz'
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def media_url(path):
+    """
+    URL of a file under MEDIA_ROOT. Built from the relative path, so it never has the
+    doubled slash that replacing MEDIA_ROOT with MEDIA_URL in the path gives, which
+    the serve_media route does not match.
+    """
+    relative_path = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    return f"{settings.MEDIA_URL.rstrip('/')}/{relative_path}"
+
+
+def write_gzip_sibling(path, compresslevel=6):
+    """
+    Writes `path`.gz next to a file, for serve_media to send to clients that accept
+    gzip. Written under a temporary name first, so it is never served half-written.
+    """
+    temp_path = f"{path}{GZIP_SUFFIX}.tmp"
+    with open(path, 'rb') as source, gzip.open(temp_path, 'wb', compresslevel=compresslevel) as target:
+        shutil.copyfileobj(source, target, STREAM_BLOCK_SIZE)
+    os.replace(temp_path, path + GZIP_SUFFIX)
+    return path + GZIP_SUFFIX
+
+
+def file_etag(path, stat_result, variant=''):
+    """
+    Strong ETag of one representation of a file: its path, size and modification time.
+    Every writer in this app replaces files (os.replace or a fresh write), so new bytes
+    always come with a new mtime.
+    """
+    parts = [os.path.relpath(path, settings.MEDIA_ROOT), stat_result.st_size, stat_result.st_mtime_ns, variant]
+    return quote_etag(hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()[:32])
+
+
+def parse_byte_range(header, size):
+    """
+    (start, end) of a single 'bytes=' range, end inclusive, or None when the header
+    is not one we honour (multiple ranges are answered with the whole file).
+    Raises ValueError for a range that starts beyond the end of the file, or for any
+    range of an empty file.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # A suffix range: the last N bytes.
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def _accepts_gzip(request):
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+class _FileRange:
+    """Reads `length` bytes of an open file from `start`, for FileResponse to stream."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def media_file_response(request, path, content_addressed=False):
+    """
+    Streams one media file with FileResponse, answering conditional and Range requests.
+
+    The whole file, or a single byte range of it, is read in blocks straight from disk.
+    When the client accepts gzip and an up-to-date `path`.gz sibling exists, that is
+    sent instead with Content-Encoding: gzip (not for Range requests, which always
+    address the plain bytes). Content-addressed files are marked immutable for a year;
+    the rest must be revalidated, which their ETag makes a cheap 304.
+    """
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    gzip_path = path + GZIP_SUFFIX
+    try:
+        gzip_stat = os.stat(gzip_path)
+        has_gzip = gzip_stat.st_mtime_ns >= stat_result.st_mtime_ns
+    except FileNotFoundError:
+        has_gzip = False
+    range_header = request.META.get('HTTP_RANGE')
+    use_gzip = has_gzip and not range_header and _accepts_gzip(request)
+
+    etag = file_etag(gzip_path, gzip_stat, 'gzip') if use_gzip else file_etag(path, stat_result)
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    if content_addressed:
+        headers['Cache-Control'] = f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        headers['Cache-Control'] = 'private, no-cache'
+    if has_gzip:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    byte_range = None
+    if range_header:
+        # If-Range: only honour the range when the client still has this exact version.
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or if_range.strip() == etag:
+            try:
+                byte_range = parse_byte_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                for name, value in headers.items():
+                    response[name] = value
+                return response
+
+    if use_gzip:
+        response = FileResponse(open(gzip_path, 'rb'), content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    elif byte_range is not None:
+        start, end = byte_range
+        response = FileResponse(_FileRange(open(path, 'rb'), start, end - start + 1),
+                                content_type=content_type, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response.block_size = STREAM_BLOCK_SIZE
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,218 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('dicom_processor.stages')
+
+# Upper bounds, in seconds, of the latency histogram buckets. They span a PNG encode
+# (about a millisecond) up to a Grad-CAM pass on a cold model (about a minute).
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = 'dicom_processor_stage_seconds'
+JOB_STAGE_SECONDS = 'dicom_processor_job_stage_seconds'
+REQUEST_SECONDS = 'dicom_processor_http_request_seconds'
+RESPONSES_TOTAL = 'dicom_processor_http_responses_total'
+
+METRIC_HELP = {
+    STAGE_SECONDS: 'Time spent in each processing stage (DICOM read, resize, model passes, NRRD write, image encode).',
+    JOB_STAGE_SECONDS: 'Time spent in each stage of a background processing job.',
+    REQUEST_SECONDS: 'Time from the request reaching the app to the response (or its first chunk) being returned.',
+    RESPONSES_TOTAL: 'Responses sent, by endpoint, method and status code.',
+}
+
+
+class Histogram:
+    """Counts of observations per bucket (the last one is +Inf), with their sum, as Prometheus histograms keep them."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # An observation belongs to the first bucket whose upper bound is >= the value.
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.bucket_counts = list(self.bucket_counts)
+        histogram.sum, histogram.count = self.sum, self.count
+        return histogram
+
+
+class MetricsRegistry:
+    """
+    In-process histograms and counters, keyed by metric name and label values.
+    Every worker process keeps its own; /metrics reports those of the process that
+    answers the scrape.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}   # (name, ((label, value), ...)) -> Histogram
+        self._counters = {}     # (name, ((label, value), ...)) -> number
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """Copies of (histograms, counters), taken under the lock."""
+        with self._lock:
+            return (
+                {key: histogram.copy() for key, histogram in self._histograms.items()},
+                dict(self._counters),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self, component_stats=None):
+        """
+        The registry in the Prometheus text format (version 0.0.4), followed by the
+        `component_stats` of the caches and workers (see render_component_stats).
+        """
+        histograms, counters = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines += _header(name, 'histogram')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for upper_bound, bucket_count in zip(histogram.buckets + (math.inf,), histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(upper_bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name in sorted({name for name, _ in counters}):
+            lines += _header(name, 'counter')
+            lines += [f"{name}{_labels(labels)} {_number(value)}"
+                      for (metric, labels), value in sorted(counters.items()) if metric == name]
+        if component_stats:
+            lines += render_component_stats(component_stats)
+        return '\n'.join(lines) + '\n'
+
+
+def _header(name, metric_type, help_text=None):
+    help_text = help_text or METRIC_HELP.get(name, name)
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in labels) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def render_component_stats(component_stats):
+    """
+    Prometheus lines for the stats() dicts of the app's caches and workers, given as
+    {component: (stats, counter_keys)}. Each numeric entry becomes
+    dicom_processor_<component>_<key>: a counter (with _total) when the key is in
+    `counter_keys`, otherwise a gauge. Booleans are 1 or 0; other values are skipped.
+    """
+    lines = []
+    for component, (stats, counter_keys) in component_stats.items():
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            if key in counter_keys:
+                name = f"dicom_processor_{component}_{key.removeprefix('total_')}_total"
+            else:
+                name = f"dicom_processor_{component}_{key}"
+            lines += _header(name, 'counter' if key in counter_keys else 'gauge',
+                             f"{key.replace('_', ' ').capitalize()} of the {component.replace('_', ' ')}.")
+            lines.append(f"{name} {_number(value)}")
+    return lines
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Returns the process-wide MetricsRegistry."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = MetricsRegistry()
+    return _metrics
+
+
+@contextmanager
+def timed_stage(stage, log_level=logging.INFO, **fields):
+    """
+    Times the block as one run of `stage`: the duration goes into the stage histogram
+    and is logged as "stage=<stage> seconds=<s>" plus any `fields` (e.g. slices=128).
+    A block that raises is timed and logged with the exception's name, then re-raised.
+    Per-slice stages log at DEBUG so scrolling does not flood the log.
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        get_metrics().observe(STAGE_SECONDS, seconds, stage=stage)
+        if logger.isEnabledFor(log_level):
+            details = ''.join(f" {key}={value}" for key, value in fields.items())
+            if error:
+                details += f" error={error}"
+            logger.log(log_level, "stage=%s seconds=%.4f%s", stage, seconds, details,
+                       extra={'stage': stage, 'seconds': seconds})
+
+
+def request_metrics_middleware(get_response):
+    """
+    Records the latency and status of every request per endpoint (the URL pattern
+    name, so /dicom/ajax/get_nrrd_url/5/ and /7/ count together). Streaming
+    responses are timed until they are returned, not until their last chunk is sent.
+    """
+    def middleware(request):
+        started = time.perf_counter()
+        response = get_response(request)
+        seconds = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        endpoint = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics = get_metrics()
+        metrics.observe(REQUEST_SECONDS, seconds, endpoint=endpoint, method=request.method)
+        metrics.increment(RESPONSES_TOTAL, endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    return middleware
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_processor', '0003_processingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='mode',
+            field=models.CharField(choices=[('full', 'Score and heatmap'), ('score', 'Score only'), ('heatmap', 'Heatmap for an existing score')], default='full', max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_processor', '0004_processingjob_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='result_cache_hit',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='processingresult',
+            name='content_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='processingresult',
+            name='model_id',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+    ]
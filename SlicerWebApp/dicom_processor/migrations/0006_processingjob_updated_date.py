@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:55
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_processor', '0005_result_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='updated_date',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
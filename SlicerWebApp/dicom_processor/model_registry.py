@@ -0,0 +1,282 @@
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+from django.conf import settings
+from tensorflow.keras.models import load_model
+
+from .metrics import timed_stage
+
+
+# The model expects a single-channel (90, 90, 25) volume.
+MODEL_INPUT_SHAPE = (90, 90, 25)
+
+CHECKPOINT_FOLDER_NAME = "checkpoint_v2_1"
+KERAS_MODEL_FILENAME = "weights-improvement_v2_1.keras"
+
+# 'activation_41' is the last activation layer before pooling, which is perfect for Grad-CAM.
+GRAD_CAM_LAYER_NAME = "activation_41"
+
+
+def get_default_model_path():
+    return os.path.join(settings.BASE_DIR, 'dicom_processor', CHECKPOINT_FOLDER_NAME, KERAS_MODEL_FILENAME)
+
+
+def model_identifier(model_path):
+    """
+    Identifies the checkpoint a result was computed with: the checkpoint folder and
+    file name plus a hash of the file contents, so replacing the weights (even under
+    the same name) gives a new identifier. None when the file does not exist.
+    """
+    try:
+        digest = hashlib.sha256()
+        with open(model_path, 'rb') as model_file:
+            for block in iter(lambda: model_file.read(1024 * 1024), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    folder = os.path.basename(os.path.dirname(model_path))
+    return f"{folder}/{os.path.basename(model_path)}:{digest.hexdigest()[:16]}"
+
+
+def build_predict_function(model, jit_compile=False):
+    """
+    Forward pass only, as a tf.function over batches of shape (N, 90, 90, 25, 1).
+    Used when just the score is needed: no gradients are recorded or computed.
+    """
+    input_signature = [tf.TensorSpec((None,) + MODEL_INPUT_SHAPE + (1,), tf.float32)]
+
+    @tf.function(input_signature=input_signature, jit_compile=jit_compile, reduce_retracing=True)
+    def predict(input_batch):
+        return model(input_batch, training=False)
+
+    return predict
+
+
+def build_gradcam_function(grad_model, jit_compile=False):
+    """
+    Builds the Grad-CAM step for `grad_model` over batches of shape (N, 90, 90, 25, 1)
+    as three compiled stages, each timed on its own:
+
+    - forward_pass: the model, giving the Grad-CAM layer output and the predictions;
+    - gradient_pass: the gradient of each sample's predicted-class score with respect
+      to the layer output, through the part of the model after the layer;
+    - cam_build: channel weighting as a single tensor contraction, ReLU and per-sample
+      normalization to [0, 1].
+
+    The returned function gives (predictions, cams) as numpy arrays; cams is None when
+    the layer is not connected to the output. When the part after the layer cannot be
+    taken out as a model of its own (a skip connection runs around the layer), the
+    forward pass is repeated under the gradient tape inside gradient_pass.
+
+    The batch dimension is left open so one trace serves every batch size. With
+    `jit_compile` XLA compiles the graphs, once per distinct batch size.
+    """
+    input_signature = [tf.TensorSpec((None,) + MODEL_INPUT_SHAPE + (1,), tf.float32)]
+    layer_output, model_output = grad_model.outputs
+    try:
+        head_model = tf.keras.models.Model(layer_output, model_output)
+    except ValueError:
+        head_model = None
+
+    @tf.function(input_signature=input_signature, jit_compile=jit_compile, reduce_retracing=True)
+    def forward(input_batch):
+        return grad_model(input_batch)
+
+    def predicted_class_scores(preds):
+        return tf.gather(preds, tf.argmax(preds, axis=1), axis=1, batch_dims=1)
+
+    @tf.function(jit_compile=jit_compile, reduce_retracing=True)
+    def gradient_from_layer(input_batch, conv_output):
+        with tf.GradientTape() as tape:
+            tape.watch(conv_output)
+            class_scores = predicted_class_scores(head_model(conv_output))
+        return tape.gradient(class_scores, conv_output)
+
+    @tf.function(jit_compile=jit_compile, reduce_retracing=True)
+    def gradient_from_input(input_batch, conv_output):
+        with tf.GradientTape() as tape:
+            conv_output, preds = grad_model(input_batch)
+            class_scores = predicted_class_scores(preds)
+        return tape.gradient(class_scores, conv_output)
+
+    gradient = gradient_from_layer if head_model is not None else gradient_from_input
+
+    @tf.function(jit_compile=jit_compile, reduce_retracing=True)
+    def build_cams(conv_output, grads):
+        pooled_grads = tf.reduce_mean(grads, axis=(1, 2, 3))
+        cams = tf.nn.relu(tf.einsum('bxyzc,bc->bxyz', conv_output, pooled_grads))
+        cam_max = tf.reduce_max(cams, axis=(1, 2, 3), keepdims=True)
+        # Samples whose CAM is all zeros stay all zeros.
+        return tf.math.divide_no_nan(cams, cam_max)
+
+    def gradcam(input_batch):
+        input_batch = tf.convert_to_tensor(input_batch, dtype=tf.float32)
+        batch = int(input_batch.shape[0])
+        with timed_stage('forward_pass', batch=batch):
+            conv_output, preds = forward(input_batch)
+            predictions = preds.numpy()
+        with timed_stage('gradient_pass', batch=batch):
+            grads = gradient(input_batch, conv_output)
+        if grads is None:
+            return predictions, None
+        with timed_stage('cam_build', batch=batch):
+            cams = build_cams(conv_output, grads).numpy()
+        return predictions, cams
+
+    return gradcam
+
+
+class ModelRegistry:
+    """
+    Holds the Keras model and its Grad-CAM wrapper for the lifetime of the worker process.
+
+    Loading the checkpoint and building the Grad-CAM model takes seconds, so we do it
+    once (normally at worker start, see warm_up_model_registry) and every request
+    afterwards only pays for inference. All loading goes through a lock so that
+    concurrent requests never deserialize the model twice.
+    """
+
+    def __init__(self, model_path, grad_cam_layer_name=GRAD_CAM_LAYER_NAME):
+        self.model_path = model_path
+        self.grad_cam_layer_name = grad_cam_layer_name
+        self.model = None
+        self.grad_model = None
+        self.gradcam_fn = None
+        self.predict_fn = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self._model_id = None
+        self._lock = threading.Lock()
+
+    @property
+    def model_id(self):
+        """model_identifier of the checkpoint, computed once. Does not need the model to be loaded."""
+        if self._model_id is None:
+            with self._lock:
+                if self._model_id is None:
+                    self._model_id = model_identifier(self.model_path)
+        return self._model_id
+
+    @property
+    def is_loaded(self):
+        return self.model is not None
+
+    def ensure_loaded(self):
+        """Loads the model on first use. Returns True when a model is ready."""
+        if self.model is not None:
+            return True
+        with self._lock:
+            if self.model is None:
+                with timed_stage('model_load', model=os.path.basename(self.model_path)):
+                    self._load()
+        return self.model is not None
+
+    def _load(self):
+        print(f"  > Attempting to load model from: {self.model_path}")
+        if not os.path.exists(self.model_path):
+            print(f"!!! ERROR: Model file not found at {self.model_path}.")
+            return
+
+        started = time.perf_counter()
+        try:
+            model = load_model(self.model_path)
+        except Exception as e:
+            print(f"!!! ERROR loading Keras model from file {self.model_path}: {e}")
+            return
+
+        grad_model = None
+        try:
+            grad_model = tf.keras.models.Model(
+                model.input, [model.get_layer(self.grad_cam_layer_name).output, model.output]
+            )
+        except ValueError:
+            # Without the Grad-CAM model we can still return a prediction score.
+            print(f"!!! ERROR creating Grad-CAM model. Layer '{self.grad_cam_layer_name}' not found. Heatmaps will be skipped.")
+
+        jit_compile = getattr(settings, 'GRAD_CAM_JIT_COMPILE', False)
+        self.predict_fn = build_predict_function(model, jit_compile=jit_compile)
+        self.gradcam_fn = None
+        if grad_model is not None:
+            self.gradcam_fn = build_gradcam_function(grad_model, jit_compile=jit_compile)
+        self.grad_model = grad_model
+        self.model = model
+        self.load_seconds = time.perf_counter() - started
+        print(f"  > Model loaded successfully in {self.load_seconds:.2f}s.")
+
+    def warm_up(self):
+        """
+        Runs one pass with a dummy input so TensorFlow traces the inference functions
+        and builds their kernels now rather than during the first real request.
+        """
+        if not self.ensure_loaded():
+            return False
+        with self._lock:
+            if self.warmup_seconds is not None:
+                return True
+            dummy_input = np.zeros((1,) + MODEL_INPUT_SHAPE + (1,), dtype=np.float32)
+            started = time.perf_counter()
+            # Traces (and with XLA, compiles) both the score-only and the Grad-CAM function.
+            with timed_stage('model_warmup'):
+                self.predict_fn(dummy_input)
+                if self.gradcam_fn is not None:
+                    self.gradcam_fn(dummy_input)
+            self.warmup_seconds = time.perf_counter() - started
+        print(f"  > Model warm-up finished in {self.warmup_seconds:.2f}s.")
+        return True
+
+    def stats(self):
+        return {
+            'model_path': self.model_path,
+            'model_id': self._model_id,
+            'loaded': self.is_loaded,
+            'grad_cam_available': self.grad_model is not None,
+            'grad_cam_jit_compile': getattr(settings, 'GRAD_CAM_JIT_COMPILE', False),
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+        }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry():
+    """Returns the process-wide ModelRegistry, creating it on first call."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry(get_default_model_path())
+    return _registry
+
+
+def _warm_up(registry):
+    try:
+        registry.warm_up()
+    except Exception as e:
+        print(f"!!! ERROR warming up the model from {registry.model_path}: {e}")
+
+
+def warm_up_model_registry(background=None):
+    """
+    Called once per worker process (see wsgi.py / asgi.py). Unless
+    MODEL_WARMUP_IN_BACKGROUND is off (or `background` is False), the model is loaded
+    and warmed up on a daemon thread, so the worker starts serving at once and only
+    requests that need the model wait for it, in ensure_loaded. Returns that thread,
+    or None when warm-up is disabled or has already run in the foreground.
+    """
+    if not getattr(settings, 'MODEL_WARMUP_ON_STARTUP', True):
+        return None
+    if background is None:
+        background = getattr(settings, 'MODEL_WARMUP_IN_BACKGROUND', True)
+    registry = get_model_registry()
+    if not background:
+        _warm_up(registry)
+        return None
+    thread = threading.Thread(target=_warm_up, args=(registry,), name='model-warmup', daemon=True)
+    thread.start()
+    return thread
@@ -25,12 +25,15 @@ class ProcessingResult(models.Model):
     Stores the results of processing a DicomSeries.
     This links a DicomSeries to its generated data, like heatmaps and predictions.
     """
+    RESULT_HEATMAP_AND_PREDICTION = 'heatmap_and_prediction'
+    RESULT_PREDICTION_ONLY = 'prediction_only'
+
     dicom_series = models.OneToOneField(
         DicomSeries,
         on_delete=models.CASCADE,
         related_name='processing_result'
     )
-    result_type = models.CharField(max_length=50, default='heatmap_and_prediction')
+    result_type = models.CharField(max_length=50, default=RESULT_HEATMAP_AND_PREDICTION)
     
     # === MODIFICATION START ===
     # We now store paths and both prediction probabilities directly.
@@ -54,6 +57,81 @@ class ProcessingResult(models.Model):
     # e.g., "{'axial': 128, 'coronal': 256, 'sagittal': 256}"
     slice_counts_json = models.TextField(blank=True, null=True)
 
+    # What the prediction and heatmap were computed from: the content fingerprint of
+    # the series and the model checkpoint identifier. A later run on a series with
+    # the same fingerprint, under the same model, reuses this result.
+    content_fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    model_id = models.CharField(max_length=128, blank=True)
+
+    @property
+    def has_heatmap(self):
+        return bool(self.heatmap_file_path)
+
     def __str__(self):
         return f"Result for {self.dicom_series.name}"
 
+
+
+class ProcessingJob(models.Model):
+    """
+    Tracks one background run of the processing pipeline for a DicomSeries.
+    The process page polls this through the job status endpoint, and only
+    redirects to the dashboard once the job has produced a ProcessingResult.
+    """
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_SUCCEEDED = 'succeeded'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = [
+        (STATE_QUEUED, 'Queued'),
+        (STATE_RUNNING, 'Running'),
+        (STATE_SUCCEEDED, 'Succeeded'),
+        (STATE_FAILED, 'Failed'),
+    ]
+
+    # 'full' computes score and heatmap, 'score' only the score (a forward pass, for
+    # triage), and 'heatmap' adds the heatmap to a series that already has a score.
+    MODE_FULL = 'full'
+    MODE_SCORE_ONLY = 'score'
+    MODE_HEATMAP = 'heatmap'
+    MODE_CHOICES = [
+        (MODE_FULL, 'Score and heatmap'),
+        (MODE_SCORE_ONLY, 'Score only'),
+        (MODE_HEATMAP, 'Heatmap for an existing score'),
+    ]
+
+    dicom_series = models.ForeignKey(
+        DicomSeries,
+        on_delete=models.CASCADE,
+        related_name='processing_jobs'
+    )
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_QUEUED)
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default=MODE_FULL)
+    # Whether the model stage was answered from a previous result with the same
+    # fingerprint and model; None until the job gets there (or when it could not look).
+    result_cache_hit = models.BooleanField(null=True, blank=True)
+
+    # Name of the stage currently running, and overall progress from 0 to 100.
+    stage = models.CharField(max_length=50, blank=True)
+    progress = models.PositiveSmallIntegerField(default=0)
+
+    # Seconds spent in each finished stage, e.g. "{'heatmap': 12.3, 'nrrd': 4.1}"
+    stage_timings_json = models.TextField(blank=True, null=True)
+    error_message = models.TextField(blank=True)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    started_date = models.DateTimeField(null=True, blank=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+    # Last time the worker wrote to the job. A queued or running job that has not been
+    # updated for PROCESSING_JOB_STALE_SECONDS lost its worker (see fail_orphaned_jobs).
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_date']
+
+    @property
+    def is_active(self):
+        return self.state in (self.STATE_QUEUED, self.STATE_RUNNING)
+
+    def __str__(self):
+        return f"Job {self.id} for {self.dicom_series.name} ({self.state})"
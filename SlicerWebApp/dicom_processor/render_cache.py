@@ -0,0 +1,155 @@
+import os
+import threading
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+from .utils import encode_slice_image, render_slice
+from .volume_cache import series_directory_mtime
+
+
+RENDER_CACHE_DIRNAME = 'slice_cache'
+
+
+def slice_render_key(series, view_orientation, slice_index, window_center, window_width):
+    """
+    Identifies one rendered slice. The series directory mtime is part of the key,
+    so a series whose files change gets fresh renders (and fresh ETags).
+
+    The key starts with the owner ("user<id>_") so serve_media can check it, as for
+    NRRD volumes, and the rest is an HMAC keyed with SECRET_KEY, so a rendered slice
+    cannot be found from the series id and view parameters alone.
+    """
+    parts = [
+        series.id,
+        series_directory_mtime(series.file_path),
+        view_orientation,
+        slice_index,
+        f"{float(window_center):g}",
+        f"{float(window_width):g}",
+    ]
+    digest = salted_hmac('dicom_processor.slice_render_key', '|'.join(str(part) for part in parts)).hexdigest()
+    return f"user{series.user_id}_{digest[:32]}"
+
+
+class SliceRenderCache:
+    """
+    Disk cache of rendered slice PNGs under MEDIA_ROOT/slice_cache, bounded by size.
+
+    Files are named after their render key, so a URL always points at the same
+    image and the browser may cache it for good. When the directory grows past
+    max_bytes, the least recently used files (by mtime, refreshed on every hit)
+    are removed until it is back under 90% of the budget.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._current_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def touch(self, key):
+        """
+        Whether the PNG for `key` is still cached, refreshing its mtime so eviction
+        sees it as recently used. Not counted as a hit: a request that goes on to
+        get_or_render is counted there.
+        """
+        try:
+            os.utime(self.path_for(key))
+        except OSError:
+            return False
+        return True
+
+    def get_or_render(self, key, volume_getter, view_orientation, slice_index, window_center, window_width):
+        """Path of the cached PNG for `key`, rendering it from `volume_getter()` on a miss."""
+        path = self.path_for(key)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return path
+
+        windowed_slice = render_slice(volume_getter(), view_orientation, slice_index, window_center, window_width)
+        if windowed_slice is None:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Write under a temporary name first, so concurrent readers never see half a file.
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as png_file:
+                png_file.write(encode_slice_image(windowed_slice, 'png'))
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"  Error saving PNG image {path}: {e}")
+            return None
+
+        with self._lock:
+            self.misses += 1
+            if self._current_bytes is None:
+                self._current_bytes = self._directory_size()
+            else:
+                self._current_bytes += os.path.getsize(path)
+            if self._current_bytes > self.max_bytes:
+                self._evict()
+        return path
+
+    def _directory_size(self):
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.png'):
+                total += entry.stat().st_size
+        return total
+
+    def _evict(self):
+        files = [entry for entry in os.scandir(self.directory) if entry.is_file() and entry.name.endswith('.png')]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in files)
+        target = self.max_bytes * 0.9
+        for entry in files:
+            if total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._current_bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """Returns the process-wide SliceRenderCache, sized by SLICE_RENDER_CACHE_MAX_BYTES."""
+    global _render_cache
+    if _render_cache is None:
+        with _render_cache_lock:
+            if _render_cache is None:
+                _render_cache = SliceRenderCache(
+                    os.path.join(settings.MEDIA_ROOT, RENDER_CACHE_DIRNAME),
+                    getattr(settings, 'SLICE_RENDER_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+                )
+    return _render_cache
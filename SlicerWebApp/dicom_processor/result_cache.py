@@ -0,0 +1,58 @@
+import os
+import threading
+
+from .models import ProcessingResult
+
+
+class InferenceResultCache:
+    """
+    Finds an earlier ProcessingResult that can stand in for a new inference run.
+
+    Results are stored with the content fingerprint of their series and the
+    identifier of the model checkpoint, so a match means the same pixels went
+    through the same weights. A new checkpoint changes the identifier, which makes
+    every older entry a miss without any explicit invalidation. Results with a
+    heatmap also serve score-only runs, but not the other way round.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, fingerprint, model_id, with_heatmap=True):
+        """Returns a reusable ProcessingResult, or None. Not counted when either key is unknown."""
+        if not fingerprint or not model_id:
+            return None
+
+        candidates = ProcessingResult.objects.filter(content_fingerprint=fingerprint, model_id=model_id)
+        for result in candidates.order_by('-processed_date'):
+            if result.ece_probability is None:
+                continue
+            if with_heatmap and not (result.heatmap_file_path and os.path.exists(result.heatmap_file_path)):
+                continue
+            with self._lock:
+                self.hits += 1
+            return result
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Returns the process-wide InferenceResultCache."""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = InferenceResultCache()
+    return _result_cache
@@ -0,0 +1,112 @@
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+# Slice orientations and the volume axis (slices, rows, cols) each one steps along.
+ORIENTATION_AXES = {'axial': 0, 'coronal': 1, 'sagittal': 2}
+ATLAS_INDEX_VERSION = 1
+
+
+def normalize_orientation(volume, axis, chunk_slices=32):
+    """
+    Every slice along `axis` stretched to 0-255 by its own minimum and maximum, as
+    uint8 with shape (slices, height, width). This is the per-slice normalization
+    generate_all_directional_slices always did, computed for many slices per numpy
+    call instead of one; float32 temporaries are bounded by `chunk_slices`.
+    """
+    slices = np.moveaxis(volume, axis, 0)
+    normalized = np.empty(slices.shape, dtype=np.uint8)
+    for start in range(0, slices.shape[0], chunk_slices):
+        chunk = slices[start:start + chunk_slices].astype(np.float32)
+        chunk -= chunk.min(axis=(1, 2), keepdims=True)
+        peak = chunk.max(axis=(1, 2), keepdims=True)
+        chunk /= np.where(peak > 0, peak, 1)
+        chunk *= 255
+        normalized[start:start + chunk_slices] = chunk.astype(np.uint8)
+    return normalized
+
+
+def atlas_layout(num_slices, tile_height, tile_width, max_atlas_pixels=4096):
+    """
+    (columns, slices_per_atlas) for packing tiles into atlases no wider or taller
+    than `max_atlas_pixels`, which keeps each sheet within browser texture limits.
+    """
+    columns = max(1, min(max_atlas_pixels // tile_width, math.ceil(math.sqrt(num_slices))))
+    rows = max(1, min(max_atlas_pixels // tile_height, math.ceil(num_slices / columns)))
+    return columns, columns * rows
+
+
+def _write_atlas(tiles, columns, path, compress_level):
+    rows = math.ceil(len(tiles) / columns)
+    tile_height, tile_width = tiles.shape[1:]
+    sheet = np.zeros((rows * tile_height, columns * tile_width), dtype=np.uint8)
+    for offset, tile in enumerate(tiles):
+        row, column = divmod(offset, columns)
+        sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width] = tile
+    temp_path = f"{path}.tmp"
+    # Pillow releases the GIL while compressing, so sheets are encoded in parallel.
+    Image.fromarray(sheet, mode='L').save(temp_path, format='PNG', compress_level=compress_level)
+    os.replace(temp_path, path)
+    return path
+
+
+def render_slice_atlases(volume, output_folder, name_prefix, workers=None,
+                         max_atlas_pixels=4096, compress_level=1):
+    """
+    Renders every axial, coronal and sagittal slice of `volume` into grayscale PNG
+    sprite atlases, `<name_prefix>_<orientation>_<n>.png`, and writes
+    `<name_prefix>_atlas.json` describing them. Returns that index.
+
+    Each orientation is normalized in one vectorized pass (see normalize_orientation)
+    and split into sheets of at most max_atlas_pixels a side, which are encoded on
+    `workers` threads. Slice i of an orientation is in sheet i // slices_per_atlas,
+    at tile offset i % slices_per_atlas, i.e. column offset % columns and row
+    offset // columns; the index also lists [sheet, x, y] for every slice.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or min(8, os.cpu_count() or 1)
+    index = {'version': ATLAS_INDEX_VERSION, 'shape': list(volume.shape), 'orientations': {}}
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='atlas') as pool:
+        futures = []
+        for orientation, axis in ORIENTATION_AXES.items():
+            tiles = normalize_orientation(volume, axis)
+            num_slices, tile_height, tile_width = tiles.shape
+            columns, slices_per_atlas = atlas_layout(num_slices, tile_height, tile_width, max_atlas_pixels)
+
+            atlases = []
+            for sheet, start in enumerate(range(0, num_slices, slices_per_atlas)):
+                filename = f"{name_prefix}_{orientation}_{sheet}.png"
+                atlases.append(filename)
+                futures.append(pool.submit(
+                    _write_atlas, tiles[start:start + slices_per_atlas], columns,
+                    os.path.join(output_folder, filename), compress_level,
+                ))
+
+            slices = []
+            for slice_index in range(num_slices):
+                sheet, offset = divmod(slice_index, slices_per_atlas)
+                row, column = divmod(offset, columns)
+                slices.append([sheet, column * tile_width, row * tile_height])
+            index['orientations'][orientation] = {
+                'count': num_slices,
+                'tile_width': tile_width,
+                'tile_height': tile_height,
+                'columns': columns,
+                'slices_per_atlas': slices_per_atlas,
+                'atlases': atlases,
+                'slices': slices,
+            }
+        for future in futures:
+            future.result()
+
+    index_path = os.path.join(output_folder, f"{name_prefix}_atlas.json")
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path + '.tmp', index_path)
+    return index
@@ -0,0 +1,199 @@
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Binary slice payload: MAGIC, a little-endian uint32 header length, the JSON header
+# padded with spaces so the pixels start at a multiple of 8 bytes (a typed array can
+# view them in place), then the pixels in C order.
+SLICE_PAYLOAD_MAGIC = b'DSLC'
+SLICE_PAYLOAD_VERSION = 1
+SLICE_PAYLOAD_CONTENT_TYPE = 'application/octet-stream'
+SLICE_PAYLOAD_MAX_SLICES = 64
+PAYLOAD_CHUNK_BYTES = 1024 * 1024
+_PREFIX_BYTES = len(SLICE_PAYLOAD_MAGIC) + 4
+ORIENTATION_AXES = {'axial': 0, 'coronal': 1, 'sagittal': 2}
+
+# Rendered slice batch: SLICE_BATCH_MAGIC, a uint32 header length and a JSON header,
+# then one record per slice in index order: uint32 slice index, uint32 byte length and
+# the encoded image. All integers are little endian.
+SLICE_BATCH_MAGIC = b'DSLB'
+SLICE_BATCH_VERSION = 1
+SLICE_BATCH_MAX_SLICES = 128
+
+
+def slice_range_pixels(pixels, view_orientation, first_index, count):
+    """
+    `count` consecutive slices of `pixels` (slices, rows, cols) along an orientation,
+    stacked as (count, height, width). Axial ranges are views of the volume itself,
+    so a memory-mapped volume store is never copied; coronal and sagittal ranges
+    have to be gathered into a new contiguous array.
+    Raises ValueError for an unknown orientation or a range outside the volume.
+    """
+    if view_orientation not in ORIENTATION_AXES:
+        raise ValueError(f"Unknown view_orientation '{view_orientation}'. Must be 'axial', 'coronal', or 'sagittal'.")
+    axis = ORIENTATION_AXES[view_orientation]
+    if count < 1 or first_index < 0 or first_index + count > pixels.shape[axis]:
+        raise ValueError(
+            f"Slices {first_index}-{first_index + count - 1} are out of bounds for {pixels.shape[axis]} {view_orientation} slices."
+        )
+    if axis == 0:
+        return pixels[first_index:first_index + count]
+    return np.ascontiguousarray(np.moveaxis(pixels, axis, 0)[first_index:first_index + count])
+
+
+def slice_indices(size, start, stop=None, step=1, max_slices=SLICE_BATCH_MAX_SLICES):
+    """
+    The slice indices start, start+step, ... before `stop` (at most `max_slices` of
+    them), clipped to the `size` slices of an orientation. A negative step scrolls
+    backwards. The bounds come from the query string, so they are clamped to the
+    volume before the range is built: the work never depends on how far out they are.
+    Raises ValueError when the range holds no slice.
+    """
+    if step == 0:
+        raise ValueError("step must not be 0.")
+    if step > 0:
+        stop = size if stop is None else min(stop, size)
+        if start < 0:
+            # Skip ahead to the first index of the sequence inside the volume.
+            start += -(start // step) * step
+        indices = range(start, min(stop, start + max_slices * step), step)
+    else:
+        stop = -1 if stop is None else max(stop, -1)
+        if start > size - 1:
+            start -= -((size - 1 - start) // -step) * -step
+        indices = range(start, max(stop, start + max_slices * step), step)
+    indices = list(indices)
+    if not indices:
+        raise ValueError(f"No slices in range({start}, {stop}, {step}) for {size} slices.")
+    return indices
+
+
+def stacked_slices(pixels, view_orientation, indices):
+    """The slices at `indices` along an orientation, gathered into one (len(indices), height, width) array."""
+    if view_orientation not in ORIENTATION_AXES:
+        raise ValueError(f"Unknown view_orientation '{view_orientation}'. Must be 'axial', 'coronal', or 'sagittal'.")
+    axis = ORIENTATION_AXES[view_orientation]
+    return np.moveaxis(np.take(pixels, indices, axis=axis), axis, 0)
+
+
+def _rescale_header(series_volume, view_orientation, first_index, count):
+    # Axial slices each have their own rescale values. A coronal or sagittal slice crosses
+    # every axial slice, so its rows use the values of the whole volume, one per row.
+    if view_orientation == 'axial':
+        slopes = series_volume.rescale_slopes[first_index:first_index + count]
+        intercepts = series_volume.rescale_intercepts[first_index:first_index + count]
+    else:
+        slopes, intercepts = series_volume.rescale_slopes, series_volume.rescale_intercepts
+    if np.all(slopes == slopes[0]) and np.all(intercepts == intercepts[0]):
+        return {'rescale_slope': float(slopes[0]), 'rescale_intercept': float(intercepts[0])}
+    return {
+        'rescale_slope': None,
+        'rescale_intercept': None,
+        'rescale_slopes': [float(value) for value in slopes],
+        'rescale_intercepts': [float(value) for value in intercepts],
+    }
+
+
+def slice_payload_header(series_volume, view_orientation, first_index, slices):
+    """
+    The header bytes (magic, length and padded JSON) for `slices` as returned by
+    slice_range_pixels. The JSON gives shape, dtype (a numpy dtype string such as
+    '<i2'), the orientation and first slice index, the rescale slope and intercept
+    (or per-row lists when they differ, see _rescale_header), pixel spacing and the
+    series' default window.
+    """
+    spacing = series_volume.spacing  # (x, y, z) = (col, row, slice)
+    pixel_spacing = {
+        'axial': [spacing[1], spacing[0]],
+        'coronal': [spacing[2], spacing[0]],
+        'sagittal': [spacing[2], spacing[1]],
+    }[view_orientation]
+    header = {
+        'version': SLICE_PAYLOAD_VERSION,
+        'view_type': view_orientation,
+        'first_index': first_index,
+        'shape': list(slices.shape),
+        'dtype': slices.dtype.str,
+        'pixel_spacing': [float(value) for value in pixel_spacing],
+        'window_center': float(series_volume.window_centers[0]),
+        'window_width': float(series_volume.window_widths[0]),
+    }
+    header.update(_rescale_header(series_volume, view_orientation, first_index, slices.shape[0]))
+    header_json = json.dumps(header, separators=(',', ':')).encode()
+    header_json += b' ' * (-(_PREFIX_BYTES + len(header_json)) % 8)
+    return SLICE_PAYLOAD_MAGIC + struct.pack('<I', len(header_json)) + header_json
+
+
+def iter_slice_payload(header_bytes, slices, compress=False, compress_level=1):
+    """
+    Yields the payload in chunks: the header, then memoryviews of the pixel bytes,
+    so nothing is copied here. With `compress`, the chunks are gzip-compressed
+    instead (sent with Content-Encoding: gzip, which browsers inflate by themselves).
+    """
+    data = memoryview(np.ascontiguousarray(slices)).cast('B')
+    chunks = [header_bytes] + [data[start:start + PAYLOAD_CHUNK_BYTES] for start in range(0, len(data), PAYLOAD_CHUNK_BYTES)]
+    if not compress:
+        yield from chunks
+        return
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_slice_payload(payload):
+    """(header dict, pixels array) from a complete payload; the array is a view of `payload`."""
+    if payload[:len(SLICE_PAYLOAD_MAGIC)] != SLICE_PAYLOAD_MAGIC:
+        raise ValueError("Not a slice payload.")
+    (header_length,) = struct.unpack_from('<I', payload, len(SLICE_PAYLOAD_MAGIC))
+    header = json.loads(bytes(payload[_PREFIX_BYTES:_PREFIX_BYTES + header_length]))
+    pixels = np.frombuffer(payload, dtype=np.dtype(header['dtype']), offset=_PREFIX_BYTES + header_length)
+    return header, pixels.reshape(header['shape'])
+
+
+def iter_slice_batch(header, windowed_slices, indices, encode, workers=None):
+    """
+    Yields a rendered slice batch (see SLICE_BATCH_MAGIC): the header, then each
+    slice of `windowed_slices` encoded with `encode(slice) -> bytes`. Slices are
+    encoded on `workers` threads (Pillow releases the GIL while compressing) and
+    each record is sent as soon as it and every slice before it are done, so the
+    client can show the first slices while the rest are still being encoded.
+    """
+    header_json = json.dumps(dict(header, version=SLICE_BATCH_VERSION, indices=list(indices))).encode()
+    yield SLICE_BATCH_MAGIC + struct.pack('<I', len(header_json)) + header_json
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slice-batch') as pool:
+        futures = [pool.submit(encode, windowed_slice) for windowed_slice in windowed_slices]
+        try:
+            for index, future in zip(indices, futures):
+                image_bytes = future.result()
+                yield struct.pack('<II', index, len(image_bytes)) + image_bytes
+        finally:
+            # The client went away: do not encode the slices nobody will read.
+            for future in futures:
+                future.cancel()
+
+
+def parse_slice_batch(payload):
+    """(header dict, {slice index: image bytes}) from a complete slice batch."""
+    if payload[:len(SLICE_BATCH_MAGIC)] != SLICE_BATCH_MAGIC:
+        raise ValueError("Not a slice batch.")
+    (header_length,) = struct.unpack_from('<I', payload, len(SLICE_BATCH_MAGIC))
+    offset = len(SLICE_BATCH_MAGIC) + 4
+    header = json.loads(bytes(payload[offset:offset + header_length]))
+    offset += header_length
+    images = {}
+    while offset < len(payload):
+        index, length = struct.unpack_from('<II', payload, offset)
+        offset += 8
+        images[index] = bytes(payload[offset:offset + length])
+        offset += length
+    return header, images
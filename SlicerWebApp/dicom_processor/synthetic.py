@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+
+def _phantom_slice(rows, cols, slice_index, num_slices, rng):
+    # A soft-tissue ellipse with a brighter "bone" ring and some noise, in stored
+    # values (HU + 1024), so windowing and resizing see realistic data.
+    y, x = np.mgrid[0:rows, 0:cols]
+    cy, cx = rows / 2.0, cols / 2.0
+    scale = 0.8 + 0.2 * np.sin(np.pi * slice_index / max(num_slices - 1, 1))
+    radius = ((y - cy) / (0.42 * rows * scale)) ** 2 + ((x - cx) / (0.35 * cols * scale)) ** 2
+    image = np.full((rows, cols), 24, dtype=np.int16)          # air, about -1000 HU
+    image[radius < 1.0] = 1064                                  # soft tissue, about 40 HU
+    image[(radius >= 0.85) & (radius < 1.0)] = 1724             # bone, about 700 HU
+    image += rng.integers(-20, 20, size=(rows, cols), dtype=np.int16)
+    return image
+
+
+def make_synthetic_volume(num_slices=64, rows=512, cols=512, seed=0):
+    """The same phantom write_synthetic_series stores, as an in-memory int16 volume."""
+    rng = np.random.default_rng(seed)
+    return np.stack([_phantom_slice(rows, cols, index, num_slices, rng) for index in range(num_slices)], axis=0)
+
+
+def write_synthetic_series(directory, num_slices=64, rows=512, cols=512,
+                           transfer_syntax=ExplicitVRLittleEndian, seed=0):
+    """
+    Writes a synthetic single-series CT study to `directory` as IM0001.dcm ... and
+    returns the list of file paths. `transfer_syntax` can be any syntax pydicom
+    can encode, e.g. pydicom.uid.RLELossless for a compressed series.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study_uid, series_uid = generate_uid(), generate_uid()
+    slice_thickness = 2.5
+
+    paths = []
+    for index in range(num_slices):
+        sop_instance_uid = generate_uid()
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientID = 'SYNTHETIC'
+        ds.PatientAge = '060Y'
+        ds.PatientSex = 'M'
+        ds.Modality = 'CT'
+        ds.SeriesDescription = f'Synthetic {num_slices}x{rows}x{cols}'
+        ds.InstanceNumber = index + 1
+        ds.ImagePositionPatient = [0.0, 0.0, index * slice_thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = slice_thickness
+        ds.Rows = rows
+        ds.Columns = cols
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.WindowCenter = 40
+        ds.WindowWidth = 400
+        ds.PixelData = _phantom_slice(rows, cols, index, num_slices, rng).tobytes()
+
+        if transfer_syntax != ExplicitVRLittleEndian:
+            ds.compress(transfer_syntax)
+
+        path = os.path.join(directory, f'IM{index + 1:04d}.dcm')
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
@@ -1,3 +1,1049 @@
-from django.test import TestCase
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+import tensorflow as tf
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import SkipFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from pydicom.dataset import Dataset
+from pydicom.uid import RLELossless
+from PIL import Image
+from skimage.transform import resize
+
+from . import instance_store, jobs, model_registry, render_cache, volume_cache
+from .ingest import SeriesVolume, SliceHeader, decode_dicom_files, sort_slice_headers
+from .inference_dispatcher import InferenceDispatcher
+from .instance_store import InstanceStore
+from .loadtest import Sample, saturation_point, summarize_samples
+from .media_serving import media_url, parse_byte_range, write_gzip_sibling
+from .metrics import STAGE_SECONDS, MetricsRegistry, get_metrics, render_component_stats, timed_stage
+from .model_registry import (
+    GRAD_CAM_LAYER_NAME, MODEL_INPUT_SHAPE, ModelRegistry, build_gradcam_function, build_predict_function,
+    model_identifier, warm_up_model_registry,
+)
+from .models import DicomSeries, ProcessingJob, ProcessingResult
+from .resample import separable_resize
+from .result_cache import InferenceResultCache
+from .slice_atlas import render_slice_atlases
+from .slice_payload import (
+    iter_slice_batch, iter_slice_payload, parse_slice_batch, parse_slice_payload, slice_indices, slice_payload_header,
+    slice_range_pixels, stacked_slices,
+)
+from .synthetic import write_synthetic_series
+from .upload_handlers import DicomStreamingUploadHandler
+from .utils import (
+    _sorted_dicom_paths, compute_gradcam_batch, generate_middle_views, nrrd_level_path, prepare_model_input,
+    read_nrrd_levels, write_series_volume_nrrd_pyramid,
+)
+from .volume_store import load_series_volume, open_volume_store, write_volume_store
+from .windowing import WINDOW_PRESETS, apply_window_lut, apply_windowing, window_slices
+
+def _small_grad_model(seed=0):
+    """A tiny stand-in for the checkpoint with the same input, Grad-CAM layer name and 2-class output."""
+    tf.keras.utils.set_random_seed(seed)
+    inputs = tf.keras.Input(MODEL_INPUT_SHAPE + (1,))
+    x = tf.keras.layers.Conv3D(6, 3, strides=2, padding='same')(inputs)
+    x = tf.keras.layers.Activation('relu', name=GRAD_CAM_LAYER_NAME)(x)
+    x = tf.keras.layers.GlobalAveragePooling3D()(x)
+    outputs = tf.keras.layers.Dense(2, activation='softmax')(x)
+    model = tf.keras.Model(inputs, outputs)
+    return tf.keras.models.Model(model.input, [model.get_layer(GRAD_CAM_LAYER_NAME).output, model.output])
+
+
+def _loop_gradcam(grad_model, input_batch):
+    """The eager, channel-by-channel Grad-CAM that generate_heatmap used before it was compiled."""
+    with tf.GradientTape() as tape:
+        conv_output, preds = grad_model(input_batch)
+        pred_indices = tf.argmax(preds, axis=1)
+        class_channel_for_gradients = tf.gather(preds, pred_indices, axis=1, batch_dims=1)
+    grads = tape.gradient(class_channel_for_gradients, conv_output)
+    pooled_grads_batch = tf.reduce_mean(grads, axis=(1, 2, 3))
+    cams = []
+    for sample_index in range(len(preds)):
+        heatmap_conv_output = conv_output[sample_index]
+        cam = np.zeros(heatmap_conv_output.shape[0:3], dtype=np.float32)
+        for i, w in enumerate(pooled_grads_batch[sample_index]):
+            cam += w * heatmap_conv_output[:, :, :, i]
+        cam = np.maximum(cam, 0)
+        if np.max(cam) > 0:
+            cam = cam / np.max(cam)
+        cams.append(cam)
+    return preds.numpy(), cams
+
+
+
+def _stage_count(stage):
+    histograms, _ = get_metrics().snapshot()
+    histogram = histograms.get((STAGE_SECONDS, (('stage', stage),)))
+    return histogram.count if histogram else 0
+
+
+class CompiledGradCamTests(SimpleTestCase):
+
+    def setUp(self):
+        self.grad_model = _small_grad_model()
+        self.gradcam_fn = build_gradcam_function(self.grad_model)
+        rng = np.random.default_rng(0)
+        self.input_batch = (rng.random((3,) + MODEL_INPUT_SHAPE + (1,)) * 255).astype(np.float32)
+
+    def test_matches_loop_implementation(self):
+        expected_predictions, expected_cams = _loop_gradcam(self.grad_model, self.input_batch)
+        predictions, cams = compute_gradcam_batch(self.gradcam_fn, self.input_batch)
+
+        np.testing.assert_allclose(predictions, expected_predictions, rtol=1e-6, atol=1e-7)
+        self.assertEqual(len(cams), len(expected_cams))
+        for cam, expected_cam in zip(cams, expected_cams):
+            self.assertEqual(cam.shape, expected_cam.shape)
+            np.testing.assert_allclose(cam, expected_cam, rtol=1e-4, atol=1e-5)
+
+    def test_batch_size_does_not_change_results(self):
+        batch_predictions, batch_cams = compute_gradcam_batch(self.gradcam_fn, self.input_batch)
+        for index in range(len(self.input_batch)):
+            predictions, cams = compute_gradcam_batch(self.gradcam_fn, self.input_batch[index:index + 1])
+            np.testing.assert_allclose(predictions[0], batch_predictions[index], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(cams[0], batch_cams[index], rtol=1e-4, atol=1e-5)
+
+    def test_model_passes_are_timed_separately(self):
+        stages = ('forward_pass', 'gradient_pass', 'cam_build')
+        before = [_stage_count(stage) for stage in stages]
+        compute_gradcam_batch(self.gradcam_fn, self.input_batch)
+        self.assertEqual([_stage_count(stage) - count for stage, count in zip(stages, before)], [1, 1, 1])
+
+
+class ModelRegistryTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.model_path = os.path.join(cls.directory, 'checkpoint', 'model.keras')
+        os.makedirs(os.path.dirname(cls.model_path))
+        grad_model = _small_grad_model()
+        tf.keras.Model(grad_model.input, grad_model.outputs[1]).save(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.registry = ModelRegistry(self.model_path)
+        model_registry._registry = self.registry
+        self.addCleanup(setattr, model_registry, '_registry', None)
+
+    def test_model_is_loaded_once_across_threads(self):
+        barrier = threading.Barrier(6)
+
+        def load():
+            barrier.wait()
+            return self.registry.ensure_loaded()
+
+        with mock.patch.object(model_registry, 'load_model', wraps=model_registry.load_model) as load_model:
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                loaded = list(executor.map(lambda _: load(), range(6)))
+        self.assertEqual(loaded, [True] * 6)
+        self.assertEqual(load_model.call_count, 1)
+
+        stats = self.registry.stats()
+        self.assertTrue(stats['loaded'])
+        self.assertTrue(stats['grad_cam_available'])
+        self.assertIsNotNone(stats['load_seconds'])
+        self.assertIsNone(stats['warmup_seconds'])
+        self.assertEqual(self.registry.model_id, model_identifier(self.model_path))
+
+    def test_missing_checkpoint_is_not_loaded(self):
+        registry = ModelRegistry(os.path.join(self.directory, 'missing.keras'))
+        self.assertFalse(registry.ensure_loaded())
+        self.assertFalse(registry.warm_up())
+        self.assertEqual((registry.stats()['loaded'], registry.model_id), (False, None))
+
+    def test_warm_up_traces_both_functions_once(self):
+        before = _stage_count('model_warmup')
+        self.assertTrue(self.registry.warm_up())
+        self.assertTrue(self.registry.warm_up())
+        self.assertEqual(_stage_count('model_warmup') - before, 1)
+        self.assertIsNotNone(self.registry.stats()['warmup_seconds'])
+
+    def test_startup_warm_up_runs_in_the_background(self):
+        with override_settings(MODEL_WARMUP_ON_STARTUP=False):
+            self.assertIsNone(warm_up_model_registry())
+        self.assertFalse(self.registry.is_loaded)
+
+        thread = warm_up_model_registry()
+        self.assertEqual(thread.name, 'model-warmup')
+        thread.join(timeout=120)
+        self.assertIsNotNone(self.registry.warmup_seconds)
+
+        model_registry._registry = registry = ModelRegistry(self.model_path)
+        with override_settings(MODEL_WARMUP_IN_BACKGROUND=False):
+            self.assertIsNone(warm_up_model_registry())
+        self.assertIsNotNone(registry.warmup_seconds)
+
+
+class InferenceDispatcherTests(SimpleTestCase):
+
+    def test_concurrent_requests_are_batched(self):
+        gradcam_fn = build_gradcam_function(_small_grad_model())
+        # A long wait window, so each batch only closes once it is full.
+        dispatcher = InferenceDispatcher(lambda: gradcam_fn, max_batch_size=4, max_wait_seconds=10)
+        rng = np.random.default_rng(2)
+        volumes = [(rng.random(MODEL_INPUT_SHAPE) * 255).astype(np.float32) for _ in range(8)]
+
+        with ThreadPoolExecutor(max_workers=len(volumes)) as executor:
+            futures = [executor.submit(lambda volume: dispatcher.submit(volume).result(timeout=60), volume)
+                       for volume in volumes]
+            results = [future.result() for future in futures]
+
+        for volume, (prediction_row, cam) in zip(volumes, results):
+            predictions, cams = compute_gradcam_batch(gradcam_fn, volume[np.newaxis, ..., np.newaxis])
+            np.testing.assert_allclose(prediction_row, predictions[0], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(cam, cams[0], rtol=1e-4, atol=1e-5)
+        stats = dispatcher.stats()
+        self.assertEqual(stats['batch_size_counts'], {4: 2})
+        self.assertEqual((stats['batches_run'], stats['requests_served'], stats['requests_failed']), (2, 8, 0))
+        self.assertTrue(1 <= stats['max_queue_depth'] <= len(volumes))
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_a_failed_batch_fails_every_request_in_it(self):
+        def failing_gradcam_fn(input_batch):
+            raise RuntimeError("out of memory")
+
+        dispatcher = InferenceDispatcher(lambda: failing_gradcam_fn, max_batch_size=3, max_wait_seconds=10)
+        futures = [dispatcher.submit(np.zeros(MODEL_INPUT_SHAPE, dtype=np.float32)) for _ in range(3)]
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=60), RuntimeError)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['batches_run'], stats['requests_failed']), (0, 3))
+
+    def test_score_only_requests_match_gradcam_scores_without_a_heatmap(self):
+        grad_model = _small_grad_model()
+        predict_model = tf.keras.Model(grad_model.input, grad_model.outputs[1])
+        dispatcher = InferenceDispatcher(lambda: build_gradcam_function(grad_model), max_wait_seconds=0,
+                                         predict_fn_getter=lambda: build_predict_function(predict_model))
+        volume = (np.random.default_rng(1).random(MODEL_INPUT_SHAPE) * 255).astype(np.float32)
+
+        full_prediction, full_cam = dispatcher.submit(volume, with_heatmap=True).result(timeout=60)
+        stages = ('forward_pass', 'gradient_pass', 'cam_build')
+        before = [_stage_count(stage) for stage in stages]
+        score_prediction, score_cam = dispatcher.submit(volume, with_heatmap=False).result(timeout=60)
+
+        self.assertIsNotNone(full_cam)
+        self.assertIsNone(score_cam)
+        np.testing.assert_allclose(score_prediction, full_prediction, rtol=1e-6, atol=1e-7)
+        self.assertEqual([_stage_count(stage) - count for stage, count in zip(stages, before)], [1, 0, 0])
+        self.assertEqual(dispatcher.stats()['score_only_requests_served'], 1)
+
+
+class ParallelDecodeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.series_directory = os.path.join(self.root, 'series')
+        write_synthetic_series(self.series_directory, num_slices=12, rows=24, cols=20, transfer_syntax=RLELossless)
+
+    def test_parallel_decode_matches_serial(self):
+        file_paths = _sorted_dicom_paths(self.series_directory)
+        expected, expected_headers = decode_dicom_files(file_paths, workers=1)
+        for backend in ('thread', 'process'):
+            pixels, headers = decode_dicom_files(file_paths, workers=4, backend=backend)
+            np.testing.assert_array_equal(pixels, expected)
+            self.assertEqual([header.InstanceNumber for header in headers],
+                             [header.InstanceNumber for header in expected_headers])
+
+    def test_parallel_middle_views_match_serial(self):
+        outputs = {}
+        for workers in (1, 4):
+            output_folder = os.path.join(self.root, f'views_{workers}')
+            with override_settings(DICOM_DECODE_WORKERS=workers):
+                paths = generate_middle_views(self.series_directory, output_folder, 1, 2)
+            outputs[workers] = {}
+            for name, url in paths.items():
+                with open(os.path.join(output_folder, os.path.basename(url)), 'rb') as view_file:
+                    outputs[workers][name] = view_file.read()
+        self.assertEqual(outputs[4], outputs[1])
+
+
+class SeparableResizeTests(SimpleTestCase):
+
+    def test_matches_skimage_resize(self):
+        rng = np.random.default_rng(1)
+        # Downsampling on two axes and upsampling on the third, with uneven factors.
+        volume = rng.random((37, 130, 101))
+        expected = resize(volume, (25, 90, 90), anti_aliasing=True)
+        resized = separable_resize(volume, (25, 90, 90), workers=2, chunk_slices=8)
+        self.assertEqual(resized.dtype, np.float32)
+        np.testing.assert_allclose(resized, expected, atol=1e-5)
+
+    def test_model_input_matches_skimage_path(self):
+        rng = np.random.default_rng(2)
+        volume = rng.integers(0, 256, size=(31, 128, 112), dtype=np.uint8)
+        with override_settings(MODEL_INPUT_RESAMPLER='skimage'):
+            expected, expected_shape = prepare_model_input(volume)
+        with override_settings(MODEL_INPUT_RESAMPLER='separable'):
+            resized, transposed_shape = prepare_model_input(volume)
+        self.assertEqual(transposed_shape, expected_shape)
+        self.assertEqual(resized.shape, MODEL_INPUT_SHAPE)
+        np.testing.assert_allclose(resized, expected, atol=1e-5)
+
+
+class WindowLutTests(SimpleTestCase):
+
+    def test_matches_float_windowing(self):
+        rng = np.random.default_rng(3)
+        for dtype in (np.int16, np.uint16, np.uint8):
+            info = np.iinfo(dtype)
+            pixels = rng.integers(info.min, info.max, size=(4, 40, 36), endpoint=True).astype(dtype)
+            for window_center, window_width in list(WINDOW_PRESETS.values()) + [(np.float32(40.3), np.float32(399.9))]:
+                expected = apply_windowing(pixels.astype(np.float32), window_center, window_width)
+                np.testing.assert_array_equal(apply_window_lut(pixels, window_center, window_width), expected)
+                # A non-contiguous batch of slices, as the coronal and sagittal views take.
+                np.testing.assert_array_equal(
+                    apply_window_lut(pixels[:, 5, :], window_center, window_width), expected[:, 5, :]
+                )
+
+    def test_per_slice_rescale_and_window(self):
+        rng = np.random.default_rng(4)
+        pixels = rng.integers(0, 4096, size=(3, 16, 16)).astype(np.int16)
+        centers = np.array([40, 40, -600], dtype=np.float32)
+        widths = np.array([400, 400, 1500], dtype=np.float32)
+        slopes = np.array([1, 1, 0.5], dtype=np.float32)
+        intercepts = np.array([-1024, -1024, -1000], dtype=np.float32)
+        windowed = window_slices(pixels, centers, widths, slopes, intercepts)
+        for index in range(3):
+            rescaled = pixels[index].astype(np.float32) * slopes[index] + intercepts[index]
+            np.testing.assert_array_equal(windowed[index], apply_windowing(rescaled, centers[index], widths[index]))
+
+
+class SlicePayloadTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        pixels = rng.integers(-1024, 3000, size=(6, 20, 24)).astype(np.int16)
+        self.series_volume = SeriesVolume(
+            pixels, (0.7, 0.8, 2.5), (0, 0, 0), (1, 0, 0, 0, 1, 0, 0, 0, 1),
+            [1.0] * 6, [-1024.0] * 5 + [-1000.0], [40.0] * 6, [400.0] * 6,
+        )
+
+    def _roundtrip(self, view_type, first_index, count, compress=False):
+        slices = slice_range_pixels(self.series_volume.pixels, view_type, first_index, count)
+        header_bytes = slice_payload_header(self.series_volume, view_type, first_index, slices)
+        payload = b''.join(bytes(chunk) for chunk in iter_slice_payload(header_bytes, slices, compress=compress))
+        return parse_slice_payload(gzip.decompress(payload) if compress else payload)
+
+    def test_axial_range_roundtrip(self):
+        header, pixels = self._roundtrip('axial', 1, 3)
+        np.testing.assert_array_equal(pixels, self.series_volume.pixels[1:4])
+        self.assertEqual(header['dtype'], '<i2')
+        self.assertEqual(header['rescale_intercept'], -1024.0)
+        # The axial range is a view of the volume, not a copy.
+        self.assertTrue(np.shares_memory(slice_range_pixels(self.series_volume.pixels, 'axial', 1, 3),
+                                         self.series_volume.pixels))
+
+    def test_sagittal_range_with_per_slice_rescale_compressed(self):
+        header, pixels = self._roundtrip('sagittal', 20, 4, compress=True)
+        np.testing.assert_array_equal(pixels, np.moveaxis(self.series_volume.pixels, 2, 0)[20:24])
+        self.assertIsNone(header['rescale_intercept'])
+        self.assertEqual(header['rescale_intercepts'], [-1024.0] * 5 + [-1000.0])
+
+    def test_out_of_bounds_range(self):
+        with self.assertRaises(ValueError):
+            slice_range_pixels(self.series_volume.pixels, 'axial', 5, 2)
+
+    def test_slice_batch_keeps_index_order(self):
+        indices = slice_indices(24, 22, 0, -5)
+        self.assertEqual(indices, [22, 17, 12, 7, 2])
+        slices = stacked_slices(self.series_volume.pixels, 'sagittal', indices)
+        payload = b''.join(iter_slice_batch({'view_type': 'sagittal'}, slices, indices, lambda image: image.tobytes(), workers=3))
+        header, images = parse_slice_batch(payload)
+        self.assertEqual(header['indices'], indices)
+        for index in indices:
+            self.assertEqual(images[index], self.series_volume.pixels[:, :, index].tobytes())
+
+    def test_slice_indices_clamps_bounds_before_building_the_range(self):
+        started = time.perf_counter()
+        self.assertEqual(slice_indices(24, 0, 10**8), list(range(24)))
+        self.assertEqual(slice_indices(24, -10**8, 10**8, 10**7 + 1), [10])
+        self.assertEqual(slice_indices(24, 10**8, -10**8, -1, max_slices=3), [23, 22, 21])
+        self.assertLess(time.perf_counter() - started, 0.1)
+        with self.assertRaises(ValueError):
+            slice_indices(24, 0, 10, 0)
+        with self.assertRaises(ValueError):
+            slice_indices(24, 30, 40)
+
+
+class LoadTestSummaryTests(SimpleTestCase):
+
+    def test_percentiles_and_error_rate_per_endpoint(self):
+        samples = [Sample('get_slice_url_ajax', index * 0.1, (index + 1) / 1000, 200, None) for index in range(100)]
+        samples += [Sample('get_nrrd_url', 0.0, 0.5, 404, 'HTTP 404'), Sample('get_nrrd_url', 1.0, 0.1, 200, None)]
+        summary = summarize_samples(samples, 10.0)
+        self.assertAlmostEqual(summary['get_slice_url_ajax']['p50_ms'], 50.5)
+        self.assertAlmostEqual(summary['get_slice_url_ajax']['p99_ms'], 99.01)
+        self.assertEqual(summary['get_nrrd_url']['error_rate'], 0.5)
+        self.assertEqual(summary['get_nrrd_url']['error_kinds'], {'HTTP 404': 1})
+        self.assertEqual(summary['total']['requests'], 102)
+        self.assertAlmostEqual(summary['total']['throughput_rps'], 10.2)
+
+    def test_saturation_point(self):
+        def level(sessions, throughput, error_rate=0.0):
+            return {'sessions': sessions, 'endpoints': {'total': {'throughput_rps': throughput, 'error_rate': error_rate}}}
+        self.assertEqual(saturation_point([level(1, 10), level(8, 70), level(32, 72)]), 8)
+        self.assertEqual(saturation_point([level(1, 10), level(8, 70), level(32, 250, error_rate=0.05)]), 32)
+        self.assertIsNone(saturation_point([level(1, 10), level(8, 70)]))
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_histogram_exposition(self):
+        metrics = MetricsRegistry(buckets=(0.01, 0.1, 1.0))
+        for seconds in (0.005, 0.01, 0.05, 2.0):
+            metrics.observe('stage_seconds', seconds, stage='resize')
+        metrics.increment('responses_total', endpoint='metrics', status=200)
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE stage_seconds histogram', lines)
+        self.assertIn('stage_seconds_bucket{stage="resize",le="0.01"} 2', lines)
+        self.assertIn('stage_seconds_bucket{stage="resize",le="1.0"} 3', lines)
+        self.assertIn('stage_seconds_bucket{stage="resize",le="+Inf"} 4', lines)
+        self.assertIn('stage_seconds_count{stage="resize"} 4', lines)
+        self.assertIn('responses_total{endpoint="metrics",status="200"} 1', lines)
+
+    def test_component_stats_and_failed_stage(self):
+        lines = render_component_stats({'dispatcher': ({'queue_depth': 2, 'total_batch_seconds': 1.5, 'loaded': True,
+                                                        'batch_size_counts': {1: 3}}, {'total_batch_seconds'})})
+        self.assertIn('dicom_processor_dispatcher_queue_depth 2', lines)
+        self.assertIn('dicom_processor_dispatcher_batch_seconds_total 1.5', lines)
+        self.assertIn('dicom_processor_dispatcher_loaded 1', lines)
+        self.assertFalse(any('batch_size_counts' in line for line in lines))
+
+        with self.assertRaises(ValueError):
+            with timed_stage('test_failing_stage'):
+                raise ValueError("boom")
+        histograms, _ = get_metrics().snapshot()
+        self.assertEqual(histograms[(STAGE_SECONDS, (('stage', 'test_failing_stage'),))].count, 1)
+
+
+
+@override_settings(METRICS_INSTANCE_STORE_STATS=False)
+class MetricsViewTests(TestCase):
+
+    def test_metrics_need_staff_or_token(self):
+        # The test client connects from 127.0.0.1, as every request does behind a proxy.
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN='scrape-token'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'dicom_processor_volume_cache_hits_total', response.content)
+
+        self.client.force_login(User.objects.create_user('staff', password='pw', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class MediaTestCase(TestCase):
+    """Tests against a temporary MEDIA_ROOT holding one small synthetic series of `owner`."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        # The render cache is created under MEDIA_ROOT on first use.
+        render_cache._render_cache = None
+        self.addCleanup(setattr, render_cache, '_render_cache', None)
+        volume_cache._volume_cache = None
+        self.addCleanup(setattr, volume_cache, '_volume_cache', None)
+        instance_store._instance_store = None
+        self.addCleanup(setattr, instance_store, '_instance_store', None)
+
+        self.owner = User.objects.create_user('owner', password='pw')
+        series_directory = os.path.join(self.media_root, 'dicom_files', 'series')
+        write_synthetic_series(series_directory, num_slices=6, rows=32, cols=32)
+        self.series = DicomSeries.objects.create(user=self.owner, name='series', file_path=series_directory)
+        self.client.force_login(self.owner)
+
+
+class SliceCacheAccessTests(MediaTestCase):
+
+    def test_rendered_slices_are_only_served_to_the_owner(self):
+        response = self.client.get('/dicom/ajax/get_slice_url/', {'series_id': self.series.id, 'view_type': 'axial',
+                                                                   'slice_index': 2})
+        slice_url = response.json()['slice_url']
+        self.assertIn(f"/user{self.owner.id}_", slice_url)
+        self.assertEqual(self.client.get(slice_url).status_code, 200)
+
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        self.assertEqual(self.client.get(slice_url).status_code, 404)
+
+    def test_ranges_of_an_empty_file_are_not_satisfiable(self):
+        self.assertEqual(parse_byte_range('bytes=-10', 100), (90, 99))
+        with self.assertRaises(ValueError):
+            parse_byte_range('bytes=-10', 0)
+        with self.assertRaises(ValueError):
+            parse_byte_range('bytes=0-', 0)
+
+
+class MediaServingTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = bytes(range(256)) * 40
+        self.nrrd_path = os.path.join(self.media_root, 'nrrd_files', f'user{self.owner.id}_series{self.series.id}.nrrd')
+        heatmap_path = os.path.join(self.media_root, 'heatmaps', 'run', 'heatmap.nrrd')
+        for path in (self.nrrd_path, heatmap_path):
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as media_file:
+                media_file.write(self.data)
+        ProcessingResult.objects.create(dicom_series=self.series, heatmap_file_path=heatmap_path)
+        self.nrrd_url = media_url(self.nrrd_path)
+        self.heatmap_url = media_url(heatmap_path)
+
+    def _get(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.addCleanup(response.close)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_byte_ranges(self):
+        response, body = self._get(self.nrrd_url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(body, self.data[100:200])
+
+        response, body = self._get(self.nrrd_url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(response['Content-Range'], f'bytes {len(self.data) - 10}-{len(self.data) - 1}/{len(self.data)}')
+        self.assertEqual(body, self.data[-10:])
+
+        response, _ = self._get(self.nrrd_url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_if_range_only_honours_the_current_version(self):
+        etag = self._get(self.nrrd_url)[0]['ETag']
+        response, body = self._get(self.nrrd_url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        response, body = self._get(self.nrrd_url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[:10])
+
+    def test_gzip_sibling_is_sent_to_clients_that_accept_it(self):
+        write_gzip_sibling(self.nrrd_path)
+        response, body = self._get(self.nrrd_url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(body), self.data)
+
+        response, body = self._get(self.nrrd_url, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(body, self.data)
+
+        # Ranges address the plain bytes, whatever the client accepts.
+        response, body = self._get(self.nrrd_url, HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(body, self.data[:10])
+
+    def test_matching_etag_is_not_modified(self):
+        for url in (self.nrrd_url, self.heatmap_url):
+            etag = self._get(url)[0]['ETag']
+            response, body = self._get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(body, b'')
+            self.assertEqual(response['ETag'], etag)
+
+    def test_only_content_addressed_files_are_immutable(self):
+        self.assertIn('immutable', self._get(self.heatmap_url)[0]['Cache-Control'])
+        cache_control = self._get(self.nrrd_url)[0]['Cache-Control']
+        self.assertIn('no-cache', cache_control)
+        self.assertNotIn('immutable', cache_control)
+
+
+class ProcessingJobTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(jobs._inflight_job_ids.clear)
+        self.addCleanup(jobs._follow_up_job_ids.clear)
+
+    def test_enqueue_starts_one_job_per_series_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            job = jobs.enqueue_processing_job(self.series)
+            self.assertEqual(jobs.enqueue_processing_job(self.series, mode=ProcessingJob.MODE_SCORE_ONLY), job)
+            self.assertEqual(jobs.enqueue_processing_job(self.series, mode=ProcessingJob.MODE_HEATMAP), job)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual((job.state, job.mode), (ProcessingJob.STATE_QUEUED, ProcessingJob.MODE_FULL))
+
+    def test_heatmap_waits_for_a_running_score_only_job(self):
+        ProcessingResult.objects.create(dicom_series=self.series, ece_probability=0.7, non_ece_probability=0.3)
+        with self.captureOnCommitCallbacks():
+            score_job = jobs.enqueue_processing_job(self.series, mode=ProcessingJob.MODE_SCORE_ONLY)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/dicom/process/{self.series.id}/heatmap/')
+        heatmap_job = self.series.processing_jobs.get(mode=ProcessingJob.MODE_HEATMAP)
+        self.assertRedirects(response, f'/dicom/process/{self.series.id}/?job={heatmap_job.id}',
+                             fetch_redirect_response=False)
+        self.assertEqual(jobs.enqueue_processing_job(self.series, mode=ProcessingJob.MODE_SCORE_ONLY), score_job)
+        self.assertEqual(jobs.enqueue_processing_job(self.series, mode=ProcessingJob.MODE_HEATMAP), heatmap_job)
+        self.assertEqual(jobs._follow_up_job_ids, {score_job.id: [heatmap_job.id]})
+
+        # The heatmap job is started when the score-only job finishes, not before.
+        executor = mock.Mock()
+        with mock.patch.object(jobs, '_get_executor', return_value=executor), \
+                mock.patch.object(jobs, 'run_processing_pipeline'), mock.patch.object(jobs, 'connections'):
+            jobs.run_processing_job(score_job.id)
+        executor.submit.assert_called_once_with(jobs.run_processing_job, heatmap_job.id)
+        self.assertEqual(jobs._follow_up_job_ids, {})
+
+    def test_process_post_redirects_to_its_job(self):
+        with self.captureOnCommitCallbacks():
+            response = self.client.post(f'/dicom/process/{self.series.id}/', {'process_type': 'heatmap'})
+        job = self.series.processing_jobs.get()
+        self.assertEqual(job.mode, ProcessingJob.MODE_FULL)
+        self.assertRedirects(response, f'/dicom/process/{self.series.id}/?job={job.id}', fetch_redirect_response=False)
+        self.assertEqual(self.client.get(response.url).context['active_job'], job)
+
+    def test_job_status_redirects_once_the_result_is_ready(self):
+        job = ProcessingJob.objects.create(dicom_series=self.series, state=ProcessingJob.STATE_SUCCEEDED, progress=100)
+        status = self.client.get(f'/dicom/ajax/job_status/{job.id}/').json()
+        self.assertFalse(status['result_ready'])
+        ProcessingResult.objects.create(dicom_series=self.series, ece_probability=0.7, non_ece_probability=0.3)
+        status = self.client.get(f'/dicom/ajax/job_status/{job.id}/').json()
+        self.assertTrue(status['result_ready'])
+        self.assertEqual(status['redirect_url'], f'/dashboard/{self.series.id}/')
+
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        self.assertEqual(self.client.get(f'/dicom/ajax/job_status/{job.id}/').status_code, 404)
+
+    @override_settings(PROCESSING_JOB_STALE_SECONDS=60)
+    def test_jobs_that_lost_their_worker_are_failed(self):
+        orphaned = ProcessingJob.objects.create(dicom_series=self.series, state=ProcessingJob.STATE_RUNNING)
+        inflight = ProcessingJob.objects.create(dicom_series=self.series, state=ProcessingJob.STATE_RUNNING)
+        recent = ProcessingJob.objects.create(dicom_series=self.series, state=ProcessingJob.STATE_QUEUED)
+        jobs._inflight_job_ids.add(inflight.id)
+        ProcessingJob.objects.filter(id__in=[orphaned.id, inflight.id]).update(
+            updated_date=timezone.now() - timedelta(minutes=5))
+
+        status = self.client.get(f'/dicom/ajax/job_status/{orphaned.id}/').json()
+        self.assertEqual(status['state'], ProcessingJob.STATE_FAILED)
+        self.assertTrue(status['error'])
+        self.assertEqual(jobs.fail_orphaned_jobs(ProcessingJob.objects.all()), 0)
+        self.assertEqual(ProcessingJob.objects.get(id=inflight.id).state, ProcessingJob.STATE_RUNNING)
+        self.assertEqual(ProcessingJob.objects.get(id=recent.id).state, ProcessingJob.STATE_QUEUED)
+
+
+class InstanceStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store = InstanceStore(os.path.join(self.root, 'instances'))
+        source_path = write_synthetic_series(os.path.join(self.root, 'source'), num_slices=1, rows=8, cols=8)[0]
+        with open(source_path, 'rb') as source_file:
+            self.dicom_bytes = source_file.read()
+
+    def _add(self, series_name):
+        series_directory = os.path.join(self.root, series_name)
+        os.makedirs(series_directory, exist_ok=True)
+        destination_path = os.path.join(series_directory, 'IM0001.dcm')
+        entry = self.store.add_uploaded_file(SimpleUploadedFile('IM0001.dcm', self.dicom_bytes), destination_path)
+        self.store.write_manifest(series_directory, [entry])
+        return entry, series_directory
+
+    def test_duplicate_uploads_share_one_blob_until_released(self):
+        first, first_directory = self._add('first')
+        second, second_directory = self._add('second')
+        self.assertFalse(first['deduplicated'])
+        self.assertTrue(second['deduplicated'])
+        blob_path = self.store.blob_path(first['key'])
+        self.assertEqual(os.stat(blob_path).st_nlink, 3)
+        self.assertEqual(self.store.stats(), {'blobs': 1, 'bytes': len(self.dicom_bytes)})
+
+        self.assertEqual(self.store.release_series(first_directory), 0)
+        self.assertFalse(os.path.exists(first_directory))
+        self.assertEqual(os.stat(blob_path).st_nlink, 2)
+        self.assertEqual(self.store.release_series(second_directory), 1)
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertEqual(os.listdir(os.path.dirname(blob_path)), [])
+
+    def test_uploading_over_an_existing_file_keeps_the_reference_count(self):
+        entry, series_directory = self._add('series')
+        self._add('series')
+        self.assertEqual(os.stat(self.store.blob_path(entry['key'])).st_nlink, 2)
+        self.assertEqual(self.store.release_series(series_directory), 1)
+
+    def test_released_blob_is_stored_again(self):
+        entry, _ = self._add('first')
+        # Another process released the blob after this one saw it.
+        os.remove(self.store.blob_path(entry['key']))
+        second, second_directory = self._add('second')
+        self.assertFalse(second['deduplicated'])
+        with open(os.path.join(second_directory, 'IM0001.dcm'), 'rb') as stored_file:
+            self.assertEqual(stored_file.read(), self.dicom_bytes)
+        self.assertEqual(os.stat(self.store.blob_path(entry['key'])).st_nlink, 2)
+
+
+class VolumeStoreTests(SimpleTestCase):
+
+    def test_concurrent_writers_of_one_store_do_not_collide(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        write_synthetic_series(directory, num_slices=4, rows=16, cols=16)
+        series_volume = load_series_volume(directory)
+        expected_pixels = np.array(series_volume.pixels)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for future in [executor.submit(write_volume_store, directory, series_volume) for _ in range(12)]:
+                future.result()
+
+        np.testing.assert_array_equal(open_volume_store(directory).pixels, expected_pixels)
+        self.assertEqual([name for name in os.listdir(directory) if name.endswith('.tmp')], [])
+
+
+def _volume_of(nbytes):
+    return SeriesVolume(np.zeros(nbytes, dtype=np.uint8).reshape(1, 1, nbytes), (1, 1, 1), (0, 0, 0),
+                        (1, 0, 0, 0, 1, 0, 0, 0, 1), [1], [0], [40], [400])
+
+
+class VolumeCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = volume_cache.VolumeCache(max_bytes=250)
+        self.loads = []
+
+    def _get(self, series_id, nbytes=100):
+        def loader(directory):
+            self.loads.append(series_id)
+            return _volume_of(nbytes)
+        return self.cache.get(series_id, f'/nonexistent/series{series_id}', loader=loader)
+
+    def test_least_recently_used_series_is_evicted_first(self):
+        self._get(1)
+        self._get(2)
+        self._get(1)
+        self._get(3)
+        self.assertEqual(list(self.cache._entries), [1, 3])
+        self._get(1)
+        self._get(2)
+        self.assertEqual(self.loads, [1, 2, 3, 2])
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+        # Loading locks go with the entries they guarded.
+        self.assertEqual(set(self.cache._loading_locks), set(self.cache._entries))
+
+    def test_byte_budget(self):
+        self._get(1)
+        self._get(2, nbytes=150)
+        self.assertEqual(self.cache.stats()['bytes'], 250)
+        self._get(3, nbytes=300)
+        self._get(3, nbytes=300)
+        self.assertEqual(self.loads, [1, 2, 3, 3])
+        self.assertEqual(self.cache.stats()['bytes'], 250)
+        self.assertNotIn(3, self.cache._loading_locks)
+
+    def test_failed_read_drops_its_loading_lock(self):
+        def loader(directory):
+            raise OSError("unreadable")
+        with self.assertRaises(OSError):
+            self.cache.get(1, '/nonexistent/series1', loader=loader)
+        self.assertEqual(self.cache._loading_locks, {})
+
+
+class VolumeCacheInvalidationTests(MediaTestCase):
+
+    def test_deleting_a_series_drops_its_volume(self):
+        self.client.get('/dicom/ajax/slice_image/', {'series_id': self.series.id, 'view_type': 'axial'})
+        cache = volume_cache.get_volume_cache()
+        self.assertIn(self.series.id, cache._entries)
+        self.client.post(f'/dicom/delete/{self.series.id}/')
+        self.assertNotIn(self.series.id, cache._entries)
+        self.assertNotIn(self.series.id, cache._loading_locks)
+        self.assertFalse(os.path.exists(self.series.file_path))
+
+
+class SliceEtagTests(MediaTestCase):
+
+    def _check_conditional_requests(self, url, params):
+        # The first read may write the series' volume store, which changes the directory mtime.
+        self.client.get(url, params)
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        stat_result = os.stat(self.series.file_path)
+        os.utime(self.series.file_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10 ** 9))
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_slice_image_etag(self):
+        self._check_conditional_requests('/dicom/ajax/slice_image/', {
+            'series_id': self.series.id, 'view_type': 'coronal', 'slice_index': 3, 'format': 'png'})
+
+    def test_slice_url_is_not_revalidated_after_eviction(self):
+        params = {'series_id': self.series.id, 'view_type': 'axial', 'slice_index': 2}
+        self.client.get('/dicom/ajax/get_slice_url/', params)
+        response = self.client.get('/dicom/ajax/get_slice_url/', params)
+        etag, slice_url = response['ETag'], response.json()['slice_url']
+        self.assertEqual(self.client.get('/dicom/ajax/get_slice_url/', params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        cache = render_cache.get_render_cache()
+        for name in os.listdir(cache.directory):
+            os.remove(os.path.join(cache.directory, name))
+        response = self.client.get('/dicom/ajax/get_slice_url/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(response.json()['slice_url']).status_code, 200)
+        self.assertEqual(response.json()['slice_url'], slice_url)
+
+    def test_slice_raw_etag(self):
+        self._check_conditional_requests('/dicom/ajax/slice_raw/', {
+            'series_id': self.series.id, 'view_type': 'axial', 'slice_index': 1, 'count': 2})
+
+
+class SliceParameterTests(MediaTestCase):
+
+    def _assert_bad_request(self, url, **params):
+        response = self.client.get(url, {'series_id': self.series.id, 'view_type': 'axial', **params})
+        self.assertEqual(response.status_code, 400, params)
+        self.assertIn('error', response.json())
+
+    def test_slice_batch_rejects_bad_numbers(self):
+        for params in ({'start': 'abc'}, {'stop': '1.5'}, {'step': '0'}, {'quality': 'abc'}):
+            self._assert_bad_request('/dicom/ajax/slice_batch/', **params)
+
+    def test_slice_image_rejects_bad_slices_and_quality(self):
+        for params in ({'quality': 'abc'}, {'window_width': 'abc'}, {'view_type': 'oblique'}, {'slice_index': '6'},
+                       {'view_type': 'coronal', 'slice_index': '-1'}):
+            self._assert_bad_request('/dicom/ajax/slice_image/', **params)
+        self._assert_bad_request('/dicom/ajax/get_slice_url/', view_type='oblique')
+        self._assert_bad_request('/dicom/ajax/slice_batch/', view_type='oblique')
+
+    def test_slice_raw_rejects_bad_numbers(self):
+        for params in ({'count': 'abc'}, {'slice_index': 'x'}, {'slice_index': '99'}):
+            self._assert_bad_request('/dicom/ajax/slice_raw/', **params)
+
+    def test_window_must_be_finite_with_a_positive_width(self):
+        cache = render_cache.get_render_cache()
+        for url in ('/dicom/ajax/get_slice_url/', '/dicom/ajax/slice_image/', '/dicom/ajax/slice_batch/'):
+            for params in ({'window_center': 'abc'}, {'window_width': 'nan'}, {'window_center': 'inf'},
+                           {'window_width': '0'}, {'window_width': '-40'}):
+                self._assert_bad_request(url, **params)
+        self.assertEqual(cache.misses, 0)
+        self.assertFalse(os.path.isdir(cache.directory) and os.listdir(cache.directory))
+
+
+def _slice_header(filename, instance_number=None, position=None, orientation=None):
+    dataset = Dataset()
+    if instance_number is not None:
+        dataset.InstanceNumber = instance_number
+    if position is not None:
+        dataset.ImagePositionPatient = position
+    if orientation is not None:
+        dataset.ImageOrientationPatient = orientation
+    return SliceHeader(filename, dataset)
+
+
+class SliceOrderTests(SimpleTestCase):
+
+    def _order(self, headers):
+        return [os.path.basename(header.path) for header in sort_slice_headers(headers)]
+
+    def test_instance_number_comes_first(self):
+        headers = [_slice_header('a.dcm', 3, [0, 0, 0]), _slice_header('b.dcm', 1, [0, 0, 5]),
+                   _slice_header('c.dcm', 2, [0, 0, 10])]
+        self.assertEqual(self._order(headers), ['b.dcm', 'c.dcm', 'a.dcm'])
+
+    def test_position_along_the_slice_normal_without_distinct_instance_numbers(self):
+        # Rows along +x and columns along -y: the slice normal points along -z.
+        orientation = [1, 0, 0, 0, -1, 0]
+        headers = [_slice_header('a.dcm', 1, [0, 0, -5], orientation), _slice_header('b.dcm', 1, [0, 0, 5], orientation),
+                   _slice_header('c.dcm', None, [0, 0, 0], orientation)]
+        self.assertEqual(self._order(headers), ['b.dcm', 'c.dcm', 'a.dcm'])
+        # Without an orientation the normal is taken to be +z.
+        headers = [_slice_header(name, None, [0, 0, z]) for name, z in (('a.dcm', 2.5), ('b.dcm', -2.5), ('c.dcm', 0))]
+        self.assertEqual(self._order(headers), ['b.dcm', 'c.dcm', 'a.dcm'])
+
+    def test_file_name_order_when_tags_are_missing(self):
+        headers = [_slice_header('c.dcm', 1, [0, 0, 0]), _slice_header('a.dcm', 1), _slice_header('b.dcm', None, [0, 0, 1])]
+        self.assertEqual(self._order(headers), ['a.dcm', 'b.dcm', 'c.dcm'])
+        # Repeated positions are no better than none.
+        headers = [_slice_header('b.dcm', 2, [0, 0, 0]), _slice_header('a.dcm', 2, [0, 0, 0])]
+        self.assertEqual(self._order(headers), ['a.dcm', 'b.dcm'])
+
+
+class InferenceResultCacheTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = InferenceResultCache()
+        self.heatmap_path = os.path.join(self.media_root, 'heatmaps', 'earlier', 'heatmap.nrrd')
+        os.makedirs(os.path.dirname(self.heatmap_path))
+        open(self.heatmap_path, 'wb').close()
+        self.model_path = os.path.join(self.media_root, 'checkpoint_v2_1', 'model.keras')
+        os.makedirs(os.path.dirname(self.model_path))
+        with open(self.model_path, 'wb') as model_file:
+            model_file.write(b'weights v1')
+        self.result = ProcessingResult.objects.create(
+            dicom_series=self.series, heatmap_file_path=self.heatmap_path, ece_probability=0.8,
+            non_ece_probability=0.2, content_fingerprint='f' * 64, model_id=model_identifier(self.model_path),
+        )
+
+    def test_hit_and_miss(self):
+        model_id = model_identifier(self.model_path)
+        self.assertEqual(self.cache.lookup('f' * 64, model_id), self.result)
+        self.assertEqual(self.cache.lookup('f' * 64, model_id, with_heatmap=False), self.result)
+        self.assertIsNone(self.cache.lookup('e' * 64, model_id))
+        self.assertIsNone(self.cache.lookup(None, model_id))
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 1})
+
+    def test_score_only_result_does_not_serve_a_heatmap_run(self):
+        model_id = model_identifier(self.model_path)
+        os.remove(self.heatmap_path)
+        self.assertIsNone(self.cache.lookup('f' * 64, model_id))
+        self.assertEqual(self.cache.lookup('f' * 64, model_id, with_heatmap=False), self.result)
+
+    def test_new_weights_or_checkpoint_version_invalidate(self):
+        with open(self.model_path, 'wb') as model_file:
+            model_file.write(b'weights v2')
+        self.assertIsNone(self.cache.lookup('f' * 64, model_identifier(self.model_path)))
+
+        next_version_path = os.path.join(self.media_root, 'checkpoint_v3', 'model.keras')
+        os.makedirs(os.path.dirname(next_version_path))
+        with open(next_version_path, 'wb') as model_file:
+            model_file.write(b'weights v1')
+        self.assertIsNone(self.cache.lookup('f' * 64, model_identifier(next_version_path)))
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 2})
+
+
+class DicomUploadTests(MediaTestCase):
+
+    def _series_bytes(self, name, num_slices, seed=0):
+        paths = write_synthetic_series(os.path.join(self.media_root, 'sources', name), num_slices=num_slices,
+                                       rows=16, cols=16, seed=seed)
+        files = []
+        for path in paths:
+            with open(path, 'rb') as dicom_file:
+                files.append((f"{name}_{os.path.basename(path)}", dicom_file.read()))
+        return files
+
+    def _stream(self, handler, file_name, data, chunk_size=64):
+        handler.new_file('dicom_files', file_name, 'application/dicom', len(data))
+        for start in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[start:start + chunk_size], start)
+        return handler.file_complete(len(data))
+
+    def test_files_without_the_dicm_marker_are_skipped(self):
+        handler = DicomStreamingUploadHandler()
+        with self.assertRaises(SkipFile):
+            self._stream(handler, 'notes.txt', b'not a DICOM file' * 20)
+        self.assertEqual(handler.rejected, [('notes.txt', 'no DICM marker after the preamble')])
+        self.assertEqual(handler.series_index, {})
+
+    def test_header_is_read_past_pixel_data_bytes_inside_an_earlier_value(self):
+        file_name, data = self._series_bytes('early', 1)[0]
+        dataset = pydicom.dcmread(io.BytesIO(data))
+        dataset.add_new((0x0009, 0x0010), 'LO', 'TEST')
+        dataset.add_new((0x0009, 0x1001), 'OB', b'\xe0\x7f\x10\x00' * 4)
+        buffer = io.BytesIO()
+        dataset.save_as(buffer, enforce_file_format=True)
+
+        handler = DicomStreamingUploadHandler()
+        uploaded_file = self._stream(handler, file_name, buffer.getvalue())
+        self.assertEqual(handler.rejected, [])
+        self.assertEqual(uploaded_file.dicom_header.get('SeriesInstanceUID'), dataset.SeriesInstanceUID)
+        self.assertEqual(uploaded_file.dicom_header.get('Rows'), 16)
+        uploaded_file.close()
+
+    def test_upload_creates_one_series_per_series_instance_uid(self):
+        files = self._series_bytes('large', 3, seed=1) + self._series_bytes('small', 2, seed=2)
+        uploads = [SimpleUploadedFile(name, data) for name, data in files]
+        uploads.append(SimpleUploadedFile('readme.txt', b'not a DICOM file' * 20))
+        response = self.client.post('/dicom/upload/', {'dicom_files': uploads})
+
+        new_series = DicomSeries.objects.exclude(id=self.series.id).order_by('id')
+        self.assertEqual([len(os.listdir(series.file_path)) for series in new_series], [3 + 3, 2 + 3])
+        self.assertRedirects(response, f'/dicom/process/{new_series[0].id}/', fetch_redirect_response=False)
+        for series, prefix in zip(new_series, ('large', 'small')):
+            names = sorted(name for name in os.listdir(series.file_path) if name.endswith('.dcm'))
+            self.assertTrue(all(name.startswith(prefix) for name in names))
+
+
+class NrrdPyramidTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nrrd_path = os.path.join(self.media_root, 'nrrd_files', f"user{self.owner.id}_series{self.series.id}.nrrd")
+        os.makedirs(os.path.dirname(self.nrrd_path))
+
+    def test_level_sizes_and_spacing(self):
+        levels = write_series_volume_nrrd_pyramid(load_series_volume(self.series.file_path), self.nrrd_path, [4, 2])
+        # (x, y, z) sizes; the 6 slices shrink to 1 and 3, never to 0.
+        self.assertEqual([(level['shrink_factor'], level['size']) for level in levels],
+                         [(4, [8, 8, 1]), (2, [16, 16, 3]), (1, [32, 32, 6])])
+        self.assertEqual([level['path'] for level in levels],
+                         [nrrd_level_path(self.nrrd_path, factor) for factor in (4, 2, 1)])
+        self.assertEqual(read_nrrd_levels(self.nrrd_path), levels)
+        full, coarse = sitk.ReadImage(self.nrrd_path), sitk.ReadImage(levels[0]['path'])
+        np.testing.assert_allclose(coarse.GetSpacing()[:2], np.array(full.GetSpacing()[:2]) * 4)
+        # Each coarse voxel is the mean of its block.
+        full_pixels = sitk.GetArrayFromImage(full).astype(np.float64)
+        np.testing.assert_allclose(sitk.GetArrayFromImage(sitk.ReadImage(levels[1]['path'])),
+                                   full_pixels.reshape(3, 2, 16, 2, 16, 2).mean(axis=(1, 3, 5)), atol=1)
+
+    def test_viewer_gets_the_levels_coarsest_first(self):
+        ProcessingResult.objects.create(dicom_series=self.series, nrrd_file_path=self.nrrd_path,
+                                        ece_probability=0.5, non_ece_probability=0.5)
+        write_series_volume_nrrd_pyramid(load_series_volume(self.series.file_path), self.nrrd_path, [4, 2, 1])
+        response = self.client.get(f'/dicom/ajax/get_nrrd_url/{self.series.id}/').json()
+        self.assertEqual([level['shrink_factor'] for level in response['levels']], [4, 2, 1])
+        self.assertEqual(response['levels'][-1]['url'], response['nrrd_url'])
+        self.assertEqual(self.client.get(response['levels'][0]['url']).status_code, 200)
+
+        # With a level missing, the viewer falls back to the full resolution volume alone.
+        os.remove(nrrd_level_path(self.nrrd_path, 2))
+        response = self.client.get(f'/dicom/ajax/get_nrrd_url/{self.series.id}/').json()
+        self.assertEqual([level['shrink_factor'] for level in response['levels']], [1])
+
+
+def _individual_slice_png(img):
+    """One slice as generate_all_directional_slices saved it before the atlases: its own 0-255 stretch."""
+    img = img.astype(np.float32)
+    img -= np.min(img)
+    img /= np.max(img) if np.max(img) > 0 else 1
+    img *= 255
+    return img.astype(np.uint8)
+
+
+class SliceAtlasTests(SimpleTestCase):
+
+    def test_atlas_tiles_match_individually_rendered_slices(self):
+        output_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_folder, ignore_errors=True)
+        volume = np.random.default_rng(3).integers(-1024, 2000, size=(7, 20, 13), dtype=np.int16)
+        volume[3] = 5  # a flat slice stays black
+        # A small sheet size, so every orientation spans several sheets and a partly filled last one.
+        index = render_slice_atlases(volume, output_folder, 'test', workers=3, max_atlas_pixels=40)
+
+        for orientation, axis in (('axial', 0), ('coronal', 1), ('sagittal', 2)):
+            layout = index['orientations'][orientation]
+            self.assertGreater(len(layout['atlases']), 1)
+            sheets = [np.asarray(Image.open(os.path.join(output_folder, name))) for name in layout['atlases']]
+            for slice_index, (sheet, x, y) in enumerate(layout['slices']):
+                tile = sheets[sheet][y:y + layout['tile_height'], x:x + layout['tile_width']]
+                expected = _individual_slice_png(np.take(volume, slice_index, axis=axis))
+                np.testing.assert_array_equal(tile, expected, err_msg=f"{orientation} slice {slice_index}")
@@ -0,0 +1,105 @@
+import hashlib
+import io
+
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+
+from .ingest import SLICE_HEADER_KEYWORDS, SliceHeader
+
+
+# (7FE0,0010) PixelData, as it appears in little endian files. Once it shows up in
+# the buffered bytes, everything the header scan needs has arrived.
+PIXEL_DATA_TAG_BYTES = b'\xe0\x7f\x10\x00'
+# Pixel data elements at which the header parse stops: Pixel Data and its float variants.
+PIXEL_DATA_TAGS = {0x7FE00010, 0x7FE00009, 0x7FE00008}
+# read_partial, unlike dcmread, only takes tags.
+SLICE_HEADER_TAGS = [Tag(keyword) for keyword in SLICE_HEADER_KEYWORDS]
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b'DICM'
+
+
+class DicomStreamingUploadHandler(TemporaryFileUploadHandler):
+    """
+    Checks and indexes DICOM files while the upload is still streaming in.
+
+    Every file is hashed chunk by chunk, and its header is parsed as soon as the
+    bytes before the pixel data have arrived. A file without the DICM marker, or
+    whose header does not parse or lacks its UIDs, is skipped right there; the rest
+    of its bytes are never written. Accepted files are returned as temporary files
+    carrying `content_sha256` and `dicom_header` (a SliceHeader without a path), and
+    are grouped by SeriesInstanceUID in `series_index`. Rejected file names and the
+    reason are kept in `rejected`.
+    """
+
+    max_header_bytes = 4 * 1024 * 1024
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.series_index = {}
+        self.rejected = []
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._content_hash = hashlib.sha256()
+        self._header_buffer = bytearray()
+        self._header = None
+
+    def _reject(self, reason):
+        print(f"Upload: skipping '{self.file_name}': {reason}")
+        self.rejected.append((self.file_name, reason))
+        raise SkipFile(reason)
+
+    def _parse_header(self, final):
+        reached_pixel_data = False
+
+        def at_pixel_data(tag, vr, length):
+            nonlocal reached_pixel_data
+            reached_pixel_data = tag in PIXEL_DATA_TAGS
+            return reached_pixel_data
+
+        try:
+            dataset = read_partial(
+                io.BytesIO(bytes(self._header_buffer)), stop_when=at_pixel_data, specific_tags=SLICE_HEADER_TAGS
+            )
+            header = SliceHeader(None, dataset)
+        except Exception as e:
+            if final or len(self._header_buffer) > self.max_header_bytes:
+                self._reject(f"not a readable DICOM file ({e})")
+            return  # the header is not complete yet
+        if not final and not reached_pixel_data:
+            # The tag bytes were inside an earlier value, and a buffer cut at an element
+            # boundary parses without error: wait until the parser gets to the pixel data.
+            return
+        if not header.get('SeriesInstanceUID') or not header.get('SOPInstanceUID'):
+            self._reject("missing SeriesInstanceUID or SOPInstanceUID")
+        self._header = header
+        self._header_buffer = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self._content_hash.update(raw_data)
+        if self._header is None:
+            self._header_buffer += raw_data
+            magic_end = DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC)
+            if len(self._header_buffer) >= magic_end and self._header_buffer[DICOM_PREAMBLE_LENGTH:magic_end] != DICOM_MAGIC:
+                self._reject("no DICM marker after the preamble")
+            if PIXEL_DATA_TAG_BYTES in self._header_buffer[magic_end:]:
+                self._parse_header(final=False)
+            elif len(self._header_buffer) > self.max_header_bytes:
+                self._reject("header larger than expected")
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if self._header is None:
+            # Small files, or files without pixel data, are parsed once they are complete.
+            try:
+                self._parse_header(final=True)
+            except SkipFile:
+                self.file.close()
+                return None
+
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.content_sha256 = self._content_hash.hexdigest()
+        uploaded_file.dicom_header = self._header
+        self.series_index.setdefault(str(self._header.get('SeriesInstanceUID')), []).append(uploaded_file)
+        return uploaded_file
@@ -4,9 +4,14 @@ from . import views
 urlpatterns = [
     path('upload/', views.upload_dicom, name='upload_dicom'),
     path('process/<int:series_id>/', views.process_dicom, name='process_dicom'),
+    path('process/<int:series_id>/heatmap/', views.compute_heatmap, name='compute_heatmap'),
+    path('ajax/job_status/<int:job_id>/', views.job_status_ajax, name='ajax_job_status'),
     path('delete/<int:series_id>/', views.delete_dicom, name='delete_dicom'),
     #path('result/<int:result_id>/', views.view_result, name='view_result'), 
     path('ajax/get_slice_url/', views.get_slice_url_ajax, name='ajax_get_slice_url'),
+    path('ajax/slice_image/', views.get_slice_image, name='ajax_slice_image'),
+    path('ajax/slice_raw/', views.get_slice_raw, name='ajax_slice_raw'),
+    path('ajax/slice_batch/', views.get_slice_batch, name='ajax_slice_batch'),
     path('ajax/get_nrrd_url/<int:series_id>/', views.get_nrrd_url, name='ajax_get_nrrd_url'),
     path('ajax/get_heatmap_url/<int:series_id>/', views.get_heatmap_url, name='get_heatmap_url_ajax'),
  ]
@@ -1,13 +1,24 @@
+import io
+import json
+import logging
 import os
 import numpy as np
 import pydicom
 import SimpleITK as sitk
 from skimage.transform import resize
-from tensorflow.keras.models import load_model
 import uuid
 from django.conf import settings
 import matplotlib.pyplot as plt
+from PIL import Image
 import tensorflow as tf
+from .ingest import decode_dicom_files
+from .media_serving import write_gzip_sibling
+from .metrics import timed_stage
+from .resample import separable_resize
+from .slice_atlas import render_slice_atlases
+from .windowing import apply_window_lut, apply_windowing, supports_lut, window_slices
+from .volume_store import load_series_volume
+from .model_registry import MODEL_INPUT_SHAPE, get_model_registry
 
 
 
@@ -31,12 +42,14 @@ def convert_dicom_series_to_nrrd(dicom_directory_path, output_nrrd_path):
         series_reader.SetFileNames(series_filenames)
         
         # Execute the reader to create the 3D image.
-        image_3d = series_reader.Execute()
+        with timed_stage('dicom_read', slices=len(series_filenames), reader='sitk'):
+            image_3d = series_reader.Execute()
         
         print(f"  > Image loaded with size: {image_3d.GetSize()} and spacing: {image_3d.GetSpacing()}")
         
         # Save the 3D image to the .nrrd file path we were given.
-        sitk.WriteImage(image_3d, output_nrrd_path)
+        with timed_stage('nrrd_write', size=image_3d.GetSize()):
+            sitk.WriteImage(image_3d, output_nrrd_path)
         
         print(f"  > NRRD file written successfully to {output_nrrd_path}")
         return True
@@ -52,17 +65,109 @@ def convert_dicom_series_to_nrrd(dicom_directory_path, output_nrrd_path):
         return False
 
 
+def write_series_volume_nrrd(series_volume, output_nrrd_path):
+    """
+    Saves an already decoded SeriesVolume as a .nrrd file, with the same values
+    and geometry SimpleITK's series reader would produce, without reading the
+    DICOM files again.
+    """
+    try:
+        with timed_stage('nrrd_write', shape=series_volume.pixels.shape):
+            volume = series_volume.rescaled(np.int16 if series_volume.rescaled_fits_int16() else np.float32)
+
+            image_3d = sitk.GetImageFromArray(volume)
+            del volume
+            image_3d.SetSpacing(series_volume.spacing)
+            image_3d.SetOrigin(series_volume.origin)
+            image_3d.SetDirection(series_volume.direction)
+            print(f"  > Writing NRRD with size: {image_3d.GetSize()} and spacing: {image_3d.GetSpacing()}")
+
+            sitk.WriteImage(image_3d, output_nrrd_path)
+        print(f"  > NRRD file written successfully to {output_nrrd_path}")
+        return True
+    except RuntimeError as e:
+        print(f"!!! A runtime error occurred while writing the NRRD file: {e}")
+        return False
+
+
+def nrrd_levels_path(output_nrrd_path):
+    """The JSON file listing the resolution levels written next to a volume NRRD."""
+    return os.path.splitext(output_nrrd_path)[0] + '.levels.json'
+
+
+def nrrd_level_path(output_nrrd_path, shrink_factor):
+    """Path of one resolution level; the full resolution level is the NRRD path itself."""
+    if shrink_factor == 1:
+        return output_nrrd_path
+    return f"{os.path.splitext(output_nrrd_path)[0]}_x{shrink_factor}.nrrd"
+
+
+def write_series_volume_nrrd_pyramid(series_volume, output_nrrd_path, shrink_factors=None):
+    """
+    Saves a SeriesVolume as gzip-encoded NRRDs at several resolutions, so the 3D
+    viewer can show a coarse volume first and refine it while the rest downloads.
+    Each level is shrunk by its factor along every axis (block averages, with the
+    spacing and origin adjusted by SimpleITK) and the full resolution level is
+    written to `output_nrrd_path`. The levels are listed, coarsest first, in the
+    file returned by nrrd_levels_path. Returns that list, or None on failure.
+    """
+    if shrink_factors is None:
+        shrink_factors = getattr(settings, 'NRRD_PYRAMID_SHRINK_FACTORS', [4, 2, 1])
+    try:
+        with timed_stage('nrrd_write', shape=series_volume.pixels.shape, shrink_factors=shrink_factors):
+            volume = series_volume.rescaled(np.int16 if series_volume.rescaled_fits_int16() else np.float32)
+            image_3d = sitk.GetImageFromArray(volume)
+            del volume
+            image_3d.SetSpacing(series_volume.spacing)
+            image_3d.SetOrigin(series_volume.origin)
+            image_3d.SetDirection(series_volume.direction)
+
+            levels = []
+            for shrink_factor in sorted(set(shrink_factors) | {1}, reverse=True):
+                if shrink_factor == 1:
+                    level_image = image_3d
+                else:
+                    # Thin series keep at least one slice along an axis shorter than the factor.
+                    factors = [max(1, min(shrink_factor, size)) for size in image_3d.GetSize()]
+                    level_image = sitk.BinShrink(image_3d, factors)
+                level_path = nrrd_level_path(output_nrrd_path, shrink_factor)
+                sitk.WriteImage(level_image, level_path, useCompression=True)
+                levels.append({
+                    'shrink_factor': shrink_factor,
+                    'path': level_path,
+                    'size': list(level_image.GetSize()),
+                    'bytes': os.path.getsize(level_path),
+                })
+                print(f"  > NRRD level 1/{shrink_factor} written: size {level_image.GetSize()}, {levels[-1]['bytes']} bytes")
+
+        with open(nrrd_levels_path(output_nrrd_path), 'w') as levels_file:
+            json.dump({'levels': levels}, levels_file)
+        return levels
+    except RuntimeError as e:
+        print(f"!!! A runtime error occurred while writing the NRRD levels: {e}")
+        return None
+
+
+def read_nrrd_levels(output_nrrd_path):
+    """The level list written by write_series_volume_nrrd_pyramid, or None for a single NRRD."""
+    try:
+        with open(nrrd_levels_path(output_nrrd_path)) as levels_file:
+            levels = json.load(levels_file)['levels']
+    except (OSError, ValueError, KeyError):
+        return None
+    if not all(os.path.exists(level['path']) for level in levels):
+        return None
+    return levels
+
 
-def apply_windowing(img, window_center, window_width):
-    lower = window_center - (window_width / 2)
-    upper = window_center + (window_width / 2)
-    img = np.clip(img, lower, upper)
-    img = (img - lower) / (upper - lower) * 255.0
-    return img.astype(np.uint8)
 
 def load_dicom_image(dicom_file):
     ds = pydicom.dcmread(dicom_file)
-    img = ds.pixel_array.astype(np.float32)
+    return window_dicom_pixels(ds, ds.pixel_array)
+
+def window_dicom_pixels(ds, pixel_array):
+    """Rescales and windows one decoded slice with its own header values, as load_dicom_image does."""
+    img = pixel_array.astype(np.float32)
     img *= getattr(ds, 'RescaleSlope', 1)
     img += getattr(ds, 'RescaleIntercept', 0)
 
@@ -72,24 +177,46 @@ def load_dicom_image(dicom_file):
     if isinstance(ww, pydicom.multival.MultiValue): ww = ww[0]
     return apply_windowing(img, wc, ww)
 
+def create_model_volume(series_volume):
+    """
+    Windowed uint8 volume for the model, computed from an already decoded series.
+    Every slice uses its own rescale and window values, like load_dicom_image does.
+    Integer volumes are windowed through cached lookup tables, with the same result.
+    """
+    if supports_lut(series_volume.pixels.dtype):
+        return window_slices(
+            series_volume.pixels, series_volume.window_centers, series_volume.window_widths,
+            series_volume.rescale_slopes, series_volume.rescale_intercepts,
+        )
+    volume = np.empty(series_volume.shape, dtype=np.uint8)
+    for index in range(series_volume.shape[0]):
+        volume[index] = apply_windowing(
+            series_volume.rescaled_slice(index),
+            series_volume.window_centers[index],
+            series_volume.window_widths[index],
+        )
+    return volume
+
 def create_volume_from_dicom(directory):
-    slices = []
-    for fname in sorted(os.listdir(directory)):
-        if fname.endswith('.dcm'):
-            path = os.path.join(directory, fname)
-            slices.append(load_dicom_image(path))
-    return np.stack(slices, axis=0)
+    paths = [os.path.join(directory, fname) for fname in sorted(os.listdir(directory)) if fname.endswith('.dcm')]
+    pixels, headers = decode_dicom_files(paths)
+    volume = np.empty(pixels.shape, dtype=np.uint8)
+    for index, ds in enumerate(headers):
+        volume[index] = window_dicom_pixels(ds, pixels[index])
+    return volume
+
+
+def _sorted_dicom_paths(dicom_folder):
+    return [
+        os.path.join(dicom_folder, filename)
+        for filename in sorted(os.listdir(dicom_folder))
+        if filename.lower().endswith(".dcm")
+    ]
 
 
 def generate_views(dicom_folder, output_folder):
     """Generate axial, sagittal, and coronal PNGs from a folder of .dcm files."""
-    slices = []
-    for filename in sorted(os.listdir(dicom_folder)):
-        if filename.lower().endswith(".dcm"):
-            ds = pydicom.dcmread(os.path.join(dicom_folder, filename))
-            slices.append(ds.pixel_array)
-    
-    volume = np.stack(slices, axis=0)
+    volume, _ = decode_dicom_files(_sorted_dicom_paths(dicom_folder))
 
     z = volume.shape[0] // 2
     y = volume.shape[1] // 2
@@ -113,17 +240,7 @@ def generate_views(dicom_folder, output_folder):
 
 
 def generate_middle_views(dicom_folder, output_folder, user_id, series_id):
-    import os
-    import pydicom
-    import numpy as np
-
-    slices = []
-    for filename in sorted(os.listdir(dicom_folder)):
-        if filename.lower().endswith(".dcm"):
-            ds = pydicom.dcmread(os.path.join(dicom_folder, filename))
-            slices.append(ds.pixel_array)
-
-    volume = np.stack(slices, axis=0)
+    volume, _ = decode_dicom_files(_sorted_dicom_paths(dicom_folder))
 
     z = volume.shape[0] // 2
     y = volume.shape[1] // 2
@@ -146,284 +263,177 @@ def generate_middle_views(dicom_folder, output_folder, user_id, series_id):
 
 def generate_all_directional_slices(dicom_folder, output_folder, user_id, series_id):
     """
-    Converts all .dcm files into a 3D volume, then saves every slice
-    in axial, coronal, and sagittal directions as .png files.
+    Converts all .dcm files into a 3D volume, then renders every slice in axial,
+    coronal, and sagittal directions into per-orientation PNG sprite atlases,
+    named user<id>_series<id>_<view>_<n>.png. Returns the atlas index (also saved
+    as user<id>_series<id>_atlas.json) that locates each slice; see render_slice_atlases.
     """
     # 1. Stack all .dcm slices into a 3D cube
-    slices = []
-    for filename in sorted(os.listdir(dicom_folder)):
-        if filename.lower().endswith(".dcm"):
-            ds = pydicom.dcmread(os.path.join(dicom_folder, filename))
-            slices.append(ds.pixel_array)
+    volume, _ = decode_dicom_files(_sorted_dicom_paths(dicom_folder))  # shape: (depth, height, width)
 
-    volume = np.stack(slices, axis=0)  # shape: (depth, height, width)
+    # 2. Normalize each orientation at once and write its atlases in parallel
+    return render_slice_atlases(
+        volume, output_folder, f"user{user_id}_series{series_id}",
+        workers=getattr(settings, 'SLICE_ATLAS_WORKERS', None),
+    )
 
-    os.makedirs(output_folder, exist_ok=True)
+def split_prediction_probabilities(prediction_row):
+    """
+    Returns (ece_probability, non_ece_probability) from one row of model output.
+    The model outputs [non-ECE, ECE]; a single sigmoid output is treated as P(ECE).
+    """
+    prediction_row = np.asarray(prediction_row, dtype=np.float64).ravel()
+    if prediction_row.size == 1:
+        ece_prob = float(prediction_row[0])
+        return ece_prob, 1.0 - ece_prob
+    return float(prediction_row[1]), float(prediction_row[0])
 
-    total = {
-        'axial':    volume.shape[0],
-        'coronal':  volume.shape[1],
-        'sagittal': volume.shape[2]
-    }
 
-    for view, count in total.items():
-        for i in range(count):
-            if view == 'axial':
-                img = volume[i, :, :]
-            elif view == 'coronal':
-                img = volume[:, i, :]
-            elif view == 'sagittal':
-                img = volume[:, :, i]
-            else:
-                continue
-
-            # Normalize image to 0-255
-            img = img.astype(np.float32)
-            img -= np.min(img)
-            img /= np.max(img) if np.max(img) > 0 else 1
-            img *= 255
-            img = img.astype(np.uint8)
-
-            filename = f"user{user_id}_series{series_id}_{view}_{i}.png"
-            full_path = os.path.join(output_folder, filename)
-            plt.imsave(full_path, img, cmap='gray')
-
-def generate_heatmap(dicom_directory):
+def prepare_model_input(volume):
     """
-    Generates a Grad-CAM style heatmap and also returns the model's prediction score.
-    Updated with correct input shape and layer name for the new model.
+    Turns a (slices, rows, cols) volume into the (90, 90, 25) array the model expects.
+    Returns (resized_volume, transposed_shape); the transposed shape is what the
+    heatmap has to be resized back to for a correct overlay.
     """
-    print("--- Starting generate_heatmap ---")
-    print(f"Processing directory: {dicom_directory}")
-    volume = create_volume_from_dicom(dicom_directory)
-    if volume is None or volume.size == 0:
-        print("!!! ERROR: create_volume_from_dicom failed.")
-        return None, None 
-
     volume_transposed = np.transpose(volume, (2, 1, 0))
     print(f"  > Volume transposed to shape: {volume_transposed.shape}")
 
-    # --- FIX #1: Correct Resize Shape ---
-    # Why this change? The error message told us the model expects a shape of (90, 90, 25).
-    # We now resize the input scan to this exact size.
-    correct_shape = (90, 90, 25)
+    # The model expects a shape of (90, 90, 25), so we resize the input scan to this exact size.
+    correct_shape = MODEL_INPUT_SHAPE
     print(f"  > Resizing volume to the correct model input shape: {correct_shape}")
-    resized_volume = resize(volume_transposed, correct_shape, anti_aliasing=True)
+    resampler = getattr(settings, 'MODEL_INPUT_RESAMPLER', 'separable')
+    with timed_stage('resize', shape=volume.shape, resampler=resampler):
+        if resampler == 'skimage':
+            resized_volume = resize(volume_transposed, correct_shape, anti_aliasing=True)
+        else:
+            # Same result as the skimage resize above, in float32 and on several threads.
+            # It works on the untransposed volume, so the output is transposed at the end.
+            resized_volume = separable_resize(
+                volume, correct_shape[::-1], workers=getattr(settings, 'MODEL_RESAMPLE_WORKERS', None)
+            ).transpose(2, 1, 0)
     print(f"  > Volume resized to shape: {resized_volume.shape}")
-    
-    input_vol_for_model = np.expand_dims(resized_volume, axis=(0, -1))
-    print(f"  > Final input shape for model: {input_vol_for_model.shape}")
-
-    # --- LOADING THE MODEL ---
-    chosen_checkpoint_folder_name = "checkpoint_v2_1" 
-    keras_model_filename = "weights-improvement_v2_1.keras"
+    return np.ascontiguousarray(resized_volume, dtype=np.float32), volume_transposed.shape
 
-    model_path = os.path.join(settings.BASE_DIR, 'dicom_processor', chosen_checkpoint_folder_name, keras_model_filename)
-    
-    print(f"  > Attempting to load model from: {model_path}")
-    if not os.path.exists(model_path):
-        print(f"!!! ERROR: Model file not found at {model_path}.")
-        return None, None 
 
-    try:
-        model = load_model(model_path)
-        print("  > Model loaded successfully.")
-    except Exception as e:
-        print(f"!!! ERROR loading Keras model from file {model_path}: {e}")
-        return None, None
-
-    # --- PREPARE FOR HEATMAP ---
-    prediction_score_value = None 
-
-    # --- FIX #2: Correct Layer Name ---
-    # Why this change? The error message listed all the valid layer names.
-    # 'activation_41' is the last activation layer before pooling, which is perfect for Grad-CAM.
-    last_conv_layer_name = "activation_41" # <<< CORRECTED NAME
-    print(f"  > Using layer for Grad-CAM: '{last_conv_layer_name}'")
-    
-    try:
-        grad_model = tf.keras.models.Model(
-            [model.inputs], [model.get_layer(last_conv_layer_name).output, model.output]
-        )
-        print("  > Grad-CAM model created successfully.")
-    except ValueError as e:
-        print(f"!!! ERROR creating Grad-CAM model. Layer '{last_conv_layer_name}' not found. Heatmap will be skipped.")
-        # If Grad-CAM fails, try getting a prediction directly from the main model
-        try:
-            # Important: The model.predict() expects a compatible shape.
-            # If the grad_model creation fails, it's safer to just return.
-            # The error above indicates the model itself has a different input layer name or structure.
-            # Let's adjust the logic slightly. The primary error is shape mismatch on the model itself.
-            preds_only = model.predict(input_vol_for_model)
-            pred_index_fallback = np.argmax(preds_only[0])
-            prediction_score_value = float(preds_only[0][pred_index_fallback])
-            print(f"  > Fallback prediction score (no heatmap): {prediction_score_value}")
-            return None, prediction_score_value
-        except Exception as e_pred_fallback:
-            print(f"!!! ERROR getting fallback prediction: {e_pred_fallback}")
-            return None, None
-
-    # --- GENERATE HEATMAP & SCORE ---
-    print("  > Generating heatmap and extracting score...")
-    with tf.GradientTape() as tape:
-        # We pass the correctly shaped input to our model now.
-        conv_output, preds = grad_model(input_vol_for_model)
-        pred_index = tf.argmax(preds[0]).numpy() 
-        prediction_score_value = float(preds[0][pred_index].numpy()) 
-        class_channel_for_gradients = preds[:, pred_index] 
-
-        print(f"  > Model prediction values (preds): {preds.numpy()}")
-        print(f"  > Predicted class index: {pred_index}")
-        print(f"  > Final prediction score value: {prediction_score_value}")
-
-    # The rest of the heatmap generation code remains the same...
-    grads = tape.gradient(class_channel_for_gradients, conv_output)
-    if grads is None:
+def compute_gradcam_batch(gradcam_fn, input_batch):
+    """
+    Runs the compiled Grad-CAM function (ModelRegistry.gradcam_fn) on a batch of
+    shape (N, 90, 90, 25, 1). Returns (predictions, cams) where predictions has
+    shape (N, num_classes) and cams is a list of N normalized CAM volumes (None if
+    gradients were unavailable).
+
+    Each sample's gradient only depends on its own prediction, so differentiating
+    the sum of the predicted-class scores gives the same per-sample gradients as
+    running the samples one at a time. The function times its forward_pass,
+    gradient_pass and cam_build stages itself.
+    """
+    predictions, cams = gradcam_fn(np.asarray(input_batch, dtype=np.float32))
+    if cams is None:
         print("!!! ERROR: Gradients are None. Cannot create heatmap. Returning score only.")
-        return None, prediction_score_value 
+        return predictions, [None] * len(predictions)
+    return predictions, list(cams)
 
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2, 3)) 
-    heatmap_conv_output = conv_output[0] 
-    cam = np.zeros(heatmap_conv_output.shape[0:3], dtype=np.float32) 
 
-    for i, w in enumerate(pooled_grads):
-        cam += w * heatmap_conv_output[:, :, :, i]
+def compute_predictions_batch(predict_fn, input_batch):
+    """Score-only counterpart of compute_gradcam_batch: one forward pass, predictions of shape (N, num_classes)."""
+    with timed_stage('forward_pass', batch=len(input_batch)):
+        return predict_fn(tf.convert_to_tensor(input_batch, dtype=tf.float32)).numpy()
 
-    cam = np.maximum(cam, 0) 
-    if np.max(cam) > 0: 
-        cam = cam / np.max(cam)
-    
+
+def save_heatmap(cam, output_shape):
+    """Resizes a CAM back to the scan size and saves it as heatmaps/<uuid>/heatmap.nrrd."""
     # We resize the final heatmap to match the original scan size for correct overlay.
-    heatmap_resized = resize(cam, volume_transposed.shape, anti_aliasing=True)
+    with timed_stage('cam_resize', shape=output_shape):
+        heatmap_resized = resize(cam, output_shape, anti_aliasing=True)
     save_dir_name = str(uuid.uuid4()) 
     heatmap_output_directory = os.path.join(settings.MEDIA_ROOT, 'heatmaps', save_dir_name)
     os.makedirs(heatmap_output_directory, exist_ok=True)
 
     heatmap_img_sitk = sitk.GetImageFromArray(heatmap_resized.astype(np.float32))
     heatmap_file_path = os.path.join(heatmap_output_directory, 'heatmap.nrrd')
-    sitk.WriteImage(heatmap_img_sitk, heatmap_file_path)
+    with timed_stage('heatmap_write'):
+        sitk.WriteImage(heatmap_img_sitk, heatmap_file_path)
+        # Float heatmaps compress well; serve_media sends the .gz to clients that accept gzip.
+        write_gzip_sibling(heatmap_file_path)
     print(f"  > Heatmap saved to: {heatmap_file_path}")
-    print("--- Finished generate_heatmap successfully ---")
-
-    return heatmap_output_directory, prediction_score_value
+    return heatmap_output_directory
 
 
-
-    
-
-
-def load_scan_as_3d_volume(dicom_series_directory_path):
+def generate_heatmap(dicom_directory, series_volume=None, with_heatmap=True):
     """
-    Reads a series of DICOM files from the specified directory, sorts them by InstanceNumber,
-    and stacks them into a 3D numpy array(Volume)."""
-    print("Attemting to Load DICOM Series from: ", dicom_series_directory_path)
-    slices_data =[]
-    dicom_files_path = []
-
-    for filename in os.listdir(dicom_series_directory_path):
-        if filename.lower().endswith('.dcm'):
-            dicom_files_path.append(os.path.join(dicom_series_directory_path, filename))
-
-    if not dicom_files_path:
-        print(f"Error: No .dcm files found in directory: {dicom_series_directory_path}")
-        raise ValueError("No DICOM files found in the specified directory.")
-
-    "Lets sort the files by InstanceNumber to ensure correct stacking"
-
-    slice_objects = []
-    for file_path in dicom_files_path:
-        try:
-            dicom_slice = pydicom.dcmread(file_path)
-            slice_objects.append(dicom_slice)
-        except Exception as e:
-            print(f"Warning: Could not read DICOM file {file_path}: {e}")
-            raise ValueError(f"Could not read DICOM file {file_path}: {e}")
-        
+    Generates a Grad-CAM style heatmap and also returns the model's prediction.
+    Returns (heatmap_directory_path, ece_probability, non_ece_probability).
+    Pass `series_volume` when the series has already been read, so the DICOM
+    files are not decoded again. The model itself comes ready-loaded from the
+    process-wide ModelRegistry, and when INFERENCE_BATCHING_ENABLED is set the
+    pass is batched with other requests.
+
+    With `with_heatmap=False` only a forward pass is run (no gradients) and the
+    heatmap directory is None; this is the score-only mode used for triage.
+    """
+    print("--- Starting generate_heatmap ---")
+    print(f"Processing directory: {dicom_directory}")
+    if series_volume is None:
+        series_volume = load_series_volume(dicom_directory)
+    volume = create_model_volume(series_volume)
+    if volume is None or volume.size == 0:
+        print("!!! ERROR: create_model_volume failed.")
+        return None, None, None
 
-    # if we could not read any of the files , we raise an error
-    if not slice_objects:
-        print(f"Error: No valid DICOM files found in directory: {dicom_series_directory_path}")
-        raise ValueError("No valid DICOM files found in the specified directory.")
-    
+    resized_volume, output_shape = prepare_model_input(volume)
 
-    # let's sort the slices by InstanceNumber
-    try:
-        slice_objects.sort(key= lambda slice_obj: int(slice_obj.get("InstanceNumber", 0)) )
-        print(f"Sorted {len(slice_objects)} slices by InstanceNumber)")
-    except Exception as e:
-        #if sorting by InstanceNumber fails, we can sort by filename
-        print(f"Warning: Could not sort slices by InstanceNumber: {e}. Sorting by filename instead.")
-        pass
-
-    #Extracting pixel data from the sorted slices
-    for dicom_slice in slice_objects:
-        try:
-            pixel_array = dicom_slice.pixel_array
-            slices_data.append(pixel_array)
-        except Exception as e:
-            print(f"Warning: Could not extract pixel data from DICOM slice: {e}")
-            raise ValueError(f"Could not extract pixel data from DICOM slice: {e}")
-    
-    pixel_spacing = [1.0,1.0]  # Default spacing if not found
-    slice_thickness = 1.0  # Default thickness if not found
+    # --- GETTING THE MODEL ---
+    # The model and the Grad-CAM wrapper are loaded once per worker process by the registry.
+    registry = get_model_registry()
+    if not registry.ensure_loaded():
+        return None, None, None
 
+    if with_heatmap and registry.gradcam_fn is None:
+        # If Grad-CAM is not available, we can still get a prediction from the main model
+        print("  > Grad-CAM is not available, computing the score only.")
+        with_heatmap = False
 
-    if slice_objects:
-        #pixel_spacing 
-        first_slice = slice_objects[0]
-        ps = first_slice.get('PixelSpacing', None)
-        if ps:
-            pixel_spacing = [float(ps[0]), float(ps[1])]
-            print(f"Pixel spacing found: {pixel_spacing}")
-        else:
-            print("Warning: Pixel spacing not found in DICOM metadata, using default values [1.0,1.0].")
+    # --- GENERATE HEATMAP & SCORE ---
+    print("  > Generating heatmap and extracting score..." if with_heatmap else "  > Extracting score (no heatmap)...")
+    if getattr(settings, 'INFERENCE_BATCHING_ENABLED', False):
+        # Imported here because the dispatcher itself builds on compute_gradcam_batch.
+        from .inference_dispatcher import get_inference_dispatcher
+        prediction_row, cam = get_inference_dispatcher().submit(resized_volume, with_heatmap=with_heatmap).result()
+    elif with_heatmap:
+        predictions, cams = compute_gradcam_batch(registry.gradcam_fn, np.expand_dims(resized_volume, axis=(0, -1)))
+        prediction_row, cam = predictions[0], cams[0]
+    else:
+        prediction_row = compute_predictions_batch(registry.predict_fn, np.expand_dims(resized_volume, axis=(0, -1)))[0]
+        cam = None
 
+    ece_prob, non_ece_prob = split_prediction_probabilities(prediction_row)
+    print(f"  > Model prediction values (preds): {prediction_row}")
+    if cam is None:
+        return None, ece_prob, non_ece_prob
 
-    # slice_thickness
-        st = first_slice.get('SliceThickness', None)
-        if st:
-            slice_thickness = float(st)
-            print(f"Slice thickness found: {slice_thickness}")
-        else:
-            sbs = first_slice.get('SpacingBetweenSlices', None)
-            if sbs:
-                slice_thickness
-                print(f"Using SpacingBetweenSlices for slice thickness: {slice_thickness}")
-            else:   
-                print("Warning: Slice thickness not found in DICOM metadata, using default value 1.0.")
-
+    heatmap_output_directory = save_heatmap(cam, output_shape)
+    print("--- Finished generate_heatmap successfully ---")
 
-    voxel_spacing = [pixel_spacing[0], pixel_spacing[1], slice_thickness] # col_spacing, row_spacing, slice_thickness
+    return heatmap_output_directory, ece_prob, non_ece_prob
 
 
-    # Stack the slices into a 3D numpy array
-    try:
-        volume = np.stack(slices_data, axis=0)  # shape (rows, cols, slices)
-        print(f"Successfully stacked {len(slices_data)} as 3D volume with shape: {volume.shape}")
-        return volume, voxel_spacing
-    except ValueError as e:
-        print(f"Error stacking slices into a 3D volume: {e}")
-        raise ValueError(f"Error stacking slices into a 3D volume: {e}")
-        return None, None
+def load_scan_as_3d_volume(dicom_series_directory_path):
+    """
+    Reads a series of DICOM files from the specified directory, sorts them by InstanceNumber,
+    and stacks them into a 3D numpy array(Volume).
+    The volume is memory-mapped from the series' consolidated volume store when it has one.
+    Returns (volume, voxel_spacing); use load_series_volume when the rest of the metadata is needed."""
+    series_volume = load_series_volume(dicom_series_directory_path)
+    return series_volume.pixels, series_volume.voxel_spacing
     
 
-def get_slice_from_volume_and_save_png(volume_3d, view_orientation, slice_index, 
-                                       window_center, window_width, 
-                                       output_directory, output_filename_prefix):
-    
+def render_slice(volume_3d, view_orientation, slice_index, window_center, window_width):
+    """
+    Cuts one 2D slice out of the volume and applies the window.
+    Returns the windowed uint8 image, or None if the orientation or index is invalid.
+    """
     print(f"Extracting slice: orientation={view_orientation}, index={slice_index} from volume of shape {volume_3d.shape}")
 
-    # Why these checks?
-    # We need to make sure we have everything we need to work.
-    if volume_3d is None:
-        print("Error: Input 3D volume is None.")
-        return None
-    if not output_directory or not output_filename_prefix:
-        print("Error: Output directory or filename prefix not provided.")
-        return None
-
-    
-
     slice_2d = None # This will hold our cut 2D picture data.
 
     if view_orientation == "axial":
@@ -465,16 +475,56 @@ def get_slice_from_volume_and_save_png(volume_3d, view_orientation, slice_index,
         return None
 
     
-    # Ensure slice_2d is float32 for apply_windowing if it's not already
-    if slice_2d.dtype != np.float32:
-        slice_2d_float = slice_2d.astype(np.float32)
-    else:
-        slice_2d_float = slice_2d
-        
-    windowed_slice = apply_windowing(slice_2d_float, window_center, window_width)
+    # Integer slices go through a cached lookup table per window (one gather, no float
+    # copy); anything else is converted to float32 and windowed as before.
+    windowed_slice = apply_window_lut(slice_2d, window_center, window_width)
     print(f"  Applied windowing. Resulting dtype: {windowed_slice.dtype}, shape: {windowed_slice.shape}")
+    return windowed_slice
+
+
+# Formats the slice endpoints can encode to, and their content types.
+SLICE_IMAGE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+
+def encode_slice_image(windowed_slice, image_format='png', quality=85):
+    """
+    Encodes a windowed uint8 slice straight into image bytes in memory, as a
+    single-channel grayscale image. `quality` only applies to webp and jpeg.
+    """
+    if image_format not in SLICE_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported slice image format '{image_format}'.")
+    with timed_stage(f'{image_format}_encode', log_level=logging.DEBUG):
+        image = Image.fromarray(np.ascontiguousarray(windowed_slice, dtype=np.uint8))
+        buffer = io.BytesIO()
+        if image_format == 'png':
+            # Level 1 is much faster than the default and barely larger for CT slices.
+            image.save(buffer, format='PNG', compress_level=1)
+        else:
+            image.save(buffer, format=image_format.upper(), quality=int(quality))
+        return buffer.getvalue()
 
 
+def get_slice_from_volume_and_save_png(volume_3d, view_orientation, slice_index, 
+                                       window_center, window_width, 
+                                       output_directory, output_filename_prefix):
+
+    # Why these checks?
+    # We need to make sure we have everything we need to work.
+    if volume_3d is None:
+        print("Error: Input 3D volume is None.")
+        return None
+    if not output_directory or not output_filename_prefix:
+        print("Error: Output directory or filename prefix not provided.")
+        return None
+
+    windowed_slice = render_slice(volume_3d, view_orientation, slice_index, window_center, window_width)
+    if windowed_slice is None:
+        return None
+
     
     os.makedirs(output_directory, exist_ok=True)
     
@@ -486,8 +536,8 @@ def get_slice_from_volume_and_save_png(volume_3d, view_orientation, slice_index,
 
     
     try:
-        
-        plt.imsave(full_output_path, windowed_slice, cmap='gray', vmin=0, vmax=255)
+        with open(full_output_path, 'wb') as png_file:
+            png_file.write(encode_slice_image(windowed_slice, 'png'))
         print(f"  Successfully saved PNG: {full_output_path}")
         return full_output_path # Give back the full path to where we saved the picture.
     except Exception as e:
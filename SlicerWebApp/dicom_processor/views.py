@@ -2,73 +2,132 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import quote_etag
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition, require_POST, require_safe
+from django.urls import reverse
 from django.conf import settings
-from .models import DicomSeries, ProcessingResult
+from .models import DicomSeries, ProcessingJob, ProcessingResult
 from .forms import DicomUploadForm
-from .utils import (
-    generate_heatmap, 
-    load_scan_as_3d_volume, 
-    get_slice_from_volume_and_save_png, 
-    convert_dicom_series_to_nrrd
+from .inference_dispatcher import get_inference_dispatcher
+from .ingest import sort_slice_headers
+from .instance_store import get_instance_store
+from .jobs import enqueue_processing_job, fail_orphaned_jobs, job_status
+from .media_serving import SERVED_MEDIA_DIRECTORIES, media_file_response, media_url
+from .metrics import get_metrics
+from .model_registry import get_model_registry
+from .upload_handlers import DicomStreamingUploadHandler
+from .render_cache import RENDER_CACHE_DIRNAME, get_render_cache, slice_render_key
+from .result_cache import get_result_cache
+from .utils import SLICE_IMAGE_FORMATS, encode_slice_image, read_nrrd_levels, render_slice
+from .windowing import apply_window_lut
+from .slice_payload import (
+    ORIENTATION_AXES, SLICE_PAYLOAD_CONTENT_TYPE, SLICE_PAYLOAD_MAX_SLICES, iter_slice_batch, iter_slice_payload, slice_indices,
+    slice_payload_header, slice_range_pixels, stacked_slices,
 )
+from .volume_cache import get_series_volume, get_volume_cache, series_directory_mtime
+import functools
+import hashlib
+import hmac
 import os
 import pydicom
 import time
 import json
+import math
 from datetime import datetime
 
+# Rendered slices are content-addressed (see render_cache), so browsers may keep them a while.
+SLICE_CACHE_MAX_AGE = 60 * 60
+
+def _series_metadata(header):
+    """DicomSeries fields from the first SliceHeader of a series; the pixels are never needed."""
+    patient_id = header.get('PatientID', 'Unknown')
+    series_desc = header.get('SeriesDescription', '')
+    study_desc = header.get('StudyDescription', '')
+    now_str = datetime.now().strftime("%Y-%m-%d_%H%M")
+    wc_val = header.get('WindowCenter', 40)
+    ww_val = header.get('WindowWidth', 400)
+    return {
+        'patient_id': patient_id,
+        'name': f"{patient_id}_{series_desc or study_desc or now_str}",
+        'patient_age': header.get('PatientAge', ''),
+        'patient_gender': header.get('PatientSex', ''),
+        'window_center': float(wc_val[0]) if isinstance(wc_val, pydicom.multival.MultiValue) else float(wc_val),
+        'window_width': float(ww_val[0]) if isinstance(ww_val, pydicom.multival.MultiValue) else float(ww_val),
+    }
+
+
+@csrf_exempt
 @login_required
 def upload_dicom(request):
+    # The streaming handler has to be installed before anything reads request.POST,
+    # which is why CSRF is checked inside _upload_dicom rather than by the middleware.
+    request.upload_handlers = [DicomStreamingUploadHandler(request)]
+    return _upload_dicom(request)
+
+
+@csrf_protect
+def _upload_dicom(request):
     if request.method == 'POST':
         form = DicomUploadForm(request.POST)
         files = request.FILES.getlist('dicom_files')
-        
+        handler = request.upload_handlers[0]
+
+        for file_name, reason in handler.rejected:
+            messages.warning(request, f"Skipped '{file_name}': {reason}.")
         if not files:
             messages.error(request, "Please upload at least one DICOM file.")
             return redirect('upload_dicom')
 
         if form.is_valid():
             user_dir = os.path.join(settings.MEDIA_ROOT, f'user_{request.user.id}')
-            upload_dir = os.path.join(user_dir, f'upload_{int(time.time())}')
-            os.makedirs(upload_dir, exist_ok=True)
-
-            for file in files:
-                with open(os.path.join(upload_dir, file.name), 'wb+') as dest:
-                    for chunk in file.chunks():
-                        dest.write(chunk)
-
-            patient_id, series_name, patient_age, patient_gender = 'Unknown', f'Series_{int(time.time())}', '', ''
-            wc, ww = 40, 400
-            try:
-                first_dcm_path = os.path.join(upload_dir, os.listdir(upload_dir)[0])
-                ds = pydicom.dcmread(first_dcm_path)
-                patient_id = ds.get('PatientID', 'Unknown')
-                series_desc = ds.get('SeriesDescription', '')
-                study_desc = ds.get('StudyDescription', '')
-                now_str = datetime.now().strftime("%Y-%m-%d_%H%M")
-                series_name = f"{patient_id}_{series_desc or study_desc or now_str}"
-                patient_age = ds.get('PatientAge', '')
-                patient_gender = ds.get('PatientSex', '')
-                wc_val = ds.get('WindowCenter', wc)
-                ww_val = ds.get('WindowWidth', ww)
-                wc = float(wc_val[0]) if isinstance(wc_val, pydicom.multival.MultiValue) else float(wc_val)
-                ww = float(ww_val[0]) if isinstance(ww_val, pydicom.multival.MultiValue) else float(ww_val)
-            except Exception as e:
-                messages.warning(request, f"Could not read full DICOM metadata: {e}")
-
-            series = DicomSeries.objects.create(
-                user=request.user,
-                name=series_name,
-                file_path=upload_dir,
-                patient_id=patient_id,
-                patient_age=patient_age,
-                patient_gender=patient_gender,
-                window_center=wc,
-                window_width=ww
-            )
-            messages.success(request, f"Successfully uploaded series: '{series.name}'")
-            return redirect('process_dicom', series_id=series.id)
+            upload_time = int(time.time())
+            store = get_instance_store()
+
+            # The handler already parsed every header and grouped the instances by
+            # SeriesInstanceUID while they streamed in; each group becomes one series.
+            groups = sorted(handler.series_index.values(), key=len, reverse=True)
+            created = []
+            for group_number, group_files in enumerate(groups):
+                suffix = f'_{group_number + 1}' if group_number else ''
+                upload_dir = os.path.join(user_dir, f'upload_{upload_time}{suffix}')
+                os.makedirs(upload_dir, exist_ok=True)
+
+                # Instances go to the content-addressed store once; the upload directory
+                # only links to them, so uploading a study again costs hashing, not disk.
+                entries = [store.add_uploaded_file(file, os.path.join(upload_dir, file.name)) for file in group_files]
+                headers = [file.dicom_header for file in group_files]
+
+                # Write the consolidated volume now, so later slice views and processing
+                # memory-map one file instead of re-parsing every .dcm file.
+                volume_key = None
+                try:
+                    volume_key, _ = store.build_or_link_volume_store(upload_dir, entries, headers=headers)
+                except (OSError, ValueError) as e:
+                    messages.warning(request, f"Could not build the volume store for this upload: {e}")
+                store.write_manifest(upload_dir, entries, volume_key)
+
+                already_stored = sum(1 for entry in entries if entry['deduplicated'])
+                if already_stored:
+                    messages.info(request, f"{already_stored} of {len(entries)} files were already stored and were not written again.")
+
+                metadata = {'name': f'Series_{upload_time}', 'patient_id': 'Unknown'}
+                try:
+                    metadata = _series_metadata(sort_slice_headers(headers)[0])
+                except Exception as e:
+                    messages.warning(request, f"Could not read full DICOM metadata: {e}")
+
+                series = DicomSeries.objects.create(user=request.user, file_path=upload_dir, **metadata)
+                messages.success(request, f"Successfully uploaded series: '{series.name}'")
+                created.append(series)
+
+            if len(created) > 1:
+                messages.info(request, f"The upload contained {len(created)} series; they are all listed under My Uploads.")
+            return redirect('process_dicom', series_id=created[0].id)
     else:
         form = DicomUploadForm()
     return render(request, 'dicom_processor/upload.html', {'form': form})
@@ -78,41 +137,52 @@ def process_dicom(request, series_id):
     series = get_object_or_404(DicomSeries, id=series_id, user=request.user)
     
     if request.method == 'POST':
-        print(f"--- Starting processing for Series ID: {series.id} ---")
-        
-        # NOTE: This assumes your `generate_heatmap` in utils.py returns:
-        # (heatmap_directory_path, ece_probability, non_ece_probability)
-        heatmap_dir_path, ece_prob, non_ece_prob = generate_heatmap(series.file_path)
-
-        nrrd_dir = os.path.join(settings.MEDIA_ROOT, "nrrd_files")
-        os.makedirs(nrrd_dir, exist_ok=True)
-        nrrd_path = os.path.join(nrrd_dir, f"user{series.user.id}_series{series.id}.nrrd")
-        convert_dicom_series_to_nrrd(series.file_path, nrrd_path)
-
-        volume, _ = load_scan_as_3d_volume(series.file_path)
-        slice_counts = {
-            'axial': volume.shape[0],
-            'coronal': volume.shape[1],
-            'sagittal': volume.shape[2]
-        } if volume is not None else {}
-
-        # === FIX IS HERE: Saving to the NEW model fields ===
-        ProcessingResult.objects.update_or_create(
-            dicom_series=series,
-            defaults={
-                'result_type': 'heatmap_and_prediction',
-                'heatmap_file_path': os.path.join(heatmap_dir_path, 'heatmap.nrrd') if heatmap_dir_path else None,
-                'nrrd_file_path': nrrd_path,
-                'ece_probability': ece_prob if ece_prob is not None else 0.0,
-                'non_ece_probability': non_ece_prob if non_ece_prob is not None else 0.0,
-                'slice_counts_json': json.dumps(slice_counts)
-            }
-        )
-        messages.success(request, f"Processing complete for '{series.name}'.")
-        return redirect('dashboard_series_view', series_id=series.id)
+        # The pipeline runs on the background worker pool; the page polls
+        # job_status_ajax and moves on to the dashboard once the result is ready.
+        # Leaving "Generate Heatmap" unticked runs the score-only forward pass.
+        if 'heatmap' in request.POST.getlist('process_type'):
+            mode = ProcessingJob.MODE_FULL
+        else:
+            mode = ProcessingJob.MODE_SCORE_ONLY
+        job = enqueue_processing_job(series, mode=mode)
+        messages.info(request, f"Processing started for '{series.name}'.")
+        return redirect(f"{reverse('process_dicom', args=[series.id])}?job={job.id}")
 
     latest_result = ProcessingResult.objects.filter(dicom_series=series).first()
-    return render(request, 'dicom_processor/process.html', {'series': series, 'latest_result': latest_result})
+    fail_orphaned_jobs(series.processing_jobs.all())
+
+    # The job we just started (passed as ?job=<id>), otherwise whatever is still queued or running.
+    job_id = request.GET.get('job', '')
+    active_job = series.processing_jobs.filter(id=job_id).first() if job_id.isdigit() else None
+    if active_job is None:
+        active_job = series.processing_jobs.filter(
+            state__in=[ProcessingJob.STATE_QUEUED, ProcessingJob.STATE_RUNNING]
+        ).first()
+
+    context = {'series': series, 'latest_result': latest_result, 'active_job': active_job}
+    return render(request, 'dicom_processor/process.html', context)
+
+
+@login_required
+@require_POST
+def compute_heatmap(request, series_id):
+    """Adds the heatmap to a series that was processed in score-only mode."""
+    series = get_object_or_404(DicomSeries, id=series_id, user=request.user)
+    if not ProcessingResult.objects.filter(dicom_series=series).exists():
+        messages.error(request, "Process this series before computing its heatmap.")
+        return redirect('process_dicom', series_id=series.id)
+    job = enqueue_processing_job(series, mode=ProcessingJob.MODE_HEATMAP)
+    messages.info(request, f"Computing the heatmap for '{series.name}'.")
+    return redirect(f"{reverse('process_dicom', args=[series.id])}?job={job.id}")
+
+@login_required
+def job_status_ajax(request, job_id):
+    fail_orphaned_jobs(ProcessingJob.objects.filter(id=job_id, dicom_series__user=request.user))
+    job = get_object_or_404(ProcessingJob, id=job_id, dicom_series__user=request.user)
+    status = job_status(job)
+    if status['result_ready']:
+        status['redirect_url'] = reverse('dashboard_series_view', args=[job.dicom_series_id])
+    return JsonResponse(status)
 
 @login_required
 def delete_dicom(request, series_id):
@@ -126,13 +196,15 @@ def delete_dicom(request, series_id):
         dicom_dir_path = series.file_path
         
         # Delete the database record first. This will cascade and delete related ProcessingResult.
+        get_volume_cache().invalidate(series.id)
         series.delete()
         
-        # Now, delete the files from the disk
+        # Now, delete the files from the disk. Stored instances that another series
+        # still links to are kept; the rest are removed with the directory.
         try:
             if os.path.isdir(dicom_dir_path):
-                shutil.rmtree(dicom_dir_path)
-                print(f"Successfully deleted directory: {dicom_dir_path}")
+                removed_blobs = get_instance_store().release_series(dicom_dir_path)
+                print(f"Successfully deleted directory: {dicom_dir_path} ({removed_blobs} stored files released)")
         except Exception as e:
             messages.error(request, f"Could not delete files for series '{series_name}'. Please check server permissions. Error: {e}")
 
@@ -171,47 +243,314 @@ def dashboard_view(request, series_id=None):
 
 # ... (The rest of your views: get_slice_url_ajax, get_nrrd_url, get_heatmap_url, etc. remain the same as the previous correct version) ...
 
+def _int_param(request, name, default):
+    """The query parameter `name` as an int; a value that is not one raises ValueError."""
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, not '{value}'.")
+
+
+def _window_param(request, name, default):
+    """The window parameter `name` as a finite float; anything else raises ValueError."""
+    value = request.GET.get(name)
+    if value is None:
+        return float(default)
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number, not '{value}'.")
+    return number
+
+
+def _slice_request(request):
+    """
+    Reads (series, view_type, slice_index, window_center, window_width) from the query string.
+    The window defaults to the series' own values; the series must belong to the user.
+    An unknown view_type, parameters that are not numbers, or a window width that is
+    not positive raise ValueError.
+    """
+    series = get_object_or_404(DicomSeries, id=request.GET.get('series_id'), user=request.user)
+    view_type = request.GET.get('view_type')
+    if view_type not in ORIENTATION_AXES:
+        raise ValueError(f"Unknown view_type '{view_type}'.")
+    slice_index = _int_param(request, 'slice_index', 0)
+    window_center = _window_param(request, 'window_center', series.window_center)
+    window_width = _window_param(request, 'window_width', series.window_width)
+    if window_width <= 0:
+        raise ValueError(f"window_width must be positive, not {window_width:g}.")
+    return series, view_type, slice_index, window_center, window_width
+
+
+def _slice_etag(request):
+    try:
+        series, view_type, slice_index, window_center, window_width = _slice_request(request)
+    except ValueError:
+        # No ETag; the view answers the bad parameters with a 400.
+        return None
+    return slice_render_key(series, view_type, slice_index, window_center, window_width)
+
+
+def _slice_url_etag(request):
+    # The ETag promises the client that its slice_url still works, so a slice the render
+    # cache has evicted gets none: the view renders it again and sets the ETag itself.
+    key = _slice_etag(request)
+    if key is None or not get_render_cache().touch(key):
+        return None
+    return key
+
+
 @login_required
+@cache_control(private=True, max_age=SLICE_CACHE_MAX_AGE)
+@condition(etag_func=_slice_url_etag)
 def get_slice_url_ajax(request):
-    series_id = request.GET.get('series_id')
-    view_type = request.GET.get('view_type')
-    slice_index = int(request.GET.get('slice_index', 0))
+    # `condition` answers a matching If-None-Match with 304 before we touch the volume at all.
+    try:
+        series, view_type, slice_index, window_center, window_width = _slice_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': f"Invalid parameters: {e}"}, status=400)
 
-    series = get_object_or_404(DicomSeries, id=series_id, user=request.user)
-    volume, _ = load_scan_as_3d_volume(series.file_path)
+    def load_volume():
+        # Scrolling asks for many slices of the same series, so the decoded volume is cached per process.
+        return get_series_volume(series).pixels
 
-    if volume is None:
+    key = slice_render_key(series, view_type, slice_index, window_center, window_width)
+    try:
+        saved_path = get_render_cache().get_or_render(
+            key, load_volume, view_type, slice_index, window_center, window_width
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error loading volume for series {series.id}: {e}")
         return JsonResponse({'error': 'Failed to load 3D volume'}, status=500)
 
-    output_dir = os.path.join(settings.MEDIA_ROOT, 'tmp_slices')
-    os.makedirs(output_dir, exist_ok=True)
-    
-    file_prefix = f"user{request.user.id}_series{series.id}_"
-
-    saved_path = get_slice_from_volume_and_save_png(
-        volume_3d=volume,
-        view_orientation=view_type,
-        slice_index=slice_index,
-        window_center=series.window_center,
-        window_width=series.window_width,
-        output_directory=output_dir,
-        output_filename_prefix=file_prefix
-    )
-
     if saved_path:
-        url = os.path.join(settings.MEDIA_URL, 'tmp_slices', os.path.basename(saved_path))
-        return JsonResponse({'success': True, 'slice_url': url})
+        url = os.path.join(settings.MEDIA_URL, RENDER_CACHE_DIRNAME, os.path.basename(saved_path))
+        response = JsonResponse({'success': True, 'slice_url': url})
+        response['ETag'] = quote_etag(key)
+        return response
     else:
         return JsonResponse({'error': 'Failed to generate slice'}, status=500)
 
+def _slice_image_format(request):
+    image_format = request.GET.get('format', 'png').lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    quality = min(max(_int_param(request, 'quality', 85), 1), 100)
+    return image_format, quality
+
+
+def _slice_image_etag(request):
+    try:
+        image_format, quality = _slice_image_format(request)
+    except ValueError:
+        return None
+    slice_etag = _slice_etag(request)
+    if image_format not in SLICE_IMAGE_FORMATS or slice_etag is None:
+        return None
+    return f"{slice_etag}-{image_format}-{quality}"
+
+
+@login_required
+@cache_control(private=True, max_age=SLICE_CACHE_MAX_AGE)
+@condition(etag_func=_slice_image_etag)
+def get_slice_image(request):
+    """
+    Returns the windowed slice itself as image bytes (png by default, or webp/jpeg
+    with ?format=...&quality=...), encoded in memory. This saves the second round
+    trip of fetching the file that get_slice_url_ajax points to.
+    """
+    try:
+        series, view_type, slice_index, window_center, window_width = _slice_request(request)
+        image_format, quality = _slice_image_format(request)
+    except ValueError as e:
+        return JsonResponse({'error': f"Invalid parameters: {e}"}, status=400)
+    if image_format not in SLICE_IMAGE_FORMATS:
+        return JsonResponse({'error': f"Unsupported format '{image_format}'."}, status=400)
+
+    try:
+        volume = get_series_volume(series).pixels
+    except (OSError, ValueError) as e:
+        print(f"Error loading volume for series {series.id}: {e}")
+        return JsonResponse({'error': 'Failed to load 3D volume'}, status=500)
+
+    slice_count = volume.shape[ORIENTATION_AXES[view_type]]
+    if not 0 <= slice_index < slice_count:
+        return JsonResponse({'error': f"Slice {slice_index} is out of bounds for {slice_count} {view_type} slices."},
+                            status=400)
+    windowed_slice = render_slice(volume, view_type, slice_index, window_center, window_width)
+    if windowed_slice is None:
+        return JsonResponse({'error': 'Failed to generate slice'}, status=500)
+    return HttpResponse(encode_slice_image(windowed_slice, image_format, quality),
+                        content_type=SLICE_IMAGE_FORMATS[image_format])
+
+def _slice_batch_request(request):
+    """
+    Reads (series, view_type, start, stop, step, window_center, window_width) for the
+    slice batch endpoint; `stop` is None when the range runs to the end.
+    """
+    series, view_type, start, window_center, window_width = _slice_request(request)
+    start = _int_param(request, 'start', start)
+    stop = _int_param(request, 'stop', None)
+    step = _int_param(request, 'step', 1)
+    if step == 0:
+        raise ValueError("step must not be 0.")
+    return series, view_type, start, stop, step, window_center, window_width
+
+
+def _slice_batch_etag(request):
+    try:
+        series, view_type, start, stop, step, window_center, window_width = _slice_batch_request(request)
+        image_format, quality = _slice_image_format(request)
+    except ValueError:
+        # No ETag; the view answers the bad parameters with a 400.
+        return None
+    parts = [
+        series.id, series_directory_mtime(series.file_path), view_type, start, stop, step,
+        f"{window_center:g}", f"{window_width:g}", image_format, quality,
+    ]
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()[:24]
+
+
+@login_required
+@cache_control(private=True, max_age=SLICE_CACHE_MAX_AGE)
+@condition(etag_func=_slice_batch_etag)
+def get_slice_batch(request):
+    """
+    Returns a run of windowed slices of one orientation in a single streamed response,
+    for prefetching while the user scrolls: ?view_type=...&start=...&stop=...&step=...
+    (up to SLICE_BATCH_MAX_SLICES slices) with the same window and format parameters
+    as get_slice_image. The body is a length-prefixed container of encoded images (see
+    slice_payload.SLICE_BATCH_MAGIC). The range is windowed in one pass and the slices
+    are encoded in parallel, each sent as soon as it is ready.
+    """
+    try:
+        series, view_type, start, stop, step, window_center, window_width = _slice_batch_request(request)
+        image_format, quality = _slice_image_format(request)
+    except ValueError as e:
+        return JsonResponse({'error': f"Invalid parameters: {e}"}, status=400)
+    if image_format not in SLICE_IMAGE_FORMATS:
+        return JsonResponse({'error': f"Unsupported format '{image_format}'."}, status=400)
+
+    try:
+        volume = get_series_volume(series).pixels
+    except (OSError, ValueError) as e:
+        print(f"Error loading volume for series {series.id}: {e}")
+        return JsonResponse({'error': 'Failed to load 3D volume'}, status=500)
+
+    try:
+        indices = slice_indices(volume.shape[ORIENTATION_AXES[view_type]], start, stop, step)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    windowed_slices = apply_window_lut(stacked_slices(volume, view_type, indices), window_center, window_width)
+    header = {
+        'view_type': view_type,
+        'format': image_format,
+        'content_type': SLICE_IMAGE_FORMATS[image_format],
+        'window_center': window_center,
+        'window_width': window_width,
+    }
+    encode = functools.partial(encode_slice_image, image_format=image_format, quality=quality)
+    return StreamingHttpResponse(
+        iter_slice_batch(header, windowed_slices, indices, encode, workers=getattr(settings, 'SLICE_BATCH_WORKERS', None)),
+        content_type=SLICE_PAYLOAD_CONTENT_TYPE,
+    )
+
+
+def _raw_slice_request(request):
+    """
+    Reads (series, view_type, first_index, count, gzip) for the raw slice endpoint.
+    `gzip` is only set when ?compression=gzip is asked for and the client accepts it.
+    An index or count that is not an integer raises ValueError.
+    """
+    series = get_object_or_404(DicomSeries, id=request.GET.get('series_id'), user=request.user)
+    view_type = request.GET.get('view_type', 'axial')
+    first_index = _int_param(request, 'slice_index', 0)
+    count = min(max(_int_param(request, 'count', 1), 1), SLICE_PAYLOAD_MAX_SLICES)
+    use_gzip = (
+        request.GET.get('compression') == 'gzip'
+        and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    )
+    return series, view_type, first_index, count, use_gzip
+
+
+def _raw_slice_etag(request):
+    try:
+        series, view_type, first_index, count, use_gzip = _raw_slice_request(request)
+    except ValueError:
+        # No ETag; the view answers the bad parameters with a 400.
+        return None
+    parts = [series.id, series_directory_mtime(series.file_path), view_type, first_index, count, use_gzip]
+    return '-'.join(str(part) for part in parts)
+
+
+@login_required
+@cache_control(private=True, max_age=SLICE_CACHE_MAX_AGE)
+@condition(etag_func=_raw_slice_etag)
+def get_slice_raw(request):
+    """
+    Returns stored pixel values (no windowing) of one slice, or of up to
+    SLICE_PAYLOAD_MAX_SLICES consecutive slices with ?count=N, as a binary payload
+    (see slice_payload): a small JSON header with shape, dtype, rescale slope and
+    intercept, followed by the pixels. The viewer can then window and level locally
+    instead of asking for a new image on every drag. Axial ranges are streamed
+    straight from the cached volume without copying it; ?compression=gzip sends the
+    payload gzip-encoded to clients that accept it.
+    """
+    try:
+        series, view_type, first_index, count, use_gzip = _raw_slice_request(request)
+    except ValueError as e:
+        return JsonResponse({'error': f"Invalid parameters: {e}"}, status=400)
+    try:
+        series_volume = get_series_volume(series)
+    except (OSError, ValueError) as e:
+        print(f"Error loading volume for series {series.id}: {e}")
+        return JsonResponse({'error': 'Failed to load 3D volume'}, status=500)
+
+    try:
+        slices = slice_range_pixels(series_volume.pixels, view_type, first_index, count)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    header_bytes = slice_payload_header(series_volume, view_type, first_index, slices)
+    response = StreamingHttpResponse(
+        iter_slice_payload(header_bytes, slices, compress=use_gzip), content_type=SLICE_PAYLOAD_CONTENT_TYPE
+    )
+    if use_gzip:
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response['Content-Length'] = len(header_bytes) + slices.nbytes
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
 @login_required
 def get_nrrd_url(request, series_id):
     series = get_object_or_404(DicomSeries, id=series_id, user=request.user)
     result = getattr(series, 'processing_result', None)
     
     if result and result.nrrd_file_path and os.path.exists(result.nrrd_file_path):
-        url = result.nrrd_file_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL).replace('\\', '/')
-        return JsonResponse({'success': True, 'nrrd_url': url})
+        url = media_url(result.nrrd_file_path)
+        # Coarsest first; the viewer renders the first level and refines with the rest.
+        # Volumes converted before the levels existed are a single full resolution level.
+        levels = read_nrrd_levels(result.nrrd_file_path) or [{
+            'shrink_factor': 1, 'path': result.nrrd_file_path, 'size': None,
+            'bytes': os.path.getsize(result.nrrd_file_path),
+        }]
+        levels = [
+            {
+                'url': media_url(level['path']),
+                'shrink_factor': level['shrink_factor'],
+                'size': level['size'],
+                'bytes': level['bytes'],
+            }
+            for level in levels
+        ]
+        return JsonResponse({'success': True, 'nrrd_url': url, 'levels': levels})
     return JsonResponse({'error': 'NRRD file not found for this series. Please process the series.'}, status=404)
 
 @login_required
@@ -220,11 +559,80 @@ def get_heatmap_url(request, series_id):
     result = getattr(series, 'processing_result', None)
     
     if result and result.heatmap_file_path and os.path.exists(result.heatmap_file_path):
-        url = result.heatmap_file_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL).replace('\\', '/')
+        url = media_url(result.heatmap_file_path)
         return JsonResponse({'success': True, 'heatmap_url': url})
     return JsonResponse({'error': 'Heatmap file not found for this series.'}, status=404)
 
 
+@login_required
+@require_safe
+def serve_media(request, path):
+    """
+    Serves the 3D viewer's files (NRRD volumes, heatmaps and rendered slices) from
+    MEDIA_ROOT with Range, precompressed .gz and cache header support; see
+    media_file_response. Volumes and rendered slices are only served to their owner
+    (their names start with "user<id>_") and heatmaps to users with a result that uses them.
+    """
+    directory = path.split('/', 1)[0]
+    if directory not in SERVED_MEDIA_DIRECTORIES:
+        raise Http404("Not a served media directory.")
+    try:
+        file_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Not a served media file.")
+    if not os.path.isfile(file_path):
+        raise Http404("Media file not found.")
+
+    if (directory in ('nrrd_files', RENDER_CACHE_DIRNAME)
+            and not os.path.basename(file_path).startswith(f"user{request.user.id}_")):
+        raise Http404("Media file not found.")
+    if directory == 'heatmaps':
+        heatmap_directory = os.path.dirname(file_path)
+        if not ProcessingResult.objects.filter(
+            dicom_series__user=request.user, heatmap_file_path__startswith=heatmap_directory + os.sep
+        ).exists():
+            raise Http404("Media file not found.")
+
+    return media_file_response(request, file_path, content_addressed=SERVED_MEDIA_DIRECTORIES[directory])
+
+
+def _has_metrics_token(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip(), token)
+
+
+@require_safe
+def metrics(request):
+    """
+    Prometheus text exposition of this worker's stage and request latency histograms
+    and of the stats of its caches, inference dispatcher, model and instance store.
+    Open to staff users and to requests with "Authorization: Bearer <METRICS_TOKEN>".
+    The client address is not trusted: behind a reverse proxy every request is local.
+    """
+    if not request.user.is_staff and not _has_metrics_token(request):
+        return HttpResponseForbidden("Metrics are only available to the metrics scraper and staff.")
+
+    registry = get_model_registry()
+    component_stats = {
+        'volume_cache': (get_volume_cache().stats(), {'hits', 'misses', 'evictions'}),
+        'render_cache': (get_render_cache().stats(), {'hits', 'misses', 'evictions'}),
+        'result_cache': (get_result_cache().stats(), {'hits', 'misses'}),
+        'inference_dispatcher': (
+            get_inference_dispatcher().stats(),
+            {'batches_run', 'requests_served', 'requests_failed', 'score_only_requests_served', 'total_batch_seconds'},
+        ),
+        'model': ({
+            'loaded': registry.is_loaded,
+            'load_seconds': registry.load_seconds,
+            'warmup_seconds': registry.warmup_seconds,
+        }, set()),
+    }
+    if getattr(settings, 'METRICS_INSTANCE_STORE_STATS', True):
+        component_stats['instance_store'] = (get_instance_store().stats(), set())
+    return HttpResponse(get_metrics().render(component_stats), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @login_required
 def my_uploads(request):
     series_list = DicomSeries.objects.filter(user=request.user).order_by('-uploaded_date')
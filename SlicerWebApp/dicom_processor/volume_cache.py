@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .volume_store import load_series_volume
+
+
+def series_directory_mtime(directory):
+    """Modification time of the series directory; it changes when files are added or removed."""
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+class VolumeCache:
+    """
+    Per-process LRU cache of SeriesVolume objects, bounded by a byte budget.
+    Volumes are charged their full size even when memory-mapped, since scrolling
+    through every slice pages the whole file in.
+
+    Entries are keyed by series id and remember the directory mtime they were read
+    at, so a series whose files changed on disk is read again. Only one thread
+    decodes a given series at a time; concurrent requests for it wait for that
+    read instead of decoding the same files in parallel. A series' loading lock
+    is dropped with its entry, so the locks do not outlive the cached series.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()   # series_id -> (mtime, series_volume, nbytes)
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, series_id, mtime):
+        entry = self._entries.get(series_id)
+        if entry is None or entry[0] != mtime:
+            return None
+        self._entries.move_to_end(series_id)
+        return entry[1]
+
+    def get(self, series_id, directory, loader=load_series_volume):
+        """Returns the SeriesVolume for the series, decoding it with `loader` on a miss."""
+        mtime = series_directory_mtime(directory)
+        with self._lock:
+            series_volume = self._lookup(series_id, mtime)
+            if series_volume is not None:
+                self.hits += 1
+                return series_volume
+            loading_lock = self._loading_locks.setdefault(series_id, threading.Lock())
+
+        with loading_lock:
+            # Another thread may have finished reading this series while we waited.
+            with self._lock:
+                series_volume = self._lookup(series_id, mtime)
+                if series_volume is not None:
+                    self.hits += 1
+                    return series_volume
+                self.misses += 1
+
+            try:
+                series_volume = loader(directory)
+                # Loading may have written the volume store into the directory, so take its mtime afresh.
+                self.put(series_id, directory, series_volume)
+            finally:
+                with self._lock:
+                    # Not cached (the read failed or the volume is over budget): nothing to guard any more.
+                    if series_id not in self._entries and self._loading_locks.get(series_id) is loading_lock:
+                        del self._loading_locks[series_id]
+        return series_volume
+
+    def put(self, series_id, directory, series_volume, mtime=None):
+        """Stores an already decoded series, e.g. right after the processing job read it."""
+        if mtime is None:
+            mtime = series_directory_mtime(directory)
+        nbytes = series_volume.pixels.nbytes
+        with self._lock:
+            self._remove(series_id)
+            if nbytes > self.max_bytes:
+                print(f"Volume cache: series {series_id} ({nbytes} bytes) is larger than the budget, not caching it.")
+                return
+            self._entries[series_id] = (mtime, series_volume, nbytes)
+            self._current_bytes += nbytes
+            while self._current_bytes > self.max_bytes:
+                evicted_id, _ = next(iter(self._entries.items()))
+                self._remove(evicted_id)
+                self._loading_locks.pop(evicted_id, None)
+                self.evictions += 1
+                print(f"Volume cache: evicted series {evicted_id} to stay within {self.max_bytes} bytes.")
+
+    def invalidate(self, series_id):
+        with self._lock:
+            self._remove(series_id)
+            self._loading_locks.pop(series_id, None)
+
+    def _remove(self, series_id):
+        entry = self._entries.pop(series_id, None)
+        if entry is not None:
+            self._current_bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading_locks.clear()
+            self._current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_volume_cache = None
+_volume_cache_lock = threading.Lock()
+
+
+def get_volume_cache():
+    """Returns the process-wide VolumeCache, sized by VOLUME_CACHE_MAX_BYTES."""
+    global _volume_cache
+    if _volume_cache is None:
+        with _volume_cache_lock:
+            if _volume_cache is None:
+                _volume_cache = VolumeCache(getattr(settings, 'VOLUME_CACHE_MAX_BYTES', 1024 ** 3))
+    return _volume_cache
+
+
+def get_series_volume(series):
+    """Decoded SeriesVolume for a DicomSeries, served from the volume cache when possible."""
+    return get_volume_cache().get(series.id, series.file_path)
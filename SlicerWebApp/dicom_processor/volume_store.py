@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .ingest import SeriesVolume, read_dicom_series
+from .metrics import timed_stage
+
+
+# The consolidated volume lives next to the .dcm files of the series: one raw
+# array in C order (slices, rows, cols) plus a small JSON sidecar describing it.
+VOLUME_FILENAME = 'volume.raw'
+VOLUME_HEADER_FILENAME = 'volume.json'
+VOLUME_STORE_VERSION = 2
+
+
+def _count_dicom_files(directory):
+    return sum(1 for filename in os.listdir(directory) if filename.lower().endswith('.dcm'))
+
+
+def _write_replacing(path, write):
+    """
+    Calls `write(file)` on a new file with a unique temporary name next to `path`, then
+    renames it over `path`. Workers in other processes may build the same store at the
+    same time; each writes its own file and the last rename wins.
+    """
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            write(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_volume_store(directory, series_volume):
+    """
+    Writes the series as one memory-mappable file plus its sidecar. The sidecar is
+    written last, so a store with a sidecar is always complete.
+    """
+    raw_path = os.path.join(directory, VOLUME_FILENAME)
+    header_path = os.path.join(directory, VOLUME_HEADER_FILENAME)
+
+    pixels = np.ascontiguousarray(series_volume.pixels)
+    _write_replacing(raw_path, pixels.tofile)
+
+    header = {
+        'version': VOLUME_STORE_VERSION,
+        'shape': list(pixels.shape),
+        'dtype': pixels.dtype.str,
+        'num_instances': _count_dicom_files(directory),
+        'spacing': list(series_volume.spacing),
+        'origin': list(series_volume.origin),
+        'direction': list(series_volume.direction),
+        'rescale_slopes': series_volume.rescale_slopes.tolist(),
+        'rescale_intercepts': series_volume.rescale_intercepts.tolist(),
+        'window_centers': series_volume.window_centers.tolist(),
+        'window_widths': series_volume.window_widths.tolist(),
+        'fingerprint': series_volume.fingerprint,
+    }
+    _write_replacing(header_path, lambda header_file: header_file.write(json.dumps(header).encode()))
+    print(f"  > Volume store written to {raw_path} ({pixels.nbytes} bytes)")
+
+
+def open_volume_store(directory):
+    """
+    Opens the consolidated volume of a series as a read-only np.memmap, so only the
+    slices that are actually touched get paged in. Returns None when the series has
+    no store yet, or when its .dcm files changed since the store was written.
+    """
+    header_path = os.path.join(directory, VOLUME_HEADER_FILENAME)
+    raw_path = os.path.join(directory, VOLUME_FILENAME)
+    try:
+        with open(header_path) as header_file:
+            header = json.load(header_file)
+    except (OSError, ValueError):
+        return None
+
+    if header.get('version') != VOLUME_STORE_VERSION or header.get('num_instances') != _count_dicom_files(directory):
+        print(f"Volume store in {directory} is out of date, ignoring it.")
+        return None
+
+    try:
+        pixels = np.memmap(raw_path, dtype=np.dtype(header['dtype']), mode='r', shape=tuple(header['shape']))
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not open volume store {raw_path}: {e}")
+        return None
+
+    return SeriesVolume(
+        pixels,
+        header['spacing'],
+        header['origin'],
+        header['direction'],
+        header['rescale_slopes'],
+        header['rescale_intercepts'],
+        header['window_centers'],
+        header['window_widths'],
+        fingerprint=header.get('fingerprint'),
+    )
+
+
+def build_volume_store(directory, headers=None):
+    """
+    Decodes the DICOM files once and writes the consolidated store. Returns the
+    memory-mapped SeriesVolume. `headers` skips the header scan when the caller
+    already has the SliceHeaders of the series.
+    """
+    write_volume_store(directory, read_dicom_series(directory, headers=headers))
+    return open_volume_store(directory)
+
+
+def load_series_volume(directory):
+    """
+    The SeriesVolume of a series directory: memory-mapped from the consolidated store
+    when there is one, otherwise decoded from the .dcm files (and the store written
+    for next time, so series uploaded before the store existed catch up on first use).
+    """
+    with timed_stage('volume_store_open'):
+        series_volume = open_volume_store(directory)
+    if series_volume is not None:
+        return series_volume
+
+    series_volume = read_dicom_series(directory)
+    try:
+        write_volume_store(directory, series_volume)
+    except OSError as e:
+        print(f"Warning: Could not write volume store for {directory}: {e}")
+    return series_volume
@@ -0,0 +1,118 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+# Standard CT windows as (window_center, window_width) in Hounsfield units.
+WINDOW_PRESETS = {
+    'lung': (-600, 1500),
+    'mediastinum': (50, 350),
+    'soft_tissue': (40, 400),
+    'bone': (400, 1800),
+    'brain': (40, 80),
+    'liver': (60, 160),
+}
+
+# Integer pixel types whose every value fits in a lookup table of at most 65,536 entries.
+LUT_DTYPES = (np.dtype(np.int8), np.dtype(np.uint8), np.dtype(np.int16), np.dtype(np.uint16))
+
+
+def apply_windowing(img, window_center, window_width):
+    lower = window_center - (window_width / 2)
+    upper = window_center + (window_width / 2)
+    img = np.clip(img, lower, upper)
+    img = (img - lower) / (upper - lower) * 255.0
+    return img.astype(np.uint8)
+
+
+def window_preset(name):
+    """(window_center, window_width) of a named preset, e.g. 'lung', 'bone' or 'soft_tissue'."""
+    try:
+        return WINDOW_PRESETS[name]
+    except KeyError:
+        raise ValueError(f"Unknown window preset '{name}'. Choose from: {', '.join(WINDOW_PRESETS)}.")
+
+
+def supports_lut(dtype):
+    return np.dtype(dtype) in LUT_DTYPES
+
+
+@lru_cache(maxsize=64, typed=True)
+def _cached_window_lut(dtype_str, window_center, window_width, rescale_slope, rescale_intercept):
+    dtype = np.dtype(dtype_str)
+    unsigned = np.dtype(f'u{dtype.itemsize}')
+    # Entry i belongs to the stored value whose bits read as i when viewed unsigned.
+    stored_values = np.arange(2 ** (8 * dtype.itemsize), dtype=unsigned).view(dtype)
+    # The same float32 operations as the float path, so every entry is bit-identical to it.
+    modality_values = stored_values.astype(np.float32) * rescale_slope + rescale_intercept
+    lut = apply_windowing(modality_values, window_center, window_width)
+    lut.setflags(write=False)
+    return lut
+
+
+def window_lut(dtype, window_center, window_width, rescale_slope=1.0, rescale_intercept=0.0):
+    """
+    The uint8 lookup table that windows every possible stored value of an 8 or 16 bit
+    integer dtype (65,536 entries for 16 bit), indexed by the value's unsigned bit
+    pattern. Rescale slope and intercept are folded in. Tables are cached per dtype,
+    window and rescale; the values are cached with their types, because float32 and
+    Python float windows can round differently.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in LUT_DTYPES:
+        raise ValueError(f"Lookup-table windowing supports 8 and 16 bit integers, not {dtype}.")
+    return _cached_window_lut(dtype.str, window_center, window_width, rescale_slope, rescale_intercept)
+
+
+def apply_window_lut(pixels, window_center, window_width, rescale_slope=1.0, rescale_intercept=0.0, out=None):
+    """
+    Windows integer pixels of any shape (a slice, a batch of slices or a whole volume)
+    with one gather through window_lut. Gives exactly what apply_windowing gives for
+    `pixels.astype(np.float32) * rescale_slope + rescale_intercept`; other dtypes are
+    windowed that way instead.
+    """
+    pixels = np.asarray(pixels)
+    if not supports_lut(pixels.dtype):
+        modality_values = pixels.astype(np.float32) * rescale_slope + rescale_intercept
+        windowed = apply_windowing(modality_values, window_center, window_width)
+        if out is None:
+            return windowed
+        out[...] = windowed
+        return out
+    lut = window_lut(pixels.dtype, window_center, window_width, rescale_slope, rescale_intercept)
+    indices = pixels.view(np.dtype(f'u{pixels.dtype.itemsize}'))
+    return np.take(lut, indices, out=out)
+
+
+def apply_window_preset(pixels, preset):
+    """Windows stored integer pixels in Hounsfield units with a named preset."""
+    window_center, window_width = window_preset(preset)
+    return apply_window_lut(pixels, window_center, window_width)
+
+
+def window_slices(pixels, window_centers, window_widths, rescale_slopes=None, rescale_intercepts=None):
+    """
+    Windows a (slices, rows, cols) stack where every slice has its own window and
+    rescale values, as DICOM allows. Slices that share their values (usually all of
+    them) are windowed together with one gather.
+    """
+    num_slices = pixels.shape[0]
+    if rescale_slopes is None:
+        rescale_slopes = np.ones(num_slices, dtype=np.float32)
+    if rescale_intercepts is None:
+        rescale_intercepts = np.zeros(num_slices, dtype=np.float32)
+
+    groups = {}
+    for index in range(num_slices):
+        key = (window_centers[index], window_widths[index], rescale_slopes[index], rescale_intercepts[index])
+        groups.setdefault(key, []).append(index)
+
+    windowed = np.empty(pixels.shape, dtype=np.uint8)
+    for (window_center, window_width, rescale_slope, rescale_intercept), indices in groups.items():
+        if len(indices) == num_slices:
+            apply_window_lut(pixels, window_center, window_width, rescale_slope, rescale_intercept, out=windowed)
+        else:
+            windowed[indices] = apply_window_lut(
+                pixels[indices], window_center, window_width, rescale_slope, rescale_intercept
+            )
+    return windowed